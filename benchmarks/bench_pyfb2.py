@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Замеры производительности pyFB2 на синтетическом корпусе книг (FB2Generator).
+
+Каждый замер выполняется в отдельном процессе, поэтому пиковый объем памяти (peak_rss)
+относится только к нему. Результаты выводятся в формате JSON для отслеживания регрессий.
+
+Пример:
+    python benchmarks/bench_pyfb2.py --books 50 --depth 2 --out result.json
+    python benchmarks/bench_pyfb2.py --books 50 --depth 2 --baseline result.json --only parser_full hyst
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TEMPLATE = '${Al} ${Af} - ${Tt}'
+
+
+def _peak_rss() -> int:
+    """ Пиковый объем памяти процесса в байтах. None - если платформа его не сообщает """
+    if resource is None:
+        return None
+    _rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux сообщает килобайты, macOS - байты
+    return _rss if sys.platform == 'darwin' else _rss * 1024
+
+
+def _per_file(files: list, action) -> tuple[list, int]:
+    """
+    Замер действия над каждым файлом
+    :return: Время обработки каждого файла и количество ошибок
+    """
+    _samples = []
+    _errors = 0
+    for file in files:
+        _start = time.perf_counter()
+        try:
+            action(file)
+        except Exception:
+            _errors += 1
+        _samples.append(time.perf_counter() - _start)
+    return _samples, _errors
+
+
+def _copy_corpus(files: list, work_dir: str) -> list:
+    """ Копия корпуса для замеров, которые меняют файлы. Время копирования не учитывается """
+    os.makedirs(work_dir)
+    return [shutil.copy(file, work_dir) for file in files]
+
+
+def bench_parser_full(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2Parser import FB2Parser
+    return _per_file(files, lambda file: FB2Parser(file))
+
+
+def bench_parser_metadata(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2Parser import FB2Parser
+    return _per_file(files, lambda file: FB2Parser(file, metadata_only=True))
+
+
+def bench_renamer(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2Renamer import FB2Renamer
+    return _per_file(_copy_corpus(files, work_dir), lambda file: FB2Renamer(file, TEMPLATE).rename())
+
+
+def bench_group_renamer(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2GroupRenamer import FB2GroupRenamer
+    _copy_corpus(files, work_dir)
+    _start = time.perf_counter()
+    _renamed = FB2GroupRenamer(work_dir, '', TEMPLATE).rename_all()
+    return [time.perf_counter() - _start], len(files) - _renamed
+
+
+def bench_scan_dir(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2DirScaner import FB2DirScaner
+    _copy_corpus(files, os.path.join(work_dir, 'books'))
+    # БД authors.db создается в текущем каталоге
+    _cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        _start = time.perf_counter()
+        FB2DirScaner(os.path.join(work_dir, 'books')).scan_dir()
+        return [time.perf_counter() - _start], 0
+    finally:
+        os.chdir(_cwd)
+
+
+def bench_html(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2HTML import FB2HTML
+
+    def _create_html(file: str):
+        if FB2HTML(file, work_dir, check_schema=False).create_html(work_dir) != 0:
+            raise RuntimeError(f'Не удалось создать HTML для {file}')
+
+    return _per_file(files, _create_html)
+
+
+def bench_hyst(files: list, work_dir: str) -> tuple[list, int]:
+    from pyFB2.FB2Hyst import FB2Hyst
+    os.makedirs(work_dir)
+    _hyst = FB2Hyst(database=os.path.join(work_dir, 'hyst.db'))
+    try:
+        _notebook_id = _hyst.add_notebook('Библиотека', '')
+        return _per_file(files, lambda file: _hyst.add_book_ext(file, _notebook_id))
+    finally:
+        _hyst.hyst_db.close()
+
+
+BENCHMARKS = {
+    "parser_full": bench_parser_full,
+    "parser_metadata": bench_parser_metadata,
+    "renamer": bench_renamer,
+    "group_renamer": bench_group_renamer,
+    "scan_dir": bench_scan_dir,
+    "html": bench_html,
+    "hyst": bench_hyst,
+}
+
+
+def _percentile(values: list, percent: float) -> float:
+    """ Процентиль по методу ближайшего ранга """
+    _sorted = sorted(values)
+    return _sorted[max(0, min(len(_sorted) - 1, round(percent / 100 * len(_sorted) + 0.5) - 1))]
+
+
+def _run(name: str, files: list, work_dir: str, repeat: int) -> dict:
+    """
+    Выполняет замер в процессе-исполнителе
+    :return: Итоги замера
+    """
+    _samples = []
+    _errors = 0
+    # сообщения модулей об испорченных файлах не должны попадать в вывод JSON
+    with contextlib.redirect_stdout(io.StringIO()):
+        for number in range(repeat):
+            _dir = os.path.join(work_dir, f'{name}_{number}')
+            # каталог мог остаться от прошлого запуска с тем же --work-dir
+            shutil.rmtree(_dir, ignore_errors=True)
+            _run_samples, _run_errors = BENCHMARKS[name](files, _dir)
+            _samples += _run_samples
+            _errors += _run_errors
+    _bytes = sum(os.path.getsize(file) for file in files) * repeat
+    _seconds = sum(_samples)
+    return {"name": name, "files": len(files) * repeat, "bytes": _bytes, "errors": _errors,
+            "seconds": _seconds,
+            "files_per_second": len(files) * repeat / max(_seconds, 1e-9),
+            "mb_per_second": _bytes / 1024 / 1024 / max(_seconds, 1e-9),
+            "latency": {"samples": len(_samples), "mean": _seconds / max(len(_samples), 1),
+                        "p50": _percentile(_samples, 50), "p90": _percentile(_samples, 90),
+                        "p99": _percentile(_samples, 99), "max": max(_samples)},
+            "peak_rss": _peak_rss()}
+
+
+def _compare(result: dict, baseline: dict):
+    """ Добавляет к итогам замеров отношение к базовым результатам: больше 1 - стало быстрее """
+    _base = {item["name"]: item for item in baseline.get("benchmarks", [])}
+    for item in result["benchmarks"]:
+        _old = _base.get(item["name"])
+        if _old is None:
+            continue
+        item["baseline"] = {"files_per_second": item["files_per_second"] / max(_old["files_per_second"], 1e-9),
+                            "p50": _old["latency"]["p50"] / max(item["latency"]["p50"], 1e-9)}
+
+
+def main(argv: list = None) -> int:
+    _parser = argparse.ArgumentParser(description='Замеры производительности pyFB2')
+    _parser.add_argument('--books', type=int, default=20, help='Количество книг в корпусе')
+    _parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора')
+    _parser.add_argument('--sections', type=int, default=10, help='Количество секций верхнего уровня')
+    _parser.add_argument('--depth', type=int, default=1, help='Глубина вложенности секций')
+    _parser.add_argument('--paragraphs', type=int, default=20, help='Количество абзацев в секции')
+    _parser.add_argument('--notes', type=int, default=5, help='Количество сносок')
+    _parser.add_argument('--images', type=int, default=1, help='Количество изображений в книге')
+    _parser.add_argument('--image-size', type=int, default=16384, help='Размер изображения в байтах')
+    _parser.add_argument('--authors', type=int, default=10, help='Количество разных авторов')
+    _parser.add_argument('--malformed', type=float, default=0.0, help='Доля испорченных книг, от 0 до 1')
+    _parser.add_argument('--repeat', type=int, default=1, help='Количество повторов каждого замера')
+    _parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Выполнить только эти замеры')
+    _parser.add_argument('--work-dir', help='Рабочий каталог. По умолчанию - временный, удаляется после замеров')
+    _parser.add_argument('--baseline', help='Файл JSON с результатами прошлых замеров для сравнения')
+    _parser.add_argument('--out', help='Файл для результатов. По умолчанию - стандартный вывод')
+    _args = _parser.parse_args(argv)
+
+    from pyFB2.FB2Generator import FB2Generator
+    _generator = FB2Generator(seed=_args.seed, sections=_args.sections, depth=_args.depth,
+                              paragraphs=_args.paragraphs, notes=_args.notes, images=_args.images,
+                              image_size=_args.image_size, authors=_args.authors)
+    _work_dir = _args.work_dir or tempfile.mkdtemp(prefix='pyfb2-bench-')
+    try:
+        _start = time.perf_counter()
+        _files = _generator.generate(os.path.join(_work_dir, 'corpus'), _args.books, malformed=_args.malformed)
+        _result = {"timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                   "python": platform.python_version(), "platform": platform.platform(),
+                   "corpus": {"books": len(_files), "bytes": sum(os.path.getsize(file) for file in _files),
+                              "seed": _args.seed, "sections": _args.sections, "depth": _args.depth,
+                              "paragraphs": _args.paragraphs, "notes": _args.notes, "images": _args.images,
+                              "image_size": _args.image_size, "authors": _args.authors,
+                              "malformed": _args.malformed, "seconds": time.perf_counter() - _start},
+                   "benchmarks": []}
+        for name in _args.only or BENCHMARKS:
+            # новый процесс для каждого замера: пиковая память не наследуется от предыдущих
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                _result["benchmarks"].append(pool.submit(_run, name, _files, _work_dir, _args.repeat).result())
+        if _args.baseline:
+            with open(_args.baseline, encoding='utf-8') as file:
+                _compare(_result, json.load(file))
+    finally:
+        if _args.work_dir is None:
+            shutil.rmtree(_work_dir, ignore_errors=True)
+
+    _json = json.dumps(_result, ensure_ascii=False, indent=2)
+    if _args.out:
+        with open(_args.out, 'w', encoding='utf-8') as file:
+            file.write(_json)
+    else:
+        print(_json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from pathlib import Path
+
+from pyFB2.FB2BlobStore import FB2BlobStore
+from pyFB2.FB2ConvertBase import FB2ConvertBase
+from pyFB2.FB2HTML import FB2HTML
+from pyFB2.FB2Parser import FB2Parser
+
+
+def _file_checksum(filename: str, buffer_size: int = 1024 * 1024) -> str:
+    """ Контрольная сумма MD5 файла """
+    _md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while _chunk := f.read(buffer_size):
+            _md5.update(_chunk)
+    return _md5.hexdigest()
+
+
+def _convert_book(task: dict) -> dict:
+    """
+    Преобразование одной книги в процессе-исполнителе.
+    Ошибки перехватываются, чтобы одна испорченная книга не останавливала обработку остальных.
+    :param task: Описание задания: source, size, out_dir, book_dir, shared_css, check_schema, blob_store,
+                 а для книг из архивов также index и member_id
+    :return: Результат: source, status ('ok' или 'failed'), out_dir, title, author, seconds, error,
+             image_bytes_written, image_bytes_saved
+    """
+    _start = time.perf_counter()
+    _result = {"source": task["source"], "status": "ok", "out_dir": None, "title": "", "author": "",
+               "size": task["size"], "seconds": 0.0, "error": None, "image_bytes_written": 0,
+               "image_bytes_saved": 0}
+    _blob_store = None if task.get("blob_store") is None else FB2BlobStore(task["blob_store"])
+    try:
+        _parser = None
+        if task.get("index") is not None:
+            from pyFB2.FB2ZipIndex import FB2ZipIndex
+            _index = FB2ZipIndex(task["index"])
+            try:
+                _parser = _index.get_parser(task["member_id"], check_schema=task["check_schema"])
+            finally:
+                _index.close()
+        _html = FB2HTML(filename=task["source"], out_dir=task["out_dir"], check_schema=task["check_schema"],
+                        shared_css=task["shared_css"], parser=_parser, blob_store=_blob_store)
+        _result["title"] = _html.parser.title or ""
+        _result["author"] = ' '.join(filter(None, [_html.parser.author_last_name(), _html.parser.author_first_name(),
+                                                   _html.parser.author_middle_name()]))
+        _code = _html.create_html(task["out_dir"], book_dir=task.get("book_dir"))
+        _result["out_dir"] = _html.out_dir
+        if _code != 0:
+            _result["status"] = "failed"
+            _result["error"] = f'create_html вернул код {_code}'
+    except Exception as err:
+        _result["status"] = "failed"
+        _result["error"] = f'{type(err).__name__}: {err}'
+    if _blob_store is not None:
+        _result["image_bytes_written"] = _blob_store.bytes_written
+        _result["image_bytes_saved"] = _blob_store.bytes_saved
+    _result["seconds"] = time.perf_counter() - _start
+    return _result
+
+
+class FB2BatchHTML:
+    """
+    Пакетное преобразование файлов FB2 в HTML.
+
+    Книги из каталога (или из индекса архивов FB2ZipIndex) преобразуются в пуле процессов.
+    Все книги используют одну копию CSS в каталоге assets, а при shared_images=True - и общее хранилище
+    изображений assets/img, в котором одинаковые изображения хранятся один раз. Книги, которые не изменились
+    с прошлого запуска (совпадает контрольная сумма источника и шаблона), пропускаются.
+    После преобразования создается общая страница библиотеки index.html.
+    """
+
+    manifest_name = 'library.json'
+    assets_dir = 'assets'
+
+    def __init__(self, out_dir: str, css: str = None, jobs: int = None, check_schema: bool = False,
+                 debug: bool = False, shared_images: bool = False):
+        """
+        Конструктор класса
+
+        :param out_dir: Каталог библиотеки HTML
+        :param css: Файл CSS, общий для всех книг
+        :param jobs: Количество процессов. По умолчанию - по числу процессоров
+        :param check_schema: Проверять файлы FB2 на соответствие схеме
+        :param debug: Выводить сообщения о каждой книге
+        :param shared_images: Хранить изображения всех книг в общем хранилище, адресуемом по содержимому
+        """
+        self.out_dir = os.path.abspath(out_dir)
+        self.css = css
+        self.jobs = jobs if jobs else os.cpu_count() or 1
+        self.check_schema = check_schema
+        self.debug = debug
+        self.shared_images = shared_images
+        self.manifest = self._load_manifest()
+
+    @property
+    def manifest_filename(self) -> str:
+        return os.path.join(self.out_dir, self.manifest_name)
+
+    def _load_manifest(self) -> dict:
+        """ Сведения о ранее преобразованных книгах: источник -> контрольные суммы, каталог, заголовок """
+        try:
+            with open(self.manifest_filename, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self):
+        with open(self.manifest_filename, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+
+    def _copy_shared_css(self) -> str:
+        """
+        Копирует CSS в общий каталог assets.
+        :return: Путь к общему файлу CSS. None - если CSS не задан
+        """
+        if self.css is None:
+            return None
+        _assets = os.path.join(self.out_dir, self.assets_dir)
+        os.makedirs(_assets, exist_ok=True)
+        _shared_css = os.path.join(_assets, os.path.basename(self.css))
+        shutil.copy2(self.css, _shared_css)
+        return _shared_css
+
+    def template_checksum(self) -> str:
+        """
+        Контрольная сумма шаблона: заголовка HTML и файла CSS.
+        При изменении шаблона все книги преобразуются заново.
+        """
+        _md5 = hashlib.md5(FB2ConvertBase.html_header.encode('utf-8'))
+        if self.css is not None:
+            _md5.update(_file_checksum(self.css).encode())
+        return _md5.hexdigest()
+
+    def _is_up_to_date(self, source: str, checksum: str, template: str) -> bool:
+        """ Книга уже преобразована из того же источника с тем же шаблоном, и результат на месте """
+        _entry = self.manifest.get(source)
+        return (_entry is not None and _entry.get("checksum") == checksum and _entry.get("template") == template
+                and _entry.get("out_dir") is not None
+                and os.path.isfile(os.path.join(_entry["out_dir"], 'index.html')))
+
+    def _dir_tasks(self, start_dir: str, recursive: bool = True):
+        """ Задания для файлов FB2 из каталога: (задание, контрольная сумма) """
+        _mask = '**/*.fb2' if recursive else '*.fb2'
+        for _item in sorted(Path(start_dir).glob(_mask)):
+            _source = str(_item.absolute())
+            yield {"source": _source, "size": _item.stat().st_size}, _file_checksum(_source)
+
+    def _index_tasks(self, index: str):
+        """ Задания для книг из индекса архивов: (задание, контрольная сумма) """
+        from pyFB2.FB2ZipIndex import FB2ZipIndex
+        _index = FB2ZipIndex(index)
+        try:
+            for member in _index.find():
+                _source = os.path.join(member["archive"], member["name"])
+                yield ({"source": _source, "size": member["file_size"], "index": os.path.abspath(index),
+                        "member_id": member["id"]}, f'{member["crc"]:08x}-{member["file_size"]}')
+        finally:
+            _index.close()
+
+    def convert_dir(self, start_dir: str, recursive: bool = True) -> dict:
+        """
+        Преобразует все файлы FB2 из каталога.
+        :param start_dir: Каталог с файлами FB2
+        :param recursive: Искать файлы в подкаталогах
+        :return: Итоги преобразования, см. convert
+        """
+        return self.convert(self._dir_tasks(start_dir, recursive))
+
+    def convert_index(self, index: str) -> dict:
+        """
+        Преобразует все книги из индекса архивов FB2ZipIndex.
+        :param index: Имя файла БД индекса
+        :return: Итоги преобразования, см. convert
+        """
+        return self.convert(self._index_tasks(index))
+
+    def convert(self, tasks) -> dict:
+        """
+        Преобразует книги в пуле процессов.
+        :param tasks: Итератор по парам (задание, контрольная сумма источника)
+        :return: Итоги: books, converted, skipped, failed, bytes, seconds, books_per_second, mb_per_second, errors,
+                 image_bytes_written, image_bytes_saved
+        """
+        _start = time.perf_counter()
+        os.makedirs(self.out_dir, exist_ok=True)
+        _shared_css = self._copy_shared_css()
+        _template = self.template_checksum()
+        _blob_store = os.path.join(self.out_dir, self.assets_dir, 'img') if self.shared_images else None
+        _summary = {"books": 0, "converted": 0, "skipped": 0, "failed": 0, "bytes": 0, "errors": [],
+                    "image_bytes_written": 0, "image_bytes_saved": 0}
+        _pending = {}
+        for task, checksum in tasks:
+            _summary["books"] += 1
+            if self._is_up_to_date(task["source"], checksum, _template):
+                _summary["skipped"] += 1
+                continue
+            task.update(out_dir=self.out_dir, shared_css=_shared_css, check_schema=self.check_schema,
+                        blob_store=_blob_store)
+            _pending[task["source"]] = (task, checksum)
+
+        self._plan_book_dirs(_pending)
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            for result in pool.map(_convert_book, [task for task, checksum in _pending.values()]):
+                if self.debug:
+                    print(f'  {result["status"]}: {result["source"]} ({result["seconds"]:.2f} с)')
+                if result["status"] != "ok":
+                    _summary["failed"] += 1
+                    _summary["errors"] += [{"source": result["source"], "error": result["error"]}]
+                    self.manifest.pop(result["source"], None)
+                    continue
+                _summary["converted"] += 1
+                _summary["bytes"] += result["size"]
+                _summary["image_bytes_written"] += result["image_bytes_written"]
+                _summary["image_bytes_saved"] += result["image_bytes_saved"]
+                self.manifest[result["source"]] = {"checksum": _pending[result["source"]][1], "template": _template,
+                                                   "out_dir": result["out_dir"], "title": result["title"],
+                                                   "author": result["author"]}
+        self._save_manifest()
+        self.write_library_index(_shared_css)
+
+        _summary["seconds"] = time.perf_counter() - _start
+        _elapsed = max(_summary["seconds"], 1e-9)
+        _summary["books_per_second"] = _summary["converted"] / _elapsed
+        _summary["mb_per_second"] = _summary["bytes"] / _elapsed / 1024 / 1024
+        return _summary
+
+    def _plan_book_dirs(self, pending: dict):
+        """
+        Назначает каталоги книгам до отправки в пул. Книга из другого источника с теми же автором и названием
+        (среди заданий или уже преобразованных книг) получает каталог с суффиксом: именем файла источника,
+        а если и он занят - контрольной суммой. Иначе процессы записывали бы книги в один каталог.
+        :param pending: Задания: источник -> (задание, контрольная сумма)
+        """
+        # каталоги сравниваются без учета регистра: файловая система может его не различать
+        _taken = {_entry["out_dir"].casefold(): source for source, _entry in self.manifest.items()
+                  if source not in pending and _entry.get("out_dir")}
+        _indexes = {}
+        try:
+            for source, (task, checksum) in pending.items():
+                try:
+                    _book_dir = os.path.join(self.out_dir, FB2HTML.book_path(self._read_metadata(task, _indexes)))
+                except Exception:
+                    # испорченную книгу не преобразует и процесс-исполнитель, ошибку сообщит он
+                    continue
+                _candidates = itertools.chain(
+                    [_book_dir, f'{_book_dir} ({Path(source).stem})', f'{_book_dir} ({checksum})'],
+                    (f'{_book_dir} ({checksum}-{number})' for number in itertools.count(2)))
+                _book_dir = next(candidate for candidate in _candidates
+                                 if _taken.get(candidate.casefold(), source) == source)
+                _taken[_book_dir.casefold()] = source
+                task["book_dir"] = _book_dir
+        finally:
+            for _index in _indexes.values():
+                _index.close()
+
+    @staticmethod
+    def _read_metadata(task: dict, indexes: dict) -> FB2Parser:
+        """ Метаданные книги задания. Открытые индексы архивов запоминаются в indexes """
+        if task.get("index") is None:
+            return FB2Parser(filename=task["source"], metadata_only=True)
+        _index = indexes.get(task["index"])
+        if _index is None:
+            from pyFB2.FB2ZipIndex import FB2ZipIndex
+            _index = indexes[task["index"]] = FB2ZipIndex(task["index"])
+        return FB2Parser(filename=task["source"], metadata_only=True, stream=_index.open(task["member_id"]))
+
+    def write_library_index(self, shared_css: str = None):
+        """
+        Записывает общую страницу библиотеки: книги, сгруппированные по авторам.
+        """
+        _header = FB2ConvertBase.html_header.replace('$title$', 'Библиотека')
+        _css = '' if shared_css is None else os.path.relpath(shared_css, self.out_dir).replace(os.sep, '/')
+        _header = _header.replace('$CSS$', _css)
+        _authors = {}
+        for _entry in self.manifest.values():
+            _authors.setdefault(_entry["author"], []).append(_entry)
+        with open(os.path.join(self.out_dir, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write(_header)
+            f.write('<body>\n<h1>Библиотека</h1>\n')
+            for _author in sorted(_authors):
+                f.write(f'<h2 class="author">{escape(_author)}</h2>\n<ul>\n')
+                for _entry in sorted(_authors[_author], key=lambda entry: entry["title"]):
+                    _href = os.path.relpath(os.path.join(_entry["out_dir"], 'index.html'), self.out_dir)
+                    f.write(f'<li><a href="{escape(_href.replace(os.sep, "/"))}">{escape(_entry["title"])}</a></li>\n')
+                f.write('</ul>\n')
+            f.write('</body></html>\n')
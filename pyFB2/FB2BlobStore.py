@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class FB2BlobStore:
+    """
+    Хранилище бинарных данных (изображений), адресуемых по содержимому.
+
+    Каждый бинарник хранится один раз под именем, равным его хэшу, в подкаталогах по первым символам хэша:
+    root/ab/cd/abcd....jpg. Одинаковые обложки и логотипы издательств из разных книг занимают место на диске
+    один раз. В каталоги книг бинарники попадают жесткими ссылками, если это возможно.
+    """
+
+    def __init__(self, root: str, algorithm: str = 'sha256'):
+        """
+        Конструктор класса
+        :param root: Каталог хранилища
+        :param algorithm: Алгоритм хэширования из hashlib
+        """
+        self.root = os.path.abspath(root)
+        self.algorithm = algorithm
+        self.puts = 0           # количество записанных бинарников
+        self.duplicates = 0     # количество бинарников, которые уже были в хранилище
+        self.bytes_written = 0  # объем записанных данных
+        self.bytes_saved = 0    # объем данных, которые не пришлось записывать
+        os.makedirs(self.root, exist_ok=True)
+
+    def digest(self, data: bytes) -> str:
+        """ Хэш данных """
+        return hashlib.new(self.algorithm, data).hexdigest()
+
+    def path(self, digest: str, ext: str = '') -> str:
+        """
+        Путь к бинарнику в хранилище.
+        :param digest: Хэш бинарника
+        :param ext: Расширение файла, например .jpg
+        """
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + ext)
+
+    def put(self, data: bytes, ext: str = '') -> str:
+        """
+        Записывает бинарник в хранилище, если его там еще нет.
+        Запись атомарна, поэтому хранилище можно использовать из нескольких процессов.
+        :param data: Бинарные данные
+        :param ext: Расширение файла, например .jpg
+        :return: Хэш бинарника
+        """
+        _digest = self.digest(data)
+        _path = self.path(_digest, ext)
+        if os.path.exists(_path):
+            self.duplicates += 1
+            self.bytes_saved += len(data)
+            return _digest
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        _fd, _tmp = tempfile.mkstemp(dir=os.path.dirname(_path), suffix='.tmp')
+        try:
+            with os.fdopen(_fd, 'wb') as f:
+                f.write(data)
+            os.chmod(_tmp, 0o644)  # mkstemp создает файл, доступный только владельцу
+            os.replace(_tmp, _path)
+        except BaseException:
+            if os.path.exists(_tmp):
+                os.unlink(_tmp)
+            raise
+        self.puts += 1
+        self.bytes_written += len(data)
+        return _digest
+
+    def link(self, digest: str, ext: str, target: str) -> str:
+        """
+        Создает в каталоге книги жесткую ссылку на бинарник. Если жесткая ссылка невозможна
+        (например, другой диск), то бинарник копируется.
+        :param digest: Хэш бинарника
+        :param ext: Расширение файла в хранилище
+        :param target: Путь к файлу в каталоге книги
+        :return: Путь к файлу в каталоге книги
+        """
+        _path = self.path(digest, ext)
+        if os.path.exists(target):
+            if os.path.samefile(_path, target):
+                return target
+            os.unlink(target)
+        try:
+            os.link(_path, target)
+        except OSError:
+            shutil.copyfile(_path, target)
+        return target
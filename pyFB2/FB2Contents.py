@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import json
+from html import escape
+
+
+class FB2Contents:
+    """
+    Содержание книги в виде дерева в памяти.
+
+    Узлы добавляются по мере записи глав (add) или загружаются из БД Hyst одним запросом (from_hyst_db).
+    Содержание выводится в HTML, JSON или в виде документа навигации EPUB 3 (nav.xhtml) за один проход.
+    """
+
+    def __init__(self, root_id: int = 0):
+        """
+        Конструктор класса
+        :param root_id: Идентификатор узла, дочерние узлы которого составляют верхний уровень содержания
+        """
+        self.root_id = root_id
+        self._nodes: dict[int, dict] = {}  # идентификатор узла -> узел
+        self._children: dict[int, list] = {}  # идентификатор родителя -> список дочерних узлов
+
+    def add(self, note_id: int, parent_id: int, name: str, href: str = None, length: int = 0) -> dict:
+        """
+        Добавляет узел в содержание.
+        :param note_id: Идентификатор узла
+        :param parent_id: Идентификатор родительского узла. 0 - корень содержания
+        :param name: Заголовок
+        :param href: Ссылка на главу. None - если у узла нет своего текста
+        :param length: Размер текста главы
+        :return: Узел содержания
+        """
+        _node = {"id": note_id, "parent_id": parent_id, "name": name, "href": href, "length": length}
+        self._nodes[note_id] = _node
+        self._children.setdefault(parent_id, []).append(_node)
+        return _node
+
+    def get(self, note_id: int) -> dict:
+        """ Узел содержания. None - если узла нет """
+        return self._nodes.get(note_id)
+
+    def children(self, parent_id: int) -> list:
+        """ Дочерние узлы в порядке добавления """
+        return self._children.get(parent_id, [])
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @classmethod
+    def from_hyst_db(cls, hyst_db, root_id: int = 0, href: str = None) -> 'FB2Contents':
+        """
+        Загружает содержание из БД Hyst одним рекурсивным запросом (HystDB.iter_subtree).
+        :param hyst_db: БД Hyst (HystDB)
+        :param root_id: Идентификатор узла, потомки которого попадут в содержание. 0 - все записи
+        :param href: Шаблон ссылки на главу, например 'html/ch_{id:04}.html'. None - ссылки не формируются
+        :return: Содержание
+        """
+        _contents = cls(root_id)
+        for note in hyst_db.iter_subtree(root_id):
+            _href = href.format(id=note["id"]) if href is not None and note["length"] > 0 else None
+            _contents.add(note["id"], note["parent_id"], note["name"], _href, note["length"])
+        return _contents
+
+    def _walk(self, parent_id: int):
+        """
+        Обход дерева в прямом порядке без рекурсии.
+        :return: Итератор по парам (событие, узел): ('node', узел), ('open', None) и ('close', None)
+                 для начала и конца списка дочерних узлов
+        """
+        _stack = [iter(self.children(self.root_id if parent_id is None else parent_id))]
+        yield 'open', None
+        while _stack:
+            _node = next(_stack[-1], None)
+            if _node is None:
+                _stack.pop()
+                yield 'close', None
+                continue
+            yield 'node', _node
+            if _node["id"] in self._children:
+                _stack.append(iter(self._children[_node["id"]]))
+                yield 'open', None
+
+    def to_html(self, parent_id: int = None, tag: str = 'ul') -> str:
+        """
+        Содержание в виде вложенных списков HTML.
+        :param parent_id: Идентификатор узла, с которого начинается вывод. По умолчанию - корень содержания
+        :param tag: Тэг списка: ul или ol
+        """
+        _parts = []
+        _after_node = False  # после элемента li, который еще не закрыт
+        for event, node in self._walk(parent_id):
+            if event == 'open':
+                _parts.append(f'\n<{tag}>')
+                _after_node = False
+            elif event == 'close':
+                if _after_node:
+                    _parts.append('</li>')
+                _parts.append(f'\n</{tag}>')
+                # список вложен в элемент li родителя, закрываем его
+                _after_node = True
+            else:
+                if _after_node:
+                    _parts.append('</li>')
+                _name = escape(node["name"] or '')
+                if node["href"]:
+                    _parts.append(f'\n<li><a href="{escape(node["href"])}">{_name}</a>')
+                else:
+                    _parts.append(f'\n<li>{_name}')
+                _after_node = True
+        # последний close закрыл корневой список, лишний </li> не нужен
+        return ''.join(_parts)
+
+    def to_list(self, parent_id: int = None) -> list:
+        """
+        Содержание в виде вложенных списков словарей {id, name, href, children}.
+        """
+        _root = []
+        _stack = [_root]
+        for event, node in self._walk(parent_id):
+            if event == 'node':
+                _item = {"id": node["id"], "name": node["name"], "href": node["href"], "children": []}
+                _stack[-1].append(_item)
+            elif event == 'open' and _stack[-1]:
+                _stack.append(_stack[-1][-1]["children"])
+            elif event == 'close' and len(_stack) > 1:
+                _stack.pop()
+        return _root
+
+    def to_json(self, parent_id: int = None) -> str:
+        """ Содержание в формате JSON """
+        return json.dumps(self.to_list(parent_id), ensure_ascii=False)
+
+    def to_nav_xhtml(self, title: str, parent_id: int = None, lang: str = 'ru') -> str:
+        """
+        Содержание в виде документа навигации EPUB 3 (nav.xhtml).
+        Узлы без собственной главы ссылаются на первую главу среди своих потомков.
+        :param title: Заголовок документа
+        :param parent_id: Идентификатор узла, с которого начинается вывод. По умолчанию - корень содержания
+        :param lang: Язык документа
+        """
+        _parts = ['<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n',
+                  f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+                  f'xml:lang="{lang}" lang="{lang}">\n<head><title>{escape(title)}</title></head>\n<body>\n',
+                  f'<nav epub:type="toc" id="toc"><h1>{escape(title)}</h1>']
+        _after_node = False
+        for event, node in self._walk(parent_id):
+            if event == 'open':
+                _parts.append('\n<ol>')
+                _after_node = False
+            elif event == 'close':
+                if _after_node:
+                    _parts.append('</li>')
+                _parts.append('\n</ol>')
+                _after_node = True
+            else:
+                if _after_node:
+                    _parts.append('</li>')
+                _href = node["href"] or self._first_href(node["id"])
+                _name = escape(node["name"] or '')
+                _parts.append(f'\n<li><a href="{escape(_href)}">{_name}</a>' if _href else f'\n<li><span>{_name}</span>')
+                _after_node = True
+        _parts.append('\n</nav>\n</body>\n</html>\n')
+        return ''.join(_parts)
+
+    def _first_href(self, parent_id: int) -> str:
+        """ Ссылка на первую главу среди потомков узла """
+        for event, node in self._walk(parent_id):
+            if event == 'node' and node["href"]:
+                return node["href"]
+        return None
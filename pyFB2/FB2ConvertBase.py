@@ -2,14 +2,78 @@
 import base64
 import posixpath
 import sqlite3
+import struct
 from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from html import escape
 from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 
+from pyFB2.FB2BlobStore import FB2BlobStore
+from pyFB2.FB2HTMLEmitter import FB2HTMLEmitter, XLINK_HREF
 from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Stats import add_counter, stage
+from pyFB2.FB2Types import ImageRef, OutlineItem
 from pyFB2.HystDB import HystDB
 
 
+def get_image_size(data: bytes) -> tuple[int, int]:
+    """
+    Определяет размеры изображения PNG, GIF или JPEG по его заголовку.
+    :param data: Изображение
+    :return: Ширина и высота в пикселях. (0, 0) - если формат не распознан
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>2L', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack('<2H', data[6:10])
+    if data[:2] == b'\xff\xd8':
+        # перебираем сегменты JPEG до маркера SOFn, в котором лежат размеры
+        _offset = 2
+        while _offset + 9 <= len(data):
+            if data[_offset] != 0xFF:
+                _offset += 1
+                continue
+            _marker = data[_offset + 1]
+            if _marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                _height, _width = struct.unpack('>2H', data[_offset + 5:_offset + 9])
+                return _width, _height
+            if _marker in (0xD8, 0x01) or 0xD0 <= _marker <= 0xD7:
+                _offset += 2
+                continue
+            _offset += 2 + struct.unpack('>H', data[_offset + 2:_offset + 4])[0]
+    return 0, 0
+
+
+# Элементы начала секции, которые остаются на странице вместе со следующим блоком
+PAGE_HEADING_TAGS = frozenset(['title', 'epigraph', 'image', 'annotation'])
+
+# Состояние процесса-исполнителя при параллельной отрисовке глав: заголовок HTML и преобразователь
+_worker_header = None
+_worker_emitter = None
+
+
+def _init_render_worker(header: str, images: dict, links: dict, notes: dict = None, image_path: str = '../img/',
+                        xhtml: bool = False):
+    """ Инициализация процесса-исполнителя: словари ссылок передаются один раз, а не с каждой главой """
+    global _worker_header, _worker_emitter
+    _worker_header = header
+    _worker_emitter = FB2HTMLEmitter(images=images, links=links, image_path=image_path, xhtml=xhtml, notes=notes)
+
+
+def _render_worker(task: tuple) -> str:
+    """
+    Отрисовка одной главы в процессе-исполнителе.
+    :param task: Кортеж (секция в виде XML, уровень, заголовок, навигация по страницам, только тело секции)
+    """
+    xml, level, title, nav, fragment = task
+    _parts = [] if fragment else [_worker_header.replace('$title$', escape(title)), '<body>', nav]
+    _worker_emitter.emit(ElementTree.fromstring(xml), _parts.append, level)
+    if not fragment:
+        _parts += [nav, '</body></html>']
+    return ''.join(_parts)
+
+
 class FB2ConvertBase:
     html_header: str = '<html xml:lang = "ru-ru" lang = "ru-ru">\n' \
                        '  <head>\n' \
@@ -18,18 +82,54 @@ class FB2ConvertBase:
                        '     <title>$title$</title >\n' \
                        '  </head>\n'
 
-    def __init__(self, filename: str, css: str = None):
+    # Использовать in-memory БД Hyst для промежуточного хранения глав
+    use_hyst_db: bool = True
+
+    def __init__(self, filename: str, css: str = None, jobs: int = 1, executor: str = 'process',
+                 check_schema: bool = True, parser: FB2Parser = None, blob_store: FB2BlobStore = None,
+                 link_images: bool = True, inline_notes: bool = False, page_size: int = 0,
+                 page_paragraphs: int = 0):
         """
         Конструктор класса
-        :param filename: Файл Fb2
+        :param filename: Файл Fb2. None - книга будет задана позже
         :param css: Файл CSS
+        :param jobs: Количество параллельно отрисовываемых глав. 1 - отрисовка в текущем потоке
+        :param executor: Пул для параллельной отрисовки: 'process' или 'thread'
+        :param check_schema: Проверять файл FB2 на соответствие схеме
+        :param parser: Готовый парсер, например для книги из архива. Если передан, то файл filename не читается
+        :param blob_store: Общее хранилище изображений. Если передано, то изображения записываются в него
+        :param link_images: При использовании хранилища создавать в каталоге книги жесткие ссылки на изображения.
+                            Если False, то книга ссылается прямо на файлы хранилища
+        :param inline_notes: Выводить текст сносок рядом со ссылкой на них (всплывающие сноски)
+        :param page_size: Примерный размер страницы в байтах. Главы большего размера разбиваются на страницы.
+                          0 - не разбивать
+        :param page_paragraphs: Количество абзацев на странице. 0 - не ограничивать
         """
-        self.parser = FB2Parser(filename=filename, check_schema=True)  # наличие файла не проверяем, это сделает парсер
-        self.hyst_db = HystDB()  # имя БД не передаем, все делаем в памяти
+        # наличие файла не проверяем, это сделает парсер.
+        # Если не передан ни парсер, ни файл, то парсер создается позже, например при добавлении книги в БД
+        if parser is None and filename is not None:
+            parser = FB2Parser(filename=filename, check_schema=check_schema)
+        self.parser = parser
+        self.hyst_db = HystDB() if self.use_hyst_db else None  # имя БД не передаем, все делаем в памяти
+        self.emitter = FB2HTMLEmitter()
+        self.blob_store = blob_store
+        self.link_images = link_images
+        self.inline_notes = inline_notes
+        self.page_size = page_size
+        self.page_paragraphs = page_paragraphs
+        self._pages: dict[Element, list[Element]] = {}  # секция -> страницы
+        self._page_ids: dict[Element, int] = {}  # секция -> идентификатор главы с первой страницей
+        self.images: dict[str, ImageRef] = {}  # идентификатор бинарника -> сведения о сохраненном изображении
         self.css = css
+        self.jobs = jobs
+        self.executor = executor
+        self.chapter_css = ''  # ссылка на CSS из файла главы
         self.level = 0
         self.counter = 0
         self.root_id = 0
+        self._planned_id = 0  # идентификатор последней главы при построении индекса ссылок
+        self._note_titles: dict[int, str] = {}  # идентификатор раздела с подсекциями -> заголовок
+        self._open_notes: dict[int, None] = {}  # статьи, документ которых еще не закрыт (см. close_parent_notes)
 
     @staticmethod
     def remove_restricted_chars(value: str) -> str:
@@ -60,17 +160,145 @@ class FB2ConvertBase:
         :return: Список сохраненных файлов.
         """
         result = []
-        images = self.parser.get_binaries()
-        for image in images:
-            image_id = image.attrib["id"]  # это имя файла, например cover.jpg
-            content_type = image.attrib["content-type"]  # сейчас не используется, содержит типа такого image/jpeg
-            bin_data = base64.b64decode(image.text)  # перекодируем из BASE64 в бинарный формат
+        for image_id, content_type, bin_data in self.decode_binaries():
             file_name = posixpath.join(path, image_id)  # формируем имя файла
-            with open(file_name, 'w+b') as file:  # открываем бинарный (b) файл для записи (w)
-                file.write(bin_data)
-                result += [file_name]
+            _digest = ''
+            if self.blob_store is None:
+                with stage('convert.write'), open(file_name, 'w+b') as file:  # бинарный (b) файл для записи (w)
+                    file.write(bin_data)
+            else:
+                # одинаковые изображения разных книг хранятся один раз
+                _ext = posixpath.splitext(image_id)[1]
+                _digest = self.blob_store.put(bin_data, _ext)
+                if self.link_images:
+                    self.blob_store.link(_digest, _ext, file_name)
+                else:
+                    file_name = self.blob_store.path(_digest, _ext)
+            result += [file_name]
+            self.register_image(image_id, content_type, bin_data, path=file_name, digest=_digest)
         return result
 
+    def decode_binaries(self):
+        """
+        Перебирает бинарники книги, перекодируя их из BASE64 в бинарный формат.
+        :return: Кортежи (идентификатор бинарника, тип MIME, данные)
+        """
+        for image in self.parser.get_binaries():
+            # идентификатор - это имя файла, например cover.jpg, тип содержит что-то вроде image/jpeg
+            with stage('convert.base64'):
+                _data = base64.b64decode(image.text or '')
+            add_counter('convert.binary_bytes', len(_data))
+            yield image.attrib["id"], image.attrib.get("content-type", ""), _data
+
+    def register_image(self, binary_id: str, content_type: str, data: bytes, stored_id: int = None,
+                       path: str = None, digest: str = '') -> ImageRef:
+        """
+        Добавляет изображение в индекс изображений книги. Индекс строится один раз при загрузке бинарников,
+        затем ссылки на изображения в секциях заменяются поиском в словаре.
+        Если изображение уже есть в индексе, то сведения объединяются.
+        :param binary_id: Идентификатор бинарника в FB2
+        :param content_type: Тип MIME
+        :param data: Изображение
+        :param stored_id: Идентификатор изображения в таблице NOTE_IMAGE
+        :param path: Путь к файлу изображения на диске
+        :param digest: Хэш изображения в хранилище
+        :return: Сведения об изображении
+        """
+        _ref = self.images.get(binary_id)
+        if _ref is None:
+            _ref = ImageRef(binary_id, stored_id, path, content_type, *get_image_size(data), digest)
+        else:
+            _ref = _ref._replace(stored_id=_ref.stored_id if stored_id is None else stored_id,
+                                 path=_ref.path if path is None else path, digest=digest or _ref.digest)
+        self.images[binary_id] = _ref
+        self.emitter.images[binary_id] = self.image_src(_ref)
+        return _ref
+
+    def image_src(self, image: ImageRef) -> str:
+        """
+        Возвращает ссылку на изображение для атрибута src.
+        Изображение, записанное в БД, адресуется по его идентификатору в таблице NOTE_IMAGE.
+        """
+        if image.stored_id is not None:
+            return f'db://thisdb.note_image.image.{image.stored_id}'
+        return f'../img/{image.binary_id}'
+
+    def note_href(self, note_id: int, anchor: str = '') -> str:
+        """
+        Возвращает ссылку на якорь в главе. Глава в БД адресуется по ее идентификатору
+        в таблице NOTE, так же как изображение в таблице NOTE_IMAGE.
+        :param note_id: Идентификатор главы
+        :param anchor: Якорь (значение атрибута id). Пустая строка - ссылка на начало главы
+        """
+        return f'db://thisdb.note.text.{note_id}' + (f'#{anchor}' if anchor else '')
+
+    def build_link_index(self, root_id: int) -> int:
+        """
+        Строит индекс внутренних ссылок: для каждого атрибута id книги определяется глава, в которую
+        он попадет, и ссылка #id заменяется ссылкой на якорь в этой главе (словарь emitter.links).
+        Книга перебирается в том же порядке, в котором вставляются главы, поэтому идентификаторы глав
+        известны заранее: главы получают идентификаторы подряд после корневого узла.
+        При inline_notes также запоминается текст сносок для всплывающих примечаний.
+        :param root_id: Идентификатор корневого узла книги
+        :return: Количество ссылок в индексе
+        """
+        self._planned_id = root_id
+        for body in self.parser.bodies:
+            if self.parser.is_body_notes(body):
+                _sections = self.parser.get_sections(body)
+                if self.get_titles_str(body) == '' and len(_sections) <= 3:
+                    for section in _sections:
+                        self._index_element(section, self._next_planned_id(), [], notes=True)
+                else:
+                    _note_id = self._next_planned_id()
+                    for section in _sections:
+                        self._index_element(section, _note_id, [], notes=True)
+            else:
+                self._index_sections(body, root_id, [])
+        return len(self.emitter.links)
+
+    def _next_planned_id(self) -> int:
+        self._planned_id += 1
+        return self._planned_id
+
+    def _index_sections(self, section: Element, parent_id: int, pending: list):
+        """
+        Индексирует идентификаторы секций в порядке insert_child_sections.
+        Секция с подсекциями не имеет своего текста, поэтому ссылки на нее (pending)
+        ведут в первую главу с текстом.
+        """
+        for child in self.parser.get_sections(section):
+            if self.parser.is_flat_section(child):
+                if self.parser.is_section_wo_title(child):
+                    self._index_element(child, parent_id, pending)
+                    continue
+                # каждая страница главы - отдельная запись
+                self._page_ids[child] = self._planned_id + 1
+                for page in self.paginate(child):
+                    self._index_element(page, self._next_planned_id(), pending)
+            else:
+                _note_id = self._next_planned_id()
+                if child.get('id'):
+                    pending.append(child.get('id'))
+                for element in child:
+                    if element.tag != 'section':
+                        pending.extend(item.get('id') for item in element.iter() if item.get('id'))
+                self._index_sections(child, _note_id, pending)
+
+    def _index_element(self, element: Element, note_id: int, pending: list, notes: bool = False):
+        """ Индексирует все идентификаторы элемента и его потомков, а также отложенные идентификаторы """
+        _links = self.emitter.links
+        for anchor in pending:
+            _links['#' + anchor] = self.note_href(note_id, anchor)
+        pending.clear()
+        for item in element.iter():
+            _anchor = item.get('id')
+            if _anchor:
+                _links['#' + _anchor] = self.note_href(note_id, _anchor)
+        if notes and self.inline_notes and element.get('id'):
+            _text = ' '.join(text for child in element if child.tag != 'title' for text in child.itertext())
+            self.emitter.notes['#' + element.get('id')] = ' '.join(_text.split())
+
     def write_html(self, path: str):
         """
         Записывает все заметки из БД Hyst как HTML файлы.
@@ -84,13 +312,10 @@ class FB2ConvertBase:
         """
         Запись картинок в БД
         """
-        images = self.parser.get_binaries()
-        for image in images:
-            image_id = image.attrib["id"]  # это имя файла, например cover.jpg
-            content_type = image.attrib["content-type"]  # сейчас не используется
-            _bin_data = base64.b64decode(image.text)  # перекодируем из BASE64 в бинарный формат
+        for image_id, content_type, _bin_data in self.decode_binaries():
             # имя файла ПОКА помещаем в поле short_descr
             last_id = self.insert_image(short_descr=image_id, image=_bin_data)
+            self.register_image(image_id, content_type, _bin_data, stored_id=last_id)
 
     def insert_notebook(self, name: str, short_descr: str = '') -> int:
         """
@@ -121,99 +346,289 @@ class FB2ConvertBase:
 
     def replace_img_links(self, section: Element):
         """
-        Заменяет в указанной секции ссылки на бинарные данные на ссылки на файлы на диске
-        :TODO: Надо литерал {http://www.w3.org/1999/xlink} заменить на значение из заголовка
+        Заменяет в указанной секции ссылки на бинарные данные на ссылки из индекса изображений.
+        Изображения, которых нет в индексе, ссылаются на файлы в каталоге img.
         """
-        src = ''
-        _images = section.findall('./image') + section.findall('./*/image') + section.findall('./**/image')
-        for image in _images:
+        for image in section.iter('image'):
+            image_name = image.attrib.pop(XLINK_HREF, '').lstrip('#')
+            _ref = self.images.get(image_name)
             image.tag = 'img'
-            image_name = image.attrib['{http://www.w3.org/1999/xlink}href'].replace('#', '')
-            src = '../img/{0}'.format(image.attrib['{http://www.w3.org/1999/xlink}href'].replace('#', ''))
-
-            _cursor = self.hyst_db.connection.cursor()
-
-            sql = 'select id from note_image where book_id=? and ShortDescr=?'
-            for row in _cursor.execute(sql, [self.root_id, image_name]):
-                src = f'db://thisdb.note_image.image.{row[0]}'
-            _cursor.close()
+            image.set('src', f'../img/{image_name}' if _ref is None else self.emitter.images[image_name])
+            if _ref is not None and _ref.width:
+                image.set('width', str(_ref.width))
+                image.set('height', str(_ref.height))
 
-            del image.attrib['{http://www.w3.org/1999/xlink}href']
-            if src > '':
-                image.set('src', src)
+    def insert_body_sections(self, body: Element, parent: int, notebook_id: int):
+        """
+        Вставляет секции тела книги. Если задано больше одного параллельного задания,
+        то главы отрисовываются параллельно.
+        """
+        if self.jobs > 1:
+            self.insert_sections_parallel(body, parent, notebook_id)
+        else:
+            self.insert_child_sections(body, parent, notebook_id)
 
     def insert_child_sections(self, section, parent: int, notebook_id: int):
         """ Вставляет заголовки и главы в in-memory БД """
         sections = self.parser.get_sections(section)
         for section in sections:
-            self.replace_img_links(section=section)
             self.level += 1
             title = self.get_titles_str(section)
-            xml_str = ElementTree.tostring(section)
-            xml_str = self.replace_fb2_html(str(xml_str.decode('utf-8')), self.level, title)
             if self.parser.is_flat_section(section):
                 self.counter += 1
+                self.replace_img_links(section=section)
                 if self.parser.is_section_wo_title(section):
-                    self.update_parent_note(parent, xml_str)
+                    self.update_parent_note(parent, self.render_fragment(section, self.level))
                 else:
-                    parent_id = self.insert_note(title, parent, xml_str, notebook_id)
+                    self.insert_pages(title, parent, [self.render_section(page, self.level, page_title, nav)
+                                                      for page, page_title, nav in self.section_pages(section, title)],
+                                      notebook_id)
             else:
                 parent_id = self.insert_note(title, parent, '', notebook_id)
+                self._note_titles[parent_id] = title
                 self.insert_child_sections(section, parent_id, notebook_id)  # рекурсивный вызов самой себя
             self.level -= 1
 
+    def build_outline(self, section: Element, parent: int = -1, outline: list = None) -> list[OutlineItem]:
+        """
+        Строит оглавление: перебирает секции в том же порядке, что и insert_child_sections,
+        и вычисляет для каждой секции уровень и порядковый номер.
+        :param section: Секция или тело книги, с которого начинается обход
+        :param parent: Номер родительского элемента в оглавлении
+        :param outline: Список, в который добавляются элементы оглавления
+        :return: Оглавление
+        """
+        if outline is None:
+            outline = []
+        for child in self.parser.get_sections(section):
+            self.level += 1
+            _flat = self.parser.is_flat_section(child)
+            if _flat:
+                self.counter += 1
+            _item = OutlineItem(index=len(outline), parent=parent, section_id=child.get('id', ''), level=self.level,
+                                seq_no=self.counter, title=self.get_titles_str(child), flat=_flat,
+                                untitled=self.parser.is_section_wo_title(child), section=child)
+            outline.append(_item)
+            if not _flat:
+                self.build_outline(child, _item.index, outline)
+            self.level -= 1
+        return outline
+
+    def render_outline(self, outline: list[OutlineItem]):
+        """
+        Отрисовывает главы оглавления в пуле процессов или потоков.
+        Результаты возвращаются в порядке оглавления по мере готовности.
+        :param outline: Оглавление
+        :return: Итератор по документам HTML для глав без подсекций (для глав из нескольких страниц - по документу
+                 на страницу). Для секций без заголовка возвращается только HTML тела секции
+        """
+        _leaves = [item for item in outline if item.flat]
+        for item in _leaves:
+            self.replace_img_links(section=item.section)
+        # главы, разбитые на страницы, отрисовываются постранично
+        _pages = [(page, item.level, page_title, nav, item.untitled) for item in _leaves
+                  for page, page_title, nav in self.section_pages(item.section, item.title)]
+        _chunksize = max(1, len(_pages) // (self.jobs * 4))
+        if self.executor == 'thread':
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                yield from pool.map(lambda page: self.render_fragment(page[0], page[1]) if page[4]
+                                    else self.render_section(*page[:4]), _pages)
+        else:
+            _tasks = ((ElementTree.tostring(page), level, title, nav, fragment)
+                      for page, level, title, nav, fragment in _pages)
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_render_worker,
+                                     initargs=(self.chapter_header(), self.emitter.images, self.emitter.links,
+                                               self.emitter.notes, self.emitter.image_path,
+                                               self.emitter.xhtml)) as pool:
+                yield from pool.map(_render_worker, _tasks, chunksize=_chunksize)
+
+    def insert_sections_parallel(self, body: Element, parent: int, notebook_id: int):
+        """
+        Вставляет секции тела книги, отрисовывая главы параллельно.
+        Сначала строится оглавление, затем главы отрисовываются в пуле, а вставка выполняется
+        в порядке оглавления, поэтому нумерация глав совпадает с последовательной отрисовкой.
+        """
+        _outline = self.build_outline(body)
+        _rendered = self.render_outline(_outline)
+        _note_ids = {-1: parent}
+        for item in _outline:
+            self.counter = item.seq_no
+            if item.flat:
+                if item.untitled:
+                    self.update_parent_note(_note_ids[item.parent], next(_rendered))
+                else:
+                    _pages = [next(_rendered) for _ in self.paginate(item.section)]
+                    _note_ids[item.index] = self.insert_pages(item.title, _note_ids[item.parent], _pages, notebook_id)
+            else:
+                _note_ids[item.index] = self.insert_note(item.title, _note_ids[item.parent], '', notebook_id)
+                self._note_titles[_note_ids[item.index]] = item.title
+
+    def paginate(self, section: Element) -> list[Element]:
+        """
+        Разбивает секцию на страницы размером не более page_size байт (оценка по тексту)
+        и не более page_paragraphs абзацев. Разбиение выполняется только по границам блоков
+        (абзацев, стихов, цитат), заголовок и эпиграфы остаются на первой странице.
+        Результат запоминается, поэтому индекс ссылок и отрисовка видят одно и то же разбиение.
+        :param section: Секция без подсекций
+        :return: Страницы в виде секций. Если разбиение не нужно - список из самой секции
+        """
+        _pages = self._pages.get(section)
+        if _pages is not None:
+            return _pages
+        _pages = [section]
+        if self.page_size > 0 or self.page_paragraphs > 0:
+            _blocks = [[]]
+            _size = 0
+            _paragraphs = 0
+            for child in section:
+                _child_size = self._estimate_size(child)
+                # заголовок, эпиграф и иллюстрация не отрываются от начала страницы
+                _heading = child.tag in PAGE_HEADING_TAGS
+                if _blocks[-1] and not _heading and (
+                        (self.page_size > 0 and _size + _child_size > self.page_size) or
+                        (self.page_paragraphs > 0 and _paragraphs >= self.page_paragraphs)):
+                    _blocks.append([])
+                    _size = 0
+                    _paragraphs = 0
+                _blocks[-1].append(child)
+                _size += _child_size
+                _paragraphs += 0 if _heading else 1
+            if len(_blocks) > 1:
+                _pages = []
+                for index, block in enumerate(_blocks):
+                    # атрибуты (в том числе id) переносятся только на первую страницу
+                    _page = Element(section.tag, section.attrib if index == 0 else {})
+                    _page.text = section.text if index == 0 else None
+                    _page.extend(block)
+                    _pages.append(_page)
+        self._pages[section] = _pages
+        return _pages
+
+    @staticmethod
+    def _estimate_size(element: Element) -> int:
+        """ Оценка размера HTML элемента в байтах: кириллица в UTF-8 занимает 2 байта, плюс разметка """
+        return sum(2 * len(text) for text in element.itertext()) + 16 * sum(1 for _ in element.iter())
+
+    def section_pages(self, section: Element, title: str) -> list[tuple]:
+        """
+        Страницы главы с заголовками и навигацией.
+        Первая страница получает заголовок главы, остальные - заголовок с номером страницы.
+        :return: Список кортежей (страница, заголовок, HTML навигации по страницам)
+        """
+        _pages = [section] if self.parser.is_section_wo_title(section) else self.paginate(section)
+        if len(_pages) == 1:
+            return [(section, title, '')]
+        _first_id = self._page_ids.get(section)
+        return [(page, title if index == 0 else f'{title} ({index + 1})',
+                 self.page_nav(_first_id, index, len(_pages))) for index, page in enumerate(_pages)]
+
+    def page_nav(self, first_id: int, index: int, count: int) -> str:
+        """
+        HTML навигации между страницами главы.
+        :param first_id: Идентификатор записи первой страницы. None - если он неизвестен, тогда ссылок нет
+        :param index: Номер страницы, начиная с 0
+        :param count: Количество страниц
+        """
+        _parts = ['<div class="page-nav">']
+        if first_id is not None and index > 0:
+            _parts.append(f'<a class="prev" href="{escape(self.note_href(first_id + index - 1))}">&lt;</a> ')
+        _parts.append(f'{index + 1} / {count}')
+        if first_id is not None and index < count - 1:
+            _parts.append(f' <a class="next" href="{escape(self.note_href(first_id + index + 1))}">&gt;</a>')
+        _parts.append('</div>')
+        return ''.join(_parts)
+
+    def insert_pages(self, title: str, parent_id: int, pages: list[str], notebook_id: int) -> int:
+        """
+        Вставляет главу, разбитую на страницы. Первая страница - запись главы,
+        остальные страницы вставляются подряд как ее дочерние записи и попадают в содержание.
+        :param pages: Документы HTML страниц
+        :return: Идентификатор записи главы (первой страницы)
+        """
+        _note_id = self.insert_note(title, parent_id, pages[0], notebook_id)
+        for index, page in enumerate(pages[1:], start=2):
+            self.insert_note(f'{title} ({index})', _note_id, page, notebook_id)
+        return _note_id
+
     def update_parent_note(self, parent_id: int, text: str):
         """
+        Дописывает секцию без заголовка в документ родительской статьи.
+        Первая такая секция начинает документ (заголовок HTML и <body>), а закрывается
+        документ один раз, в close_parent_notes.
+        :param parent_id: Идентификатор родительской статьи
+        :param text: HTML тела секции (см. render_fragment)
+        """
+        if parent_id not in self._open_notes:
+            _title = self._note_titles.get(parent_id, '')
+            self.open_note(parent_id, self.chapter_header().replace('$title$', escape(_title)) + '<body>')
+        self.append_note_text(parent_id, text)
 
-        :TODO: Вот здесь надо не просто обновлять, а сливать секции
-        :param parent_id:
-        :param text:
-        :return:
+    def open_note(self, note_id: int, text: str):
+        """
+        Начинает документ статьи, к которому затем дописываются секции без заголовка.
+        :param note_id: Идентификатор статьи
+        :param text: Начало документа: заголовок HTML, <body> и, например, аннотация
         """
-        text0 = self.hyst_db.get_note_text(note_id=parent_id)
-        self.hyst_db.update_note_text(note_id=parent_id, text=text0.join(text))
+        self._open_notes[note_id] = None
+        self.append_note_text(note_id, text)
+
+    def append_note_text(self, note_id: int, text: str):
+        """
+        Дописывает текст в конец статьи.
+        Текст копится в памяти и записывается в БД один раз (см. HystDB.append_note_text).
+        """
+        self.hyst_db.append_note_text(note_id=note_id, text=text)
+
+    def close_parent_notes(self):
+        """ Закрывает документы, начатые open_note: дописывает в них </body></html> """
+        for note_id in self._open_notes:
+            self.append_note_text(note_id, '</body></html>')
+        self._open_notes.clear()
 
     def insert_root_section(self, notebook_id: int) -> int:
-        """ Вставляет в in-memory БД корневой узел """
-        # применение encode позволяет передать в INSERT тип bytes (как он и ожидает), а не str
-        self.root_id = self.insert_note(self.parser.title, 0, self.parser.annotation,
-                                        notebook_id)
+        """
+        Вставляет корневой узел: документ с аннотацией. Документ остается открытым
+        для секций без заголовка и закрывается в close_parent_notes.
+        """
+        self.root_id = self.insert_note(self.parser.title, 0, '', notebook_id)
+        self.open_note(self.root_id, self.chapter_header().replace('$title$', escape(self.parser.title or '')) +
+                       '<body>' + self.parser.annotation)
         return self.root_id
 
-    def replace_fb2_html(self, fb2str: str, level: int, title: str) -> str:
-        """ Заменяет тэги FB2 на тэги HTML """
-
-        result = fb2str
-        result = result.replace('<section>', '<body>')
-        result = result.replace('<section', '<body')
-        result = result.replace('</section>', '</body>')
-        result = result.replace('<title>', str('<h{0}>'.format(level)))
-        result = result.replace('</title>', str('</h{0}>'.format(level)))
-        result = result.replace('<empty-line />', '<br>')
-        result = result.replace('<subtitle>', '<p class="subtitle"><b>')
-        result = result.replace('</subtitle>', '</b></p>')
-        result = result.replace('<strong>', '<b>')
-        result = result.replace('</strong>', '</b>')
-        result = result.replace('<poem>', '<pre class="poem">')
-        result = result.replace('</poem>', '</pre>')
-        result = result.replace('<stanza>', '<div class="stanza">')
-        result = result.replace('</stanza>', '</div>')
-        result = result.replace('<v>', '')
-        result = result.replace('</v>', '<br>')
-        result = result.replace('<epigraph>', '<div class="epigraph" align="left">')
-        result = result.replace('</epigraph>', '</div>')
-        result = result.replace('<emphasis>', '<div class="emphasis" align="left">')
-        result = result.replace('</emphasis>', '</div>')
-        result = result.replace('<text-author>', '<p class="text-author" align="left">"')
-        result = result.replace('</text-author>', '</p>')
-        # <cite> </cite>
-
-        result = self.html_header + result + '</html>'
-        result = result.replace('$title$', title)
-
-        # result = result.replace('$CSS$', bytes('./../css/{0}'.format(self.css_filename).encode('utf-8')))
-        # result = self.replace_css(result, bytes('./../css/{0}'.format(self.css_filename).encode('utf-8')))
-        return result
+    def chapter_header(self) -> str:
+        """
+        Возвращает заголовок документа HTML главы с подставленной ссылкой на CSS.
+        Название документа ($title$) не подставляется.
+        """
+        return self.replace_css(self.html_header, self.chapter_css)
+
+    def render_section(self, section: Element, level: int, title: str, nav: str = '') -> str:
+        """
+        Преобразует секцию FB2 в документ HTML за один проход по дереву элементов.
+        :param section: Секция (или тело) FB2
+        :param level: Уровень вложенности секции, определяет размер заголовка
+        :param title: Заголовок документа HTML
+        :param nav: HTML навигации по страницам, выводится в начале и в конце документа
+        :return: Документ HTML
+        """
+        with stage('convert.render'):
+            _parts = [self.chapter_header().replace('$title$', escape(title)), '<body>', nav]
+            self.emitter.emit(section, _parts.append, level)
+            _parts += [nav, '</body></html>']
+            return ''.join(_parts)
+
+    def render_fragment(self, section: Element, level: int) -> str:
+        """
+        Преобразует секцию FB2 в HTML без заголовка документа и <body>:
+        так секция без заголовка дописывается в документ родительской статьи.
+        :param section: Секция FB2
+        :param level: Уровень вложенности секции
+        :return: HTML тела секции
+        """
+        with stage('convert.render'):
+            _parts = []
+            self.emitter.emit(section, _parts.append, level)
+            return ''.join(_parts)
 
     def merge_bodies(self, body1: Element, body2: Element) -> Element:
         """
@@ -2,6 +2,7 @@
 from pathlib import Path
 import sqlite3
 from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Stats import stage, track_file
 
 class FB2DirScaner:
     """
@@ -55,21 +56,23 @@ class FB2DirScaner:
         wcursor = self.dbconn.cursor()
         wsql = 'insert into works(author_id, title, file_name) values(?, ?, ?)'
         for item in list(self.start_dir.glob('**/*.fb2')):
-            try:
-                parser = FB2Parser(item)
-                fn = str(parser.author_first_name()).strip()
-                ln = str(parser.author_last_name()).strip()
-                mn = str(parser.author_middle_name()).strip()
+            with track_file(item):
                 try:
-                    title = str(parser.title).strip()
-                except:
-                    title = ''
-                acursor.execute(asql, [ln, fn, mn])
-                lastrowid = acursor.lastrowid
-            except Exception:
-                # Если не удалось вставить запись из-за ограничения на уникальность
-                # то нужно узнать идентификатор записи, которая не дала вставить нового автора
-                lastrowid = self.get_author_id(ln, fn, mn)
+                    parser = FB2Parser(item)
+                    fn = str(parser.author_first_name()).strip()
+                    ln = str(parser.author_last_name()).strip()
+                    mn = str(parser.author_middle_name()).strip()
+                    try:
+                        title = str(parser.title).strip()
+                    except:
+                        title = ''
+                    acursor.execute(asql, [ln, fn, mn])
+                    lastrowid = acursor.lastrowid
+                except Exception:
+                    # Если не удалось вставить запись из-за ограничения на уникальность
+                    # то нужно узнать идентификатор записи, которая не дала вставить нового автора
+                    lastrowid = self.get_author_id(ln, fn, mn)
 
-            wcursor.execute(wsql, [lastrowid, title, str(item)])
-            self.dbconn.commit()
+                wcursor.execute(wsql, [lastrowid, title, str(item)])
+                with stage('scan.commit'):
+                    self.dbconn.commit()
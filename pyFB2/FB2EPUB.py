@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+import posixpath
+import time
+import uuid
+import zipfile
+from html import escape
+
+from pyFB2.FB2Contents import FB2Contents
+from pyFB2.FB2ConvertBase import FB2ConvertBase
+from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Stats import stage
+from pyFB2.FB2Types import ImageRef
+
+# Форматы изображений, которые уже сжаты: повторное сжатие только тратит время
+COMPRESSED_IMAGE_TYPES = frozenset(['image/jpeg', 'image/png', 'image/gif'])
+
+CONTAINER_XML = '<?xml version="1.0" encoding="utf-8"?>\n' \
+                '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n' \
+                '  <rootfiles>\n' \
+                '    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>\n' \
+                '  </rootfiles>\n' \
+                '</container>\n'
+
+
+class FB2EPUB(FB2ConvertBase):
+    """
+    Класс для преобразования файла **FB2** в **EPUB 3**
+
+    Книга пишется потоком прямо в архив: изображения декодируются из BASE64 и сразу записываются в архив,
+    главы XHTML записываются по мере отрисовки секций, в конце записываются CSS, документ навигации
+    и пакет OPF. Временные каталоги и БД Hyst не используются, каждая книга - одна последовательная запись.
+    """
+    use_hyst_db = False
+
+    html_header: str = '<?xml version="1.0" encoding="utf-8"?>\n' \
+                       '<!DOCTYPE html>\n' \
+                       '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" ' \
+                       'xml:lang="$lang$" lang="$lang$">\n' \
+                       '  <head>\n' \
+                       '     <link rel="stylesheet" href="$CSS$" type="text/css" />\n' \
+                       '     <title>$title$</title>\n' \
+                       '  </head>\n'
+
+    text_dir = 'Text'
+    image_dir = 'Images'
+    css_dir = 'Styles'
+
+    def __init__(self, filename: str, css: str = None, jobs: int = 1, check_schema: bool = True,
+                 parser: FB2Parser = None, compression: int = zipfile.ZIP_DEFLATED, compresslevel: int = None,
+                 inline_notes: bool = False, page_size: int = 0, page_paragraphs: int = 0):
+        """
+        Конструктор класса **FB2EPUB**
+
+        :param filename: Имя файла FB2
+        :param css: Имя файла CSS
+        :param jobs: Количество параллельно отрисовываемых глав
+        :param check_schema: Проверять файл FB2 на соответствие схеме
+        :param parser: Готовый парсер, например для книги из архива
+        :param compression: Метод сжатия файлов архива (кроме mimetype), например zipfile.ZIP_DEFLATED
+        :param compresslevel: Уровень сжатия. None - по умолчанию для метода
+        :param inline_notes: Выводить текст сносок рядом со ссылкой на них
+        :param page_size: Примерный размер страницы в байтах. Большие главы разбиваются на страницы. 0 - не разбивать
+        :param page_paragraphs: Количество абзацев на странице. 0 - не ограничивать
+        """
+        super().__init__(filename=filename, css=css, jobs=jobs, check_schema=check_schema, parser=parser,
+                         inline_notes=inline_notes, page_size=page_size, page_paragraphs=page_paragraphs)
+        self.emitter.xhtml = True
+        self.emitter.image_path = f'../{self.image_dir}/'
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.language = (self.parser.lang or ['ru'])[0] or 'ru'
+        self.toc = FB2Contents()
+        self.archive: zipfile.ZipFile = None
+        self._note_id: int = 0
+        self._manifest: list[tuple] = []  # элементы манифеста OPF: (id, href, media-type, properties)
+        self._spine: list[str] = []  # идентификаторы глав в порядке чтения
+        self._open_chapters: dict[int, list[str]] = {}  # идентификатор главы -> части еще не записанного документа
+
+    def chapter_filename(self, note_id: int) -> str:
+        """
+        Возвращает имя файла главы.
+        :param note_id: Идентификатор главы
+        """
+        return f'ch_{str(note_id).zfill(4)}.xhtml'
+
+    def note_href(self, note_id: int, anchor: str = '') -> str:
+        """ Ссылка на якорь в файле главы. Все главы лежат в одном каталоге """
+        return self.chapter_filename(note_id) + (f'#{anchor}' if anchor else '')
+
+    def image_src(self, image: ImageRef) -> str:
+        """ Ссылка на изображение из файла главы """
+        return f'../{self.image_dir}/{image.binary_id}'
+
+    def replace_css(self, text: str, css: str) -> str:
+        """
+        Заменяет $CSS$ на ссылку на файл CSS, а $lang$ - на язык книги.
+        Если CSS не задан, то ссылка на него удаляется.
+        """
+        if not css:
+            text = text.replace('     <link rel="stylesheet" href="$CSS$" type="text/css" />\n', '')
+        return text.replace('$CSS$', css).replace('$lang$', self.language)
+
+    def copy_css(self) -> bool:
+        """
+        Записывает файл CSS в архив
+
+        :returns:  True - если файл записан
+        """
+        if self.css is None:
+            return True
+        try:
+            with open(self.css, 'rb') as f:
+                self._write(f'{self.css_dir}/{self.css_filename}', f.read())
+        except OSError:
+            return False
+        self._manifest += [('css', f'{self.css_dir}/{self.css_filename}', 'text/css', '')]
+        return True
+
+    def _write(self, name: str, data, compress_type: int = None):
+        """ Записывает файл в каталог OEBPS архива """
+        _compress_type = self.compression if compress_type is None else compress_type
+        with stage('convert.write'):
+            self.archive.writestr(f'OEBPS/{name}', data, compress_type=_compress_type,
+                                  compresslevel=self.compresslevel)
+
+    def write_binaries(self) -> int:
+        """
+        Записывает изображения в архив сразу после декодирования из BASE64.
+        :return: Количество записанных изображений
+        """
+        _count = 0
+        for image_id, content_type, bin_data in self.decode_binaries():
+            _compress_type = zipfile.ZIP_STORED if content_type in COMPRESSED_IMAGE_TYPES else None
+            self._write(f'{self.image_dir}/{image_id}', bin_data, _compress_type)
+            self.register_image(image_id, content_type, bin_data)
+            _count += 1
+            _properties = 'cover-image' if image_id == self._cover_id() else ''
+            self._manifest += [(f'img{_count}', f'{self.image_dir}/{image_id}', content_type, _properties)]
+        return _count
+
+    def _cover_id(self) -> str:
+        try:
+            return self.parser.cover_page
+        except (AttributeError, ValueError):
+            return None
+
+    def insert_notebook(self, name: str, short_descr: str = '') -> int:
+        """ Для EPUB записная книжка не нужна """
+        return 0
+
+    def _add_chapter(self, filename: str, text: str = None):
+        """
+        Записывает файл главы в архив и добавляет его в манифест и в порядок чтения.
+        Если текст не задан, то файл только занимает место в порядке чтения, а записывается позже.
+        """
+        _item_id = posixpath.splitext(filename)[0]
+        if text is not None:
+            self._write(f'{self.text_dir}/{filename}', text.encode('utf-8'))
+        self._manifest += [(_item_id, f'{self.text_dir}/{filename}', 'application/xhtml+xml', '')]
+        self._spine += [_item_id]
+
+    def insert_note(self, title: str, parent_id: int, text: str, notebook_id: int) -> int:
+        """
+        Записывает главу в архив и добавляет ее в содержание.
+        Если текст главы пустой, то файл не создается, а в содержание добавляется только заголовок.
+        :returns: Идентификатор главы
+        """
+        self._note_id += 1
+        _href = f'{self.text_dir}/{self.chapter_filename(self._note_id)}' if text else None
+        self.toc.add(self._note_id, parent_id, title, _href, len(text))
+        if text:
+            self._add_chapter(self.chapter_filename(self._note_id), text)
+        return self._note_id
+
+    def append_note_text(self, note_id: int, text: str):
+        """
+        Дописывает текст в документ главы. Дописать файл в архиве нельзя, поэтому документ
+        копится в памяти и записывается в close_parent_notes. Место в порядке чтения глава
+        получает при первой записи. Ссылки на секции без заголовка ведут в файл родительской
+        главы (см. build_link_index), и секции попадают именно в него.
+        """
+        _texts = self._open_chapters.get(note_id)
+        _note = self.toc.get(note_id)
+        if _texts is None:
+            _texts = self._open_chapters[note_id] = []
+            self._add_chapter(self.chapter_filename(note_id))
+            if _note is not None:
+                _note["href"] = f'{self.text_dir}/{self.chapter_filename(note_id)}'
+        _texts.append(text)
+        if _note is not None:
+            _note["length"] += len(text)
+
+    def close_parent_notes(self):
+        """ Закрывает документы глав с секциями без заголовка и записывает их в архив """
+        super().close_parent_notes()
+        for note_id, texts in self._open_chapters.items():
+            self._write(f'{self.text_dir}/{self.chapter_filename(note_id)}', ''.join(texts).encode('utf-8'))
+        self._open_chapters.clear()
+
+    def insert_root_section(self, notebook_id: int) -> int:
+        """
+        Вставляет титульную страницу: обложка, авторы, название и аннотация.
+        Страница остается открытой для секций без заголовка и закрывается в close_parent_notes.
+        """
+        _parts = [self.chapter_header().replace('$title$', escape(self.parser.title or '')), '<body>']
+        _cover = self.images.get(self._cover_id())
+        if _cover is not None:
+            _parts.append(f'<p class="cover"><img src="{escape(self.image_src(_cover))}" alt="" /></p>')
+        for author in self.parser.authors:
+            _name = ' '.join(filter(None, [self.parser.author_first_name(author),
+                                           self.parser.author_middle_name(author),
+                                           self.parser.author_last_name(author)]))
+            _parts.append(f'<p class="author">{escape(_name)}</p>')
+        _parts.append(f'<h1>{escape(self.parser.title or "")}</h1>')
+        _annotation = self.parser.title_info.find('./annotation')
+        if _annotation is not None:
+            self.emitter.emit(_annotation, _parts.append)
+        self.root_id = self.insert_note(self.parser.title or '', 0, '', notebook_id)
+        self.open_note(self.root_id, ''.join(_parts))
+        return self.root_id
+
+    def book_id(self) -> str:
+        """ Уникальный идентификатор книги: id документа FB2 или UUID, вычисленный по названию и авторам """
+        try:
+            _id = self.parser.doc_info_id
+        except (AttributeError, ValueError):
+            _id = None
+        if _id:
+            return _id
+        _authors = ','.join(f'{self.parser.author_last_name(author)} {self.parser.author_first_name(author)}'
+                            for author in self.parser.authors)
+        return f'urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, f"{_authors}/{self.parser.title}")}'
+
+    def package_document(self) -> str:
+        """ Пакет OPF: метаданные, манифест и порядок чтения """
+        _parts = ['<?xml version="1.0" encoding="utf-8"?>\n',
+                  '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n',
+                  '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n',
+                  f'    <dc:identifier id="book-id">{escape(self.book_id())}</dc:identifier>\n',
+                  f'    <dc:title>{escape(self.parser.title or "")}</dc:title>\n',
+                  f'    <dc:language>{escape(self.language)}</dc:language>\n']
+        for author in self.parser.authors:
+            _name = ' '.join(filter(None, [self.parser.author_first_name(author),
+                                           self.parser.author_middle_name(author),
+                                           self.parser.author_last_name(author)]))
+            _parts.append(f'    <dc:creator>{escape(_name)}</dc:creator>\n')
+        _modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        _parts.append(f'    <meta property="dcterms:modified">{_modified}</meta>\n  </metadata>\n  <manifest>\n')
+        _parts.append('    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n')
+        for item_id, href, media_type, properties in self._manifest:
+            _properties = f' properties="{properties}"' if properties else ''
+            _parts.append(f'    <item id="{escape(item_id)}" href="{escape(href)}" '
+                          f'media-type="{escape(media_type)}"{_properties}/>\n')
+        _parts.append('  </manifest>\n  <spine>\n')
+        _parts += [f'    <itemref idref="{escape(item_id)}"/>\n' for item_id in self._spine]
+        _parts.append('  </spine>\n</package>\n')
+        return ''.join(_parts)
+
+    def create_epub(self, filename: str) -> int:
+        """
+        Записывает книгу в файл EPUB.
+
+        :param filename: Имя файла EPUB или файловый объект, открытый для записи
+        :returns: Код ошибки. 0 если все прошло удачно
+        """
+        try:
+            self.archive = zipfile.ZipFile(filename, 'w')
+        except OSError:
+            print(f'Ошибка: Не удалось создать файл {filename}.')
+            return 1
+        with self.archive:
+            # mimetype - первый файл архива и не сжимается
+            self.archive.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            self.archive.writestr('META-INF/container.xml', CONTAINER_XML, compress_type=self.compression,
+                                  compresslevel=self.compresslevel)
+            if not self.copy_css():
+                print(f'Ошибка: Не удалось скопировать CSS {self.css}')
+                return 2
+            self.chapter_css = f'../{self.css_dir}/{self.css_filename}' if self.css is not None else ''
+
+            self.write_binaries()
+            _notebook_id = self.insert_notebook(self.parser.title)
+            self.root_id = self.insert_root_section(_notebook_id)
+            self.build_link_index(self.root_id)
+
+            for body in self.parser.bodies:
+                if self.parser.is_body_notes(body):
+                    if self.get_titles_str(body) == '':
+                        _sections = body.findall('./section')
+                        if len(_sections) > 3:
+                            # много сносок - все тело примечаний записываем в один файл
+                            self.insert_note(title='Примечания', parent_id=self.root_id,
+                                             text=self.render_section(body, 1, 'Примечания'),
+                                             notebook_id=_notebook_id)
+                        else:
+                            for section in _sections:
+                                _title = self.get_titles_str(section)
+                                self.insert_note(title=_title, parent_id=self.root_id,
+                                                 text=self.render_section(section, 1, _title),
+                                                 notebook_id=_notebook_id)
+                    else:
+                        _title = self.get_titles_str(body)
+                        self.insert_note(title=_title, parent_id=self.root_id,
+                                         text=self.render_section(body, 1, _title), notebook_id=_notebook_id)
+                else:
+                    self.insert_body_sections(body, self.root_id, _notebook_id)
+            self.close_parent_notes()
+
+            self._write('nav.xhtml', self.toc.to_nav_xhtml(self.parser.title or '', lang=self.language))
+            self._write('content.opf', self.package_document())
+        return 0
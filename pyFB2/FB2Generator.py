@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+import random
+import struct
+import zipfile
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+# Варианты испорченных файлов
+MALFORMED = ('truncated', 'unclosed_tag', 'no_description', 'bad_base64', 'bad_encoding')
+
+_LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов', 'Михайлов',
+               'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров', 'Павлов')
+_FIRST_NAMES = ('Иван', 'Петр', 'Сергей', 'Алексей', 'Николай', 'Андрей', 'Михаил', 'Дмитрий', 'Федор', 'Юрий')
+_MIDDLE_NAMES = ('Иванович', 'Петрович', 'Сергеевич', 'Алексеевич', 'Николаевич', 'Андреевич', 'Михайлович')
+_WORDS = ('и', 'в', 'не', 'на', 'он', 'что', 'с', 'как', 'это', 'по', 'но', 'они', 'к', 'у', 'из', 'за', 'так',
+          'день', 'дом', 'город', 'дорога', 'время', 'человек', 'глаза', 'рука', 'слово', 'жизнь', 'земля',
+          'говорил', 'смотрел', 'думал', 'шел', 'знал', 'видел', 'ночь', 'утро', 'окно', 'дверь', 'книга',
+          'старый', 'новый', 'тихий', 'долгий', 'светлый', 'темный', 'далекий', 'последний', 'первый')
+_GENRES = ('sf', 'sf_history', 'det_classic', 'prose_classic', 'adv_history', 'love_contemporary', 'nonf_biography')
+
+
+class FB2Generator:
+    """
+    Генератор синтетических файлов FB2 для замеров производительности.
+
+    Содержимое книги полностью определяется параметрами генератора и номером книги, поэтому
+    при одинаковых параметрах каждый запуск дает побайтно одинаковые файлы. Изображения - настоящие
+    PNG со случайными (несжимаемыми) пикселями, их размер в байтах близок к image_size.
+    """
+
+    def __init__(self, seed: int = 0, sections: int = 10, depth: int = 1, subsections: int = 2,
+                 paragraphs: int = 20, words: int = 60, notes: int = 5, images: int = 1, image_size: int = 16384,
+                 authors: int = 10):
+        """
+        Конструктор класса
+
+        :param seed: Начальное значение генератора случайных чисел
+        :param sections: Количество секций верхнего уровня
+        :param depth: Глубина вложенности секций. 1 - секции без подсекций
+        :param subsections: Количество подсекций в каждой секции, кроме секций последнего уровня
+        :param paragraphs: Количество абзацев в секции последнего уровня
+        :param words: Количество слов в абзаце
+        :param notes: Количество сносок в теле примечаний. 0 - книга без примечаний
+        :param images: Количество изображений. Первое изображение становится обложкой
+        :param image_size: Примерный размер одного изображения в байтах
+        :param authors: Количество разных авторов, между которыми распределяются книги
+        """
+        self.seed = seed
+        self.sections = sections
+        self.depth = max(1, depth)
+        self.subsections = subsections
+        self.paragraphs = paragraphs
+        self.words = words
+        self.notes = notes
+        self.images = images
+        self.image_size = image_size
+        self.authors = max(1, authors)
+
+    def _random(self, index: int) -> random.Random:
+        """ Генератор случайных чисел для книги с номером index """
+        return random.Random(f'{self.seed}:{index}')
+
+    def author(self, index: int) -> tuple[str, str, str]:
+        """
+        Автор книги: фамилия, имя и отчество. Авторы повторяются с периодом authors.
+        """
+        _number = index % self.authors
+        _rnd = random.Random(f'{self.seed}:author:{_number}')
+        _last_name = _rnd.choice(_LAST_NAMES)
+        if _number >= len(_LAST_NAMES):
+            # фамилий меньше, чем авторов - добавляем номер, чтобы авторы различались
+            _last_name = f'{_last_name}-{_number}'
+        return _last_name, _rnd.choice(_FIRST_NAMES), _rnd.choice(_MIDDLE_NAMES)
+
+    def title(self, index: int) -> str:
+        """ Название книги """
+        _rnd = random.Random(f'{self.seed}:title:{index}')
+        return f'{" ".join(_rnd.choice(_WORDS) for _ in range(3)).capitalize()} {index}'
+
+    def _text(self, rnd: random.Random, words: int) -> str:
+        return escape(' '.join(rnd.choice(_WORDS) for _ in range(words)).capitalize() + '.')
+
+    def _paragraph(self, rnd: random.Random) -> str:
+        _text = self._text(rnd, self.words)
+        if self.notes and rnd.random() < 0.1:
+            _note = rnd.randrange(self.notes)
+            _text += f'<a l:href="#n_{_note}" type="note">[{_note + 1}]</a>'
+        if rnd.random() < 0.2:
+            _text = f'<strong>{self._text(rnd, 2)}</strong> {_text} <emphasis>{self._text(rnd, 2)}</emphasis>'
+        return f'<p>{_text}</p>\n'
+
+    def _section(self, rnd: random.Random, path: str, level: int, parts: list):
+        """
+        Добавляет в parts секцию с подсекциями. Рекурсия ограничена глубиной depth.
+        :param path: Номер секции вида 1.2.3
+        :param level: Уровень секции, с 1
+        """
+        parts.append(f'<section id="s{path.replace(".", "_")}"><title><p>Глава {path}</p></title>\n')
+        if level < self.depth and self.subsections > 0:
+            if rnd.random() < 0.3:
+                parts.append(f'<epigraph><p>{self._text(rnd, 12)}</p><text-author>{escape(" ".join(self.author(level)))}'
+                             f'</text-author></epigraph>\n')
+            for number in range(1, self.subsections + 1):
+                self._section(rnd, f'{path}.{number}', level + 1, parts)
+        else:
+            for number in range(self.paragraphs):
+                parts.append(self._paragraph(rnd))
+                if number and number % 50 == 0:
+                    parts.append('<empty-line/>\n')
+            if self.images > 1 and rnd.random() < 0.2:
+                parts.append(f'<image l:href="#img{rnd.randrange(1, self.images)}.png"/>\n')
+        parts.append('</section>\n')
+
+    def _image(self, rnd: random.Random) -> bytes:
+        """ Изображение PNG размером около image_size байт """
+        _side = max(1, int((self.image_size / 3) ** 0.5))
+        _raw = b''.join(b'\x00' + rnd.randbytes(_side * 3) for _ in range(_side))
+
+        def _chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack('>L', len(data)) + kind + data + struct.pack('>L', zlib.crc32(kind + data))
+
+        return b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', struct.pack('>2L5B', _side, _side, 8, 2, 0, 0, 0)) + \
+            _chunk(b'IDAT', zlib.compress(_raw, 1)) + _chunk(b'IEND', b'')
+
+    def book(self, index: int) -> bytes:
+        """
+        Содержимое книги с номером index
+        :param index: Номер книги
+        :return: Файл FB2 в кодировке UTF-8
+        """
+        _rnd = self._random(index)
+        _last_name, _first_name, _middle_name = self.author(index)
+        _title = escape(self.title(index))
+        _parts = ['<?xml version="1.0" encoding="utf-8"?>\n',
+                  '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" '
+                  'xmlns:l="http://www.w3.org/1999/xlink">\n',
+                  f'<description><title-info><genre>{_rnd.choice(_GENRES)}</genre>',
+                  f'<author><first-name>{_first_name}</first-name><middle-name>{_middle_name}</middle-name>'
+                  f'<last-name>{_last_name}</last-name></author>',
+                  f'<book-title>{_title}</book-title><annotation><p>{self._text(_rnd, 30)}</p></annotation>',
+                  '<coverpage><image l:href="#img0.png"/></coverpage>' if self.images else '',
+                  f'<lang>ru</lang><sequence name="Серия {index % 7}" number="{index // 7 + 1}"/></title-info>\n',
+                  f'<document-info><author><nickname>generator</nickname></author>'
+                  f'<program-used>pyFB2.FB2Generator</program-used><date>2024</date>'
+                  f'<id>fb2gen-{self.seed}-{index}</id><version>1.0</version></document-info></description>\n',
+                  f'<body><title><p>{_title}</p></title>\n']
+        for number in range(1, self.sections + 1):
+            self._section(_rnd, str(number), 1, _parts)
+        _parts.append('</body>\n')
+        if self.notes:
+            _parts.append('<body name="notes"><title><p>Примечания</p></title>\n')
+            for number in range(self.notes):
+                _parts.append(f'<section id="n_{number}"><title><p>{number + 1}</p></title>'
+                              f'<p>{self._text(_rnd, 20)}</p></section>\n')
+            _parts.append('</body>\n')
+        for number in range(self.images):
+            _parts.append(f'<binary id={quoteattr(f"img{number}.png")} content-type="image/png">'
+                          f'{base64.b64encode(self._image(_rnd)).decode("ascii")}</binary>\n')
+        _parts.append('</FictionBook>\n')
+        return ''.join(_parts).encode('utf-8')
+
+    def malformed(self, index: int, kind: str) -> bytes:
+        """
+        Испорченный вариант книги с номером index
+        :param index: Номер книги
+        :param kind: Вариант порчи, см. MALFORMED
+        :return: Содержимое файла
+        """
+        _data = self.book(index)
+        if kind == 'truncated':
+            return _data[:len(_data) // 2]
+        if kind == 'unclosed_tag':
+            return _data.replace(b'</p>', b'', 1)
+        if kind == 'no_description':
+            _start = _data.index(b'<description>')
+            return _data[:_start] + _data[_data.index(b'</description>') + len(b'</description>'):]
+        if kind == 'bad_base64':
+            _start = _data.index(b'</body>') + len(b'</body>')
+            return _data[:_start] + b'\n<binary id="bad.png" content-type="image/png">AAAAA</binary>' + \
+                _data[_start:]
+        if kind == 'bad_encoding':
+            # кодировка в заголовке не совпадает с настоящей
+            return _data.decode('utf-8').encode('cp1251', errors='replace')
+        raise ValueError(f'Неизвестный вариант порчи файла: {kind}')
+
+    def write(self, filename: str, index: int, kind: str = None, zipped: bool = False) -> str:
+        """
+        Записывает книгу в файл
+        :param filename: Имя файла
+        :param index: Номер книги
+        :param kind: Вариант порчи, см. MALFORMED. None - правильный файл
+        :param zipped: Упаковать книгу в архив ZIP. К имени файла добавляется .zip
+        :return: Имя записанного файла
+        """
+        _data = self.book(index) if kind is None else self.malformed(index, kind)
+        if zipped:
+            filename = f'{filename}.zip'
+            with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(os.path.basename(filename)[:-4], _data)
+        else:
+            with open(filename, 'wb') as file:
+                file.write(_data)
+        return filename
+
+    def generate(self, out_dir: str, count: int, malformed: float = 0.0, zipped: bool = False) -> list[str]:
+        """
+        Создает каталог с книгами
+        :param out_dir: Каталог. Создается, если его нет
+        :param count: Количество книг
+        :param malformed: Доля испорченных книг, от 0 до 1. Испорченные книги распределены равномерно,
+                          варианты порчи чередуются
+        :param zipped: Упаковать каждую книгу в отдельный архив .fb2.zip
+        :return: Список имен созданных файлов
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        _files = []
+        _bad = 0
+        for index in range(count):
+            _kind = None
+            # испорченной становится книга, на которой накопленная доля испорченных достигает очередного целого
+            if int((index + 1) * malformed) > _bad:
+                _kind = MALFORMED[_bad % len(MALFORMED)]
+                _bad += 1
+            _name = os.path.join(out_dir, f'book_{index:05}{"_" + _kind if _kind else ""}.fb2')
+            _files.append(self.write(_name, index, _kind, zipped))
+        return _files
@@ -1,25 +1,29 @@
 # -*- coding: utf-8 -*-
 from pathlib import Path
 from pyFB2.FB2Renamer import FB2Renamer
+from pyFB2.FB2Stats import track_file
 
 
 class FB2GroupRenamer:
     """
-    Групповое переименование FB2 файлов
+    Групповое переименование FB2 файлов и архивов .fb2.zip
     """
 
-    def __init__(self, start_dir: str, out_dir: str, template: str, debug: bool = False):
+    def __init__(self, start_dir: str, out_dir: str, template: str, debug: bool = False,
+                 rename_member: bool = False):
         """
         Конструктор
 
         :param start_dir: Каталог, в котором нужно искать файлы FB2
         :param out_dir: Дополнительный каталог в форме шаблона
         :param template: Шаблон переименования
+        :param rename_member: Для архивов переименовывать также файл FB2 внутри архива
         """
         self.startDir = Path(start_dir)
         self.template = template
         self.debug = debug
         self.outDir = out_dir
+        self.rename_member = rename_member
         if not self.startDir.is_dir():
             print(f'Ошибка: Каталог не существует: {self.startDir}')
             return
@@ -32,15 +36,16 @@ class FB2GroupRenamer:
         :returns: Количество переименованных файлов.
         """
         _counter = 0
-        _mask = '*.fb2'
-        if recursive:
-            _mask = '**/*.fb2'
-        for _item in list(self.startDir.glob(_mask)):
-            _renamer = FB2Renamer(_item.name, self.template, self.outDir, self.debug)
+        _prefix = '**/' if recursive else ''
+        _items = list(self.startDir.glob(f'{_prefix}*.fb2')) + list(self.startDir.glob(f'{_prefix}*.fb2.zip'))
+        for _item in _items:
             _new_name = ''
             try:
-                _new_name = _renamer.rename()
+                with track_file(_item):
+                    _renamer = FB2Renamer(str(_item), self.template, self.outDir, self.debug, self.rename_member)
+                    _new_name = _renamer.new_filename
+                    _renamer.rename()
                 _counter += 1
             except:
-                print(f'Ошибка: Не удалось переименовать в {_new_name}')
+                print(f'Ошибка: Не удалось переименовать {_item} в {_new_name}')
         return _counter
@@ -2,70 +2,156 @@
 import os
 import re
 import shutil
-from xml.etree import ElementTree
 
+from pyFB2.FB2BlobStore import FB2BlobStore
+from pyFB2.FB2Contents import FB2Contents
 from pyFB2.FB2ConvertBase import FB2ConvertBase
+from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Stats import add_counter, stage
+from pyFB2.FB2Types import ImageRef
 
 
 class FB2HTML(FB2ConvertBase):
     """
     Класс для преобразования файла **FB2** в файлы **HTML**
+
+    Главы записываются в файлы сразу, как только обработана соответствующая секция,
+    а содержание книги собирается в памяти по мере записи глав. БД Hyst не используется.
     """
+    use_hyst_db = False
 
-    def __init__(self, filename: str, out_dir: str, css: str = None):
+    def __init__(self, filename: str, out_dir: str, css: str = None, jobs: int = 1, check_schema: bool = True,
+                 shared_css: str = None, parser: FB2Parser = None, blob_store: FB2BlobStore = None,
+                 link_images: bool = True, inline_notes: bool = False, page_size: int = 0,
+                 page_paragraphs: int = 0):
         """
         Конструктор класса **FB2HTML**
 
         :param filename: Имя файла FB2
         :param css: Имя файла CSS
-        :param debug: Включить отладку. По умолчанию False - отладка отключена
+        :param jobs: Количество параллельно отрисовываемых глав. Имеет смысл для очень больших книг
+        :param check_schema: Проверять файл FB2 на соответствие схеме
+        :param shared_css: Путь к файлу CSS, общему для нескольких книг. Такой файл не копируется в каталог книги,
+                           на него ставится относительная ссылка
+        :param parser: Готовый парсер, например для книги из архива
+        :param blob_store: Общее хранилище изображений
+        :param link_images: Создавать в каталоге img жесткие ссылки на изображения из хранилища
+        :param inline_notes: Выводить текст сносок рядом со ссылкой на них
+        :param page_size: Примерный размер страницы в байтах. Большие главы разбиваются на страницы. 0 - не разбивать
+        :param page_paragraphs: Количество абзацев на странице. 0 - не ограничивать
         """
-        super().__init__(filename=filename, css=css)
+        super().__init__(filename=filename, css=css, jobs=jobs, check_schema=check_schema, parser=parser,
+                         blob_store=blob_store, link_images=link_images, inline_notes=inline_notes,
+                         page_size=page_size, page_paragraphs=page_paragraphs)
+        self.shared_css = shared_css
+        self._css_href: str = ''  # ссылка на CSS из каталога книги
         self._new_out_dir: str = out_dir
         self._img_out_dir: str = ''
         self._htm_out_dir: str = ''
         self._css_out_dir: str = ''
+        self._note_id: int = 0
+        self.toc = FB2Contents()  # содержание собирается по мере записи глав
 
-    def create_contents_list(self, parent_id: int):
+    @property
+    def out_dir(self) -> str:
+        """ Каталог книги. Определяется после создания каталогов """
+        return self._new_out_dir
+
+    def image_src(self, image: ImageRef) -> str:
         """
-        Создает содержание книги
-        :param parent_id: Идентификатор корневого узла, с которого нужно начать
-        :returns: Строку с содержанием книги в формате HTML
+        Ссылка на изображение из файла главы: относительный путь к файлу изображения,
+        в том числе к файлу в общем хранилище.
         """
-        #if self.hyst_db.get_children_count(parent_id) == 0:  return ""
+        if image.path is None:
+            return super().image_src(image)
+        return os.path.relpath(image.path, self._htm_out_dir).replace(os.sep, '/')
 
-        self.contents.write(b'\n<ul>')
+    def chapter_filename(self, note_id: int) -> str:
+        """
+        Возвращает имя файла главы.
+        :param note_id: Идентификатор главы
+        """
+        return f'ch_{str(note_id).zfill(4)}.html'
 
-        _notes = self.hyst_db.get_notes(parent_id=parent_id)
-        for _note in _notes:
-            _note_length = _note.get("length")
-            _strid = str(_note.get("id")).zfill(4)
-            if _note_length > 0:
-                _result = f'\n<li><a href=html/ch_{_strid}.html>{_note.get("name")}</a></li>'
-            else:
-                _result = f'\n<li>{_note.get("name")}</li>'
+    def note_href(self, note_id: int, anchor: str = '') -> str:
+        """ Ссылка на якорь в файле главы. Все главы лежат в одном каталоге """
+        return self.chapter_filename(note_id) + (f'#{anchor}' if anchor else '')
+
+    def insert_notebook(self, name: str, short_descr: str = '') -> int:
+        """ Для HTML записная книжка не нужна """
+        return 0
 
-            self.contents.write(_result.encode("utf-8"))
-            self.create_contents_list(_note.get("id"))
+    def insert_note(self, title: str, parent_id: int, text: str, notebook_id: int) -> int:
+        """
+        Записывает главу в файл и добавляет ее в содержание.
+        Если текст главы пустой, то файл не создается, а в содержание добавляется только заголовок.
+        :returns: Идентификатор главы
+        """
+        self._note_id += 1
+        _href = f'html/{self.chapter_filename(self._note_id)}' if text else None
+        self.toc.add(self._note_id, parent_id, title, _href, len(text))
+        if text:
+            with stage('convert.write'), open(os.path.join(self._htm_out_dir, self.chapter_filename(self._note_id)),
+                                               'w', encoding='utf-8') as _file:
+                _file.write(text)
+            add_counter('convert.written_chars', len(text))
+        return self._note_id
+
+    def append_note_text(self, note_id: int, text: str):
+        """
+        Дописывает текст в файл главы. Если у главы еще нет файла, то он создается.
+        """
+        _note = self.toc.get(note_id)
+        _mode = 'w' if _note is not None and _note["href"] is None else 'a'
+        with stage('convert.write'), open(os.path.join(self._htm_out_dir, self.chapter_filename(note_id)), _mode,
+                                          encoding='utf-8') as _file:
+            _file.write(text)
+        add_counter('convert.written_chars', len(text))
+        if _note is not None:
+            _note["length"] += len(text)
+            _note["href"] = f'html/{self.chapter_filename(note_id)}'
 
-        self.contents.write('\n</ul>'.encode())
+    def create_contents_list(self, parent_id: int):
+        """
+        Записывает содержание книги в файл содержания
+        :param parent_id: Идентификатор корневого узла, с которого нужно начать
+        """
+        self.contents.write(self.toc.to_html(parent_id).encode("utf-8"))
 
     def write_contents_header(self):
         """
 
         :returns:
         """
-        _contents_header = self.html_header
-        # _contents_header = self.replace_css(_contents_header, f'./css/{self.css_filename}')
+        _contents_header = self.replace_css(self.html_header, self._css_href)
         _contents_header = _contents_header.replace('$title$', self.parser.title)
         self.contents.write(_contents_header.encode("utf-8"))
-        self.contents.write('\n<p><img src="./img/{self.parser.cover_page}"></p>'.encode("utf-8"))
+        _cover = self.images.get(self.parser.cover_page)
+        if _cover is not None and _cover.path is not None:
+            _src = os.path.relpath(_cover.path, self._new_out_dir).replace(os.sep, '/')
+            self.contents.write(f'\n<p><img src="{_src}"></p>'.encode("utf-8"))
         for author in self.parser.authors:
             self.contents.write(
-                f'<h1 class="author">{self.parser.author_last_name(author)} {self.parser.author_first_name(author)} {self.parser.author_middle_name()}</h1>\n'.encode(
+                f'<h1 class="author">{self.parser.author_last_name(author)} {self.parser.author_first_name(author)} {self.parser.author_middle_name(author)}</h1>\n'.encode(
                     "utf-8"))
 
-    def create_dirs(self, outdir: str, html_dir='html', image_dir='img', css_dir='css') -> bool:
+    @classmethod
+    def book_path(cls, parser: FB2Parser) -> str:
+        """
+        Путь к каталогу книги относительно каталога вывода: автор/название
+        :param parser: Парсер книги, достаточно метаданных (metadata_only)
+        """
+        # имя автора
+        _author_name = cls.remove_restricted_chars(
+            '{0} {1} {2}'.format(parser.author_last_name(), parser.author_first_name(),
+                                 parser.author_middle_name())).strip(' ')
+        # повторяющиеся пробелы заменяем на единственный пробел
+        _author_name = re.sub("\s\s+", ' ', _author_name).strip()
+
+        book_title = cls.remove_restricted_chars('{0}'.format(parser.title)).strip(' ')
+        return os.path.join(_author_name, book_title)
+
+    def create_dirs(self, outdir: str, html_dir='html', image_dir='img', css_dir='css', book_dir: str = None) -> bool:
         """
         Создает каталоги для файлов **HTML**, **CSS** и изображений.
 
@@ -73,17 +159,10 @@ class FB2HTML(FB2ConvertBase):
         :param html_dir: Каталог для файлов HTML
         :param image_dir: Каталог для файлов изображений
         :param css_dir: Каталог для файлов CSS
+        :param book_dir: Каталог книги. None - outdir/автор/название (см. book_path)
         :returns: True если каталоги созданы. False в противном случае.
         """
-        # имя автора
-        _author_name = self.remove_restricted_chars(
-            '{0} {1} {2}'.format(self.parser.author_last_name(), self.parser.author_first_name(),
-                                 self.parser.author_middle_name())).strip(' ')
-        # повторяющиеся пробелы заменяем на единственный пробел
-        _author_name = re.sub("\s\s+", ' ', _author_name).strip()
-
-        book_title = self.remove_restricted_chars('{0}'.format(self.parser.title)).strip(' ')
-        self._new_out_dir = os.path.join(outdir, _author_name, book_title)
+        self._new_out_dir = book_dir if book_dir is not None else os.path.join(outdir, self.book_path(self.parser))
         try:
             os.makedirs(self._new_out_dir, exist_ok=True)
         except:
@@ -107,7 +186,7 @@ class FB2HTML(FB2ConvertBase):
 
         :returns:  True - если файл скопирован
         """
-        if self.css is None:
+        if self.css is None or self.shared_css is not None:
             return True
         try:
             shutil.copy2(src=self.css, dst=self._css_out_dir)
@@ -123,25 +202,36 @@ class FB2HTML(FB2ConvertBase):
         :param css: Ссылка на CSS
         :returns: Строка с подстановкой
         """
-        return ""  # text.replace('$CSS$', css)
+        return text.replace('$CSS$', css)
 
-    def create_html(self, outdir: str) -> int:
+    def create_html(self, outdir: str, book_dir: str = None) -> int:
         """
         Запись файлов html и изображений в указанный каталог.
 
         :param outdir: Путь, по которому будут сохранены файлы (html и картинки).
                      Если не указан, то в текущем каталоге будет создан каталог с названием книги
                      (с исключенными символами, запрещенными для названий каталогов).
+        :param book_dir: Каталог книги, например чтобы две книги с одинаковыми автором и названием
+                         не записывались в один каталог. None - outdir/автор/название
         :returns: Код ошибки. 0 если все прошло удачно
 
         """
         # подготовка каталогов
-        if not self.create_dirs(outdir=outdir):
+        if not self.create_dirs(outdir=outdir, book_dir=book_dir):
             print(f'Ошибка: Не удалось создать каталог {outdir}.')
             return 1
         if not self.copy_css():
             print(f'Ошибка: Не удалось скопировать CSS {self.css}')
             return 2
+        if self.shared_css is not None:
+            self._css_href = os.path.relpath(self.shared_css, self._new_out_dir).replace(os.sep, '/')
+        elif self.css is not None:
+            self._css_href = f'css/{self.css_filename}'
+        # главы лежат в подкаталоге html
+        self.chapter_css = f'../{self._css_href}' if self._css_href else ''
+
+        # записываем изображения на диск, заодно строится индекс изображений для ссылок в главах
+        self.write_binaries_on_disk(self._img_out_dir)
 
         # вставляем записную книжку, пока это только заглушка
         # для HTML она вообще не нужна
@@ -149,6 +239,8 @@ class FB2HTML(FB2ConvertBase):
 
         # вставляем корневой узел, все остальные будут его потомками
         self.root_id = self.insert_root_section(_notebook_id)
+        # главы получают идентификаторы подряд, поэтому файл для каждого id известен до записи глав
+        self.build_link_index(self.root_id)
 
         # Проходим по всем секция типа body.
         # Их может быть много и у них могут быть заголовки, эпиграфы и т.д., как и у обычных секций
@@ -159,49 +251,30 @@ class FB2HTML(FB2ConvertBase):
                     _sections = body.findall('./section')
                     _sections_count = len(_sections)
                     if _sections_count > 3:
-                        #
-                        # Анализ примечаний
-                        # Здесь это временно, нужно вынести в отдельную функцию
-                        #
-                        for section in _sections:
-                            try:
-                                # :TODO: Переписать
-                                id = section.attrib['id']
-                                _cursor = self.hyst_db.connection.cursor()
-                                _cursor.execute('insert into links (link_id) values (?)', [id])
-                                self.hyst_db.connection.commit()
-                            except:
-                                print('Ошибка при вставке в таблицу LINKS')
-
+                        # много сносок - все тело примечаний записываем в один файл
                         self.insert_note(title='Примечания', parent_id=self.root_id,
-                                         text=ElementTree.tostring(body, 'utf-8'), notebook_id=_notebook_id)
+                                         text=self.render_section(body, 1, 'Примечания'), notebook_id=_notebook_id)
 
                     else:
                         for section in _sections:
-                            self.insert_note(title=self.get_titles_str(section), parent_id=self.root_id,
-                                             text=ElementTree.tostring(section, 'utf-8'),
+                            _title = self.get_titles_str(section)
+                            self.insert_note(title=_title, parent_id=self.root_id,
+                                             text=self.render_section(section, 1, _title),
                                              notebook_id=_notebook_id)
                 else:
-                    self.insert_note(title=self.get_titles_str(body), parent_id=self.root_id,
-                                     text=ElementTree.tostring(body, 'utf-8'),
+                    _title = self.get_titles_str(body)
+                    self.insert_note(title=_title, parent_id=self.root_id,
+                                     text=self.render_section(body, 1, _title),
                                      notebook_id=_notebook_id)
             else:
-                self.insert_child_sections(body, self.root_id,
+                self.insert_body_sections(body, self.root_id,
                                            _notebook_id)  # перебор всех секций, 0 - идентификатор тела как корневого узла
+        self.close_parent_notes()
 
-        # Записываем в БД изображения
-        # возможно, для HTML этот шаг лишний и пригодится только для Hyst
-        # но пока так
-        self.insert_images()
-
-        # записываем изображения на диск
-        self.write_binaries_on_disk(self._img_out_dir)
-
-        self.write_html(self._htm_out_dir)
-        self.hyst_db.write_to_disk("blabla.db")
         filename = os.path.join(self._new_out_dir, 'index.html')
         self.contents = open(filename, 'wb')
         self.write_contents_header()
         self.create_contents_list(0)
+        self.contents.write(b'\n</html>\n')
         self.contents.close()
         return 0
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from html import escape
+from xml.etree.ElementTree import Element
+
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# Таблица соответствия тэгов FB2 тэгам HTML: тэг FB2 -> (тэг HTML, класс CSS).
+# Тэги, которых нет в таблице, не выводятся, выводится только их содержимое.
+# Тэг title обрабатывается отдельно: он становится заголовком h1..h6 в зависимости от уровня вложенности.
+FB2_HTML_TAGS = {
+    'section': ('div', 'section'),
+    'p': ('p', None),
+    'subtitle': ('p', 'subtitle'),
+    'empty-line': ('br', None),
+    'strong': ('b', None),
+    'emphasis': ('i', None),
+    'strikethrough': ('s', None),
+    'sub': ('sub', None),
+    'sup': ('sup', None),
+    'code': ('code', None),
+    'poem': ('div', 'poem'),
+    'stanza': ('div', 'stanza'),
+    'v': ('p', 'v'),
+    'epigraph': ('div', 'epigraph'),
+    'cite': ('blockquote', 'cite'),
+    'text-author': ('p', 'text-author'),
+    'annotation': ('div', 'annotation'),
+    'date': ('p', 'date'),
+    'table': ('table', None),
+    'tr': ('tr', None),
+    'th': ('th', None),
+    'td': ('td', None),
+    'style': ('span', None),
+    'a': ('a', None),
+    'image': ('img', None),
+    'img': ('img', None),
+}
+
+# Атрибуты, которые переносятся в HTML без изменений
+FB2_HTML_ATTRIBUTES = ('id', 'colspan', 'rowspan', 'align', 'valign', 'style', 'alt', 'title', 'src', 'width',
+                       'height')
+
+# Тэги HTML без закрывающего тэга
+HTML_VOID_TAGS = frozenset(['br', 'img'])
+
+
+class FB2HTMLEmitter:
+    """
+    Преобразование элементов FB2 в HTML за один проход по дереву.
+
+    Вывод пишется сразу в поток (любой объект с методом write) без промежуточных строк
+    и последовательных замен. Ссылки на изображения и внутренние ссылки подставляются
+    из словарей images и links, текст всплывающих сносок - из словаря notes.
+    """
+
+    def __init__(self, images: dict = None, links: dict = None, image_path: str = '../img/', xhtml: bool = False,
+                 tags: dict = None, notes: dict = None):
+        """
+        Конструктор класса
+
+        :param images: Словарь: идентификатор бинарника -> значение атрибута src
+        :param links: Словарь: ссылка вида #id -> значение атрибута href
+        :param image_path: Каталог изображений для бинарников, которых нет в images
+        :param xhtml: Выводить пустые тэги в форме XHTML (<br />)
+        :param tags: Таблица соответствия тэгов. По умолчанию FB2_HTML_TAGS
+        :param notes: Словарь: ссылка вида #id -> текст сноски. Текст выводится после ссылки на сноску
+        """
+        self.images = images if images is not None else {}
+        self.links = links if links is not None else {}
+        self.image_path = image_path
+        self.xhtml = xhtml
+        self.tags = tags if tags is not None else FB2_HTML_TAGS
+        self.notes = notes if notes is not None else {}
+
+    def to_string(self, element: Element, level: int = 1) -> str:
+        """
+        Возвращает HTML для элемента в виде строки.
+        :param element: Элемент FB2, например section
+        :param level: Уровень вложенности, определяет размер заголовка
+        """
+        _parts = []
+        self.emit(element, _parts.append, level)
+        return ''.join(_parts)
+
+    def emit(self, element: Element, write, level: int = 1):
+        """
+        Выводит HTML для элемента вместе с его потомками. Хвост (tail) самого элемента не выводится.
+        :param element: Элемент FB2
+        :param write: Функция записи, например file.write или list.append
+        :param level: Уровень вложенности элемента, определяет размер заголовка
+        """
+        if element.tag == 'title':
+            self._emit_title(element, write, level)
+            return
+
+        html_tag, css_class = self.tags.get(element.tag, (None, None))
+        if html_tag is None:
+            self._emit_content(element, write, level)
+            return
+
+        _attributes = self._attributes(element, css_class)
+        if html_tag in HTML_VOID_TAGS:
+            write(f'<{html_tag}{_attributes}{" /" if self.xhtml else ""}>')
+            return
+        write(f'<{html_tag}{_attributes}>')
+        self._emit_content(element, write, level)
+        write(f'</{html_tag}>')
+        if element.tag == 'a' and self.notes:
+            self._emit_note(element, write)
+
+    def _emit_note(self, element: Element, write):
+        """ Выводит текст сноски после ссылки на нее, если он есть в словаре notes """
+        _text = self.notes.get(element.get(XLINK_HREF, element.get('href', '')))
+        if _text:
+            write(f'<span class="note-popup">{escape(_text, quote=False)}</span>')
+
+    def _emit_content(self, element: Element, write, level: int):
+        """ Выводит текст элемента и его потомков """
+        if element.text:
+            write(escape(element.text, quote=False))
+        for child in element:
+            # вложенная секция на уровень глубже родителя
+            self.emit(child, write, level + 1 if child.tag == 'section' else level)
+            if child.tail:
+                write(escape(child.tail, quote=False))
+
+    def _emit_title(self, element: Element, write, level: int):
+        """ Заголовок выводится как h1..h6, абзацы заголовка разделяются переводом строки """
+        _tag = f'h{min(max(level, 1), 6)}'
+        write(f'<{_tag}{self._attributes(element, None)}>')
+        if element.text and element.text.strip():
+            write(escape(element.text, quote=False))
+        _first = True
+        for child in element:
+            if child.tag == 'p':
+                if not _first:
+                    write('<br />' if self.xhtml else '<br>')
+                self._emit_content(child, write, level)
+                _first = False
+            else:
+                self.emit(child, write, level)
+            if child.tail and child.tail.strip():
+                write(escape(child.tail, quote=False))
+        write(f'</{_tag}>')
+
+    def _attributes(self, element: Element, css_class: str) -> str:
+        """ Формирует строку атрибутов HTML """
+        _attrib = element.attrib
+        _result = {name: _attrib[name] for name in FB2_HTML_ATTRIBUTES if name in _attrib}
+        _classes = [css_class] if css_class else []
+        if element.tag == 'style' and 'name' in _attrib:
+            _classes += [_attrib['name']]
+        elif element.tag == 'a':
+            _href = _attrib.get(XLINK_HREF, _attrib.get('href', ''))
+            _result['href'] = self.links.get(_href, _href)
+            if _attrib.get('type') == 'note':
+                _classes += ['note']
+        elif element.tag == 'image':
+            _binary_id = _attrib.get(XLINK_HREF, '').lstrip('#')
+            _result['src'] = self.images.get(_binary_id, self.image_path + _binary_id)
+            _result.setdefault('alt', _attrib.get('title', ''))
+        elif element.tag == 'img' and self.xhtml:
+            _result.setdefault('alt', '')
+        if _classes:
+            _result['class'] = ' '.join(_classes)
+        return ''.join(f' {name}="{escape(value)}"' for name, value in _result.items())
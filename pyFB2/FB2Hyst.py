@@ -2,6 +2,8 @@
 import sqlite3
 from pyFB2.FB2ConvertBase import FB2ConvertBase
 from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Stats import track_file
+from pyFB2.HystDB import HystDB
 import os
 
 class FB2Hyst(FB2ConvertBase):
@@ -9,17 +11,25 @@ class FB2Hyst(FB2ConvertBase):
     Класс для преобразования файла FB2 в БД Hyst
     """
 
-    def __init__(self, database: str, name: str = None, css: str = None):
+    # главы пишутся прямо в БД database, промежуточная in-memory БД не нужна
+    use_hyst_db = False
+
+    def __init__(self, database: str = None, name: str = None, css: str = None, codec: str = None):
         """
         Конструктор класса FB2Hyst
-        :param database: Имя файла БД
+        :param database: Имя файла БД. None - БД не открывается, главы только отрисовываются
         :param name: Название БД
         :param css: Имя файла CSS
-        :param debug: Включать отладку (True|False)
+        :param codec: Алгоритм сжатия текста глав и CSS в БД, например 'zlib'. None - не сжимать
         """
-        super().__init__()
+        super().__init__(filename=None, css=css)
         self.database = database
-        self.css = css
+        self.name = name
+        self.hyst_db = HystDB(database, codec=codec) if database is not None else None
+        self.dbconn = self.hyst_db.connection if self.hyst_db is not None else None
+        # кэши на время импорта, чтобы не искать одних и тех же авторов и книги в БД
+        self.author_ids: dict[tuple, int] = {}  # (идентификатор ЗК, имя автора) -> идентификатор автора
+        self.book_ids: dict[tuple, int] = {}  # (идентификатор автора, название) -> идентификатор книги
 
     def merge_databases(self, src_db: str, dst_db: str, parent_id: int, notebook_id: int) -> int:
         """
@@ -28,22 +38,25 @@ class FB2Hyst(FB2ConvertBase):
 
         :param src_db      - БД - источник записей
         :param dst_db      - БД - приемник записей
-        :param root_id     - идентификатор корневой записи, под кторотой будут размещены перенесенные записи
-        :param notebook_id - идентификатор записной книжки
+        :param parent_id   - идентификатор записи, под которой будут размещены перенесенные записи. 0 - в корень
+        :param notebook_id - идентификатор записной книжки. None - записные книжки переносятся из источника
 
         """
-        try:
-            src_conn = sqlite3.connect(src_db)
-        except:
+        if not os.path.isfile(src_db):
             print('Ошибка: Не удалось соединиться с БД-источником {0}'.format(src_db))
             return 0
-
         try:
-            src_conn = sqlite3.connect(dst_db)
-        except:
-            src_conn.close()
+            dst = HystDB(dst_db)
+        except sqlite3.Error:
             print('Ошибка: Не удалось соединиться с БД-получателем {0}'.format(dst_db))
             return 0
+        try:
+            return dst.merge_database(src_db=src_db, parent_id=parent_id, notebook_id=notebook_id)
+        except sqlite3.Error as err:
+            print('Ошибка: Не удалось перенести записи из {0}: {1}'.format(src_db, err))
+            return 0
+        finally:
+            dst.close()
 
     def create_db(self, name: str = None) -> object:
         """
@@ -51,8 +64,7 @@ class FB2Hyst(FB2ConvertBase):
         :return:
         """
 
-        self.dbconn = sqlite3.connect(self.database)
-        self.create_tables()
+        # таблицы создает HystDB при открытии БД
         self.copy_css()
         if not name is None:
             cursor = self.dbconn.cursor()
@@ -99,11 +111,16 @@ class FB2Hyst(FB2ConvertBase):
         :param notebook_id: Идентификатор записной книжки
         :return:
         """
+        author_id = self.author_ids.get((notebook_id, author_name))
+        if author_id is not None:
+            return author_id
         ParentID = 0
-        cursor = self.dbconn.cursor()
-        sql = 'select min(id) as id from note where name = ? and NotebookID = ? and ParentID = ?'
-        for row in cursor.execute(sql, [author_name, notebook_id, ParentID]):
-            return row[0]
+        # запрос использует индекс idx_note_name (NotebookID, ParentID, Name)
+        sql = 'select min(id) as id from note where NotebookID = ? and ParentID = ? and name = ?'
+        author_id = self.dbconn.execute(sql, [notebook_id, ParentID, author_name]).fetchone()[0]
+        if author_id is not None:
+            self.author_ids[(notebook_id, author_name)] = author_id
+        return author_id
 
     def add_author(self, author_name: str, notebook_id: int) -> int:
         """
@@ -114,34 +131,47 @@ class FB2Hyst(FB2ConvertBase):
         """
         author_id = self.get_author_id(author_name=author_name, notebook_id=notebook_id)
         if author_id is None:
-            author_id = author_id = self.insert_note(title=author_name, parent_id=0, text=''.encode('utf-8'),
-                                                     notebook_id=notebook_id)
+            author_id = self.insert_note(title=author_name, parent_id=0, text=''.encode('utf-8'),
+                                         notebook_id=notebook_id)
+            self.author_ids[(notebook_id, author_name)] = author_id
             return author_id
         else:
             return author_id
 
     def get_book_id(self, title: str, author_id: int):
-        cursor = self.dbconn.cursor()
-        sql = 'select min(id) from note where ParentID = ? and name = ?'
-        for row in cursor.execute(sql, [author_id, title]):
-            return row[0]
+        """
+        Возвращает идентификатор книги автора по ее названию
+        :param title: Название книги
+        :param author_id: Идентификатор автора
+        :return: Идентификатор книги. None - если книги нет
+        """
+        book_id = self.book_ids.get((author_id, title))
+        if book_id is not None:
+            return book_id
+        # книга лежит в той же ЗК, что и автор, поэтому запрос использует индекс idx_note_name
+        sql = 'select min(id) from note where NotebookID = (select NotebookID from note where id = ?) ' \
+              'and ParentID = ? and name = ?'
+        book_id = self.dbconn.execute(sql, [author_id, author_id, title]).fetchone()[0]
+        if book_id is not None:
+            self.book_ids[(author_id, title)] = book_id
+        return book_id
 
     def get_book_cover(self) -> str:
         """
          Формирует обложку книги.
-        :return: Тело обложки книги
-        :TODO: 1. Иногда изображения обложки выглядят так <img src=db://thisdb.note_image.image.None>
-               2. Некрасиво сделано сцепление строк - переписать
+        Документ не закрывается: к нему дописываются секции без заголовка, см. close_parent_notes.
+        :return: Начало документа обложки книги
+        :TODO: Некрасиво сделано сцепление строк - переписать
         """
-        cursor = self.dbconn.cursor()
-        sql = 'select min(id) from note_image where book_id=? and ShortDescr=?'
-        for row in cursor.execute(sql, [self.root_id, self.parser.cover_page]):
-            cover_image = '<img src="db://thisdb.note_image.image.{0}">'.format(row[0])
+        cover_image = ''
+        _cover = self.images.get(self.parser.cover_page)
+        if _cover is not None:
+            cover_image = '<img src="{0}">'.format(self.image_src(_cover))
         result = self.replace_css(self.html_header, self.css)
         result = result.replace('$title$', self.parser.title)
+        result = result + '<body>'
         result = result + cover_image
         result = result + self.parser.annotation
-        result = result + '</body></html>'
         return result
 
     def update_note(self, note_id: int, text: bytes):
@@ -151,10 +181,7 @@ class FB2Hyst(FB2ConvertBase):
         :param text:
         :return:
         """
-        cursor = self.dbconn.cursor()
-        sql = 'update note set text = ? where id = ?'
-        cursor.execute(sql, [text, note_id])
-        self.dbconn.commit()
+        self.hyst_db.update_note_text(note_id=note_id, text=text)
 
     def add_book(self, filename: str, author_id: int, notebook_id: int) -> int:
         """
@@ -175,11 +202,16 @@ class FB2Hyst(FB2ConvertBase):
             return book_id
 
 
+        # документы, не закрытые при ошибке в предыдущей книге, к этой книге не относятся
+        self._open_notes.clear()
+        self._note_titles.clear()
         self.root_id = self.insert_note(self.parser.title, author_id, '', notebook_id)
         book_id = self.root_id
+        self.book_ids[(author_id, self.parser.title)] = book_id
+        self.build_link_index(self.root_id)
         self.insert_images(book_id=book_id)
 
-        self.update_note(note_id=self.root_id, text=self.get_book_cover())
+        self.open_note(self.root_id, self.get_book_cover())
 
         for body in self.parser.bodies:
             if self.parser.is_body_notes(body):
@@ -187,36 +219,26 @@ class FB2Hyst(FB2ConvertBase):
                     sections = body.findall('./section')
                     sections_count = len(sections)
                     if sections_count > 3:
-                        #
-                        # Анализ примечаний
-                        # Здесь это временно, нужно вынести в отдельную функцию
-                        #
-                        for section in sections:
-                            try:
-                                id = section.attrib['id']
-                                cursor = self.dbconn.cursor()
-                                cursor.execute('insert into links (link_id) values (?)', [id])
-                                self.dbconn.commit()
-                            except:
-                                pass
-
                         self.insert_note(title='Примечания', parent_id=self.root_id,
-                                         #text=ElementTree.tostring(body, 'utf-8'), notebook_id=notebook_id)
-                                         text=body, notebook_id=notebook_id)
+                                         text=self.render_section(body, 1, 'Примечания'), notebook_id=notebook_id)
                     else:
                         for section in sections:
-                            self.insert_note(title=self.get_titles_str(section), parent_id=self.root_id,
-                                             #text=ElementTree.tostring(section, 'utf-8'),
-                                             text=section,
+                            title = self.get_titles_str(section)
+                            self.insert_note(title=title, parent_id=self.root_id,
+                                             text=self.render_section(section, 1, title),
                                              notebook_id=notebook_id)
 
                 else:
-                    self.insert_note(title=self.get_titles_str(body), parent_id=self.root_id,
-                                     text=body,
+                    title = self.get_titles_str(body)
+                    self.insert_note(title=title, parent_id=self.root_id,
+                                     text=self.render_section(body, 1, title),
                                      notebook_id=notebook_id)
             else:
-                self.insert_child_sections(body, self.root_id,
+                self.insert_body_sections(body, self.root_id,
                                            notebook_id)  # перебор всех секций, 0 - идентификатор тела как корневого узла
+        self.close_parent_notes()
+        if self.hyst_db is not None:
+            self.hyst_db.flush_note_text()
         return book_id
 
     def add_book_ext(self, filename: str, notebook_id: int) -> int:
@@ -226,36 +248,42 @@ class FB2Hyst(FB2ConvertBase):
         :param notebook_id: К какой ЗК добавить
         :return:  Идентификатор добавленного узла
         """
-        self.parser = FB2Parser(filename=filename, check_schema=False)
-        author = '{0} {1} {2}'.format(self.parser.author_last_name(), self.parser.author_first_name(),
-                                      self.parser.author_middle_name()).strip(' ')
-        author_id = self.add_author(author, notebook_id)
-        return self.add_book(filename=filename, author_id=author_id, notebook_id=notebook_id)
+        with track_file(filename):
+            self.parser = FB2Parser(filename=filename, check_schema=False)
+            author = '{0} {1} {2}'.format(self.parser.author_last_name(), self.parser.author_first_name(),
+                                          self.parser.author_middle_name()).strip(' ')
+            # вся книга вставляется в одной транзакции
+            # индексы не откладываются: по ним ищутся авторы и книги
+            _authors_count, _books_count = len(self.author_ids), len(self.book_ids)
+            try:
+                with self.hyst_db.bulk(defer_indexes=False):
+                    author_id = self.add_author(author, notebook_id)
+                    return self.add_book(filename=filename, author_id=author_id, notebook_id=notebook_id)
+            except Exception:
+                # транзакция откачена: записи, добавленные в кэши внутри нее, больше не существуют
+                self._forget_cached(self.author_ids, _authors_count)
+                self._forget_cached(self.book_ids, _books_count)
+                raise
+
+    @staticmethod
+    def _forget_cached(cache: dict, count: int):
+        """ Удаляет из кэша записи, добавленные после первых count (словарь хранит порядок добавления) """
+        for key in list(cache)[count:]:
+            del cache[key]
 
     def copy_css(self) -> bool:
         """
         Копирование файла CSS в БД
         :return: True если все прошло удачно
-        :TODO: Более информативные сообщения
         """
-        print(' -> copy_css')
         if self.css is None:
-            print('     css is None')
             return True
         if not os.path.isfile(self.css):
-            print('     not is file')
             return False
-        print('     open file')
         with open(self.css, 'rb') as f:
             css_text = f.read()
-            f.close()
-        print('     cursor')
-        cursor = self.dbconn.cursor()
-        sql = 'insert into CSS (name, code, filename, css) values (?, ?, ?, ?)'
-        cursor.execute(sql, [self.css_filename, self.css_filename, self.css_filename, sqlite3.Binary(css_text)])
-        print('     insert')
-        self.dbconn.commit()
-        cursor.close()
+        self.hyst_db.insert_css(self.css_filename, self.css_filename, self.css_filename, css_text)
+        return True
 
     def replace_css(self, text: bytes, css: bytes) -> bytes:
         return text.replace('$CSS$', 'db://thisdb.css.css.1')
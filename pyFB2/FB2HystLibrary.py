@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+from pyFB2.FB2Hyst import FB2Hyst
+from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Types import ImageRef
+
+# Метки, которые процесс-исполнитель ставит вместо идентификаторов изображений и глав:
+# настоящие идентификаторы назначает только процесс, записывающий в БД
+PLACEHOLDER = re.compile(r'\$(image|note):(\d+)\$')
+
+
+class _HystBookCollector(FB2Hyst):
+    """
+    Отрисовка книги для БД Hyst без обращения к БД: главы и изображения собираются в списки
+    с локальными идентификаторами (с 1), а ссылки на них заменяются метками $image:N$ и $note:N$.
+    """
+
+    def __init__(self, check_schema: bool = False):
+        super().__init__(database=None)
+        self.check_schema = check_schema
+        self.notes: list[list] = []  # [локальный id, локальный id родителя, SeqNo, заголовок, текст]
+        self.book_images: list[tuple] = []  # (короткое описание, изображение)
+
+    def image_src(self, image: ImageRef) -> str:
+        return f'$image:{image.stored_id}$'
+
+    def note_href(self, note_id: int, anchor: str = '') -> str:
+        return f'$note:{note_id}$' + (f'#{anchor}' if anchor else '')
+
+    def get_book_id(self, title: str, author_id: int):
+        # наличие книги проверяет процесс, записывающий в БД
+        return None
+
+    def insert_note(self, title: str, parent_id: int, text, notebook_id: int) -> int:
+        self.notes.append([len(self.notes) + 1, parent_id, self.counter, title, text])
+        return len(self.notes)
+
+    def update_note(self, note_id: int, text):
+        self.notes[note_id - 1][4] = text
+
+    def append_note_text(self, note_id: int, text: str):
+        self.notes[note_id - 1][4] += text
+
+    def insert_image(self, short_descr: str, image: bytes) -> int:
+        self.book_images.append((short_descr, image))
+        return len(self.book_images)
+
+
+def _render_book(task: dict) -> dict:
+    """
+    Разбор и отрисовка одной книги в процессе-исполнителе.
+    Ошибки перехватываются, чтобы одна испорченная книга не останавливала импорт остальных.
+    :param task: Описание задания: source, check_schema
+    :return: Результат: source, status ('ok' или 'failed'), error, title, author, notes, images, seconds
+    """
+    _start = time.perf_counter()
+    _result = {"source": task["source"], "status": "ok", "error": None, "title": "", "author": "",
+               "notes": [], "images": [], "seconds": 0.0}
+    try:
+        _book = _HystBookCollector(check_schema=task["check_schema"])
+        _book.parser = FB2Parser(filename=task["source"], check_schema=task["check_schema"])
+        _result["title"] = _book.parser.title or ""
+        _result["author"] = ' '.join(filter(None, [_book.parser.author_last_name(), _book.parser.author_first_name(),
+                                                   _book.parser.author_middle_name()]))
+        # корневой узел книги получает родителя 0, настоящего автора подставит процесс записи
+        _book.add_book(filename=task["source"], author_id=0, notebook_id=0)
+        _result["notes"] = _book.notes
+        _result["images"] = _book.book_images
+    except Exception as err:
+        _result["status"] = "failed"
+        _result["error"] = f'{type(err).__name__}: {err}'
+    _result["seconds"] = time.perf_counter() - _start
+    return _result
+
+
+class FB2HystLibrary:
+    """
+    Параллельный импорт библиотеки FB2 в одну БД Hyst.
+
+    Книги разбираются и отрисовываются в пуле процессов, а результаты по мере готовности передаются
+    единственному процессу записи, который вставляет их в БД пакетами (HystDB.bulk). Исполнители не
+    обращаются к БД: идентификаторы глав и изображений назначаются при записи, и метки в тексте глав
+    заменяются настоящими ссылками. Ошибка в одной книге не влияет на остальные.
+    """
+
+    def __init__(self, database: str, notebook: str = 'Библиотека', css: str = None, jobs: int = None,
+                 check_schema: bool = False, debug: bool = False, commit_every: int = 100, unsafe: bool = False,
+                 codec: str = None):
+        """
+        Конструктор класса
+
+        :param database: Имя файла БД Hyst
+        :param notebook: Записная книжка, в которую добавляются книги
+        :param css: Файл CSS. Записывается в БД, если его там еще нет
+        :param jobs: Количество процессов. По умолчанию - по числу процессоров
+        :param check_schema: Проверять файлы FB2 на соответствие схеме
+        :param debug: Выводить сообщения о каждой книге
+        :param commit_every: Количество книг в одной транзакции
+        :param unsafe: Быстрые, но небезопасные настройки БД на время импорта (см. HystDB.bulk)
+        :param codec: Алгоритм сжатия текста глав и CSS, например 'zlib'. None - не сжимать
+        """
+        self.hyst = FB2Hyst(database=database, css=css, codec=codec)
+        self.hyst_db = self.hyst.hyst_db
+        self.notebook = notebook
+        self.jobs = jobs if jobs else os.cpu_count() or 1
+        self.check_schema = check_schema
+        self.debug = debug
+        self.commit_every = max(1, commit_every)
+        self.unsafe = unsafe
+
+    def close(self):
+        self.hyst_db.close()
+
+    def import_dir(self, start_dir: str, recursive: bool = True, progress=None) -> dict:
+        """
+        Импортирует все файлы FB2 из каталога.
+        :param start_dir: Каталог с файлами FB2
+        :param recursive: Искать файлы в подкаталогах
+        :param progress: Функция, которая вызывается после записи каждой книги, см. import_files
+        :return: Итоги импорта, см. import_files
+        """
+        _mask = '**/*.fb2' if recursive else '*.fb2'
+        return self.import_files((str(item) for item in sorted(Path(start_dir).glob(_mask))), progress)
+
+    def import_files(self, files, progress=None) -> dict:
+        """
+        Импортирует файлы FB2.
+        :param files: Итератор по именам файлов
+        :param progress: Функция, которая вызывается после записи каждой книги с двумя аргументами:
+                         имя файла и состояние ('ok', 'skipped' или 'failed')
+        :return: Итоги: books, imported, skipped, failed, seconds, books_per_second, errors
+        """
+        _start = time.perf_counter()
+        _summary = {"books": 0, "imported": 0, "skipped": 0, "failed": 0, "errors": []}
+        if self.hyst.css is not None and self.hyst_db.connection.execute('select count(1) from css').fetchone()[0] == 0:
+            if not self.hyst.copy_css():
+                print(f'Ошибка: Не удалось скопировать CSS {self.hyst.css}')
+        _notebook_id = self.hyst.add_notebook(self.notebook, '')
+        _results = self._render_all({"source": source, "check_schema": self.check_schema} for source in files)
+        _done = False
+        while not _done:
+            _done = True
+            with self.hyst_db.bulk(defer_indexes=False, unsafe=self.unsafe):
+                for _count, result in enumerate(_results, start=1):
+                    _summary["books"] += 1
+                    _status = self._write_book(result, _notebook_id) if result["status"] == "ok" else result["status"]
+                    if self.debug:
+                        print(f'  {_status}: {result["source"]} ({result["seconds"]:.2f} с)')
+                    if progress is not None:
+                        progress(result["source"], _status)
+                    if _status == "ok":
+                        _summary["imported"] += 1
+                    elif _status == "skipped":
+                        _summary["skipped"] += 1
+                    else:
+                        _summary["failed"] += 1
+                        _summary["errors"] += [{"source": result["source"], "error": result["error"]}]
+                    if _count >= self.commit_every:
+                        _done = False
+                        break
+        _summary["seconds"] = time.perf_counter() - _start
+        _summary["books_per_second"] = _summary["imported"] / max(_summary["seconds"], 1e-9)
+        return _summary
+
+    def _render_all(self, tasks):
+        """
+        Отрисовывает книги в пуле процессов. Одновременно в работе не больше jobs * 2 книг,
+        поэтому очередь готовых результатов не растет, даже если запись в БД отстает.
+        :return: Итератор по результатам _render_book в порядке готовности
+        """
+        _tasks = iter(tasks)
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            _running = set()
+            while True:
+                for task in _tasks:
+                    _running.add(pool.submit(_render_book, task))
+                    if len(_running) >= self.jobs * 2:
+                        break
+                if not _running:
+                    return
+                _finished, _running = wait(_running, return_when=FIRST_COMPLETED)
+                for future in _finished:
+                    yield future.result()
+
+    def _write_book(self, result: dict, notebook_id: int) -> str:
+        """
+        Записывает отрисованную книгу в БД в отдельной точке сохранения: при ошибке
+        откатывается только эта книга.
+        :return: Состояние: 'ok', 'skipped' или 'failed'
+        """
+        _conn = self.hyst_db.connection
+        _conn.execute('savepoint book')
+        try:
+            # авторы и книги кэшируются в FB2Hyst на время импорта
+            _author_id = self.hyst.add_author(result["author"], notebook_id)
+            if self.hyst.get_book_id(title=result["title"], author_id=_author_id) is not None:
+                _conn.execute('release book')
+                return "skipped"
+            _image_ids = self.hyst_db.insert_images(result["images"])
+            # главы книги получают идентификаторы подряд, начиная со следующего свободного
+            _row = _conn.execute("select seq from sqlite_sequence where name = 'note'").fetchone()
+            _first_id = (_row[0] if _row is not None else 0) + 1
+
+            def _replace(match: re.Match) -> str:
+                if match.group(1) == 'image':
+                    return f'db://thisdb.note_image.image.{_image_ids[int(match.group(2)) - 1]}'
+                return f'db://thisdb.note.text.{_first_id + int(match.group(2)) - 1}'
+
+            self.hyst_db.insert_notes(
+                (_first_id + local_id - 1, _author_id if parent_id == 0 else _first_id + parent_id - 1, notebook_id,
+                 seq_no, title, PLACEHOLDER.sub(_replace, text) if isinstance(text, str) else text)
+                for local_id, parent_id, seq_no, title, text in result["notes"])
+            self.hyst.book_ids[(_author_id, result["title"])] = _first_id
+            _conn.execute('release book')
+            return "ok"
+        except Exception as err:
+            _conn.execute('rollback to book')
+            _conn.execute('release book')
+            # автор мог быть создан в откаченной точке сохранения
+            self.hyst.author_ids.pop((notebook_id, result["author"]), None)
+            result["error"] = f'{type(err).__name__}: {err}'
+            return "failed"
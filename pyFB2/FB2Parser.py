@@ -1,4 +1,6 @@
+import functools
 import importlib.resources
+import io
 import json
 import os
 from xml.etree import ElementTree
@@ -6,46 +8,107 @@ from xml.etree.ElementTree import Element
 
 import xmlschema
 
+from pyFB2.FB2Stats import add_counter, get_stats, stage
+
+
+@functools.lru_cache(maxsize=1)
+def get_schema() -> xmlschema.XMLSchema:
+    """
+    Возвращает схему XSD FictionBook. Схема компилируется один раз на процесс.
+    """
+    return xmlschema.XMLSchema(
+        os.path.join(str(importlib.resources.files(__package__).joinpath("resources")), "FictionBook.xsd"))
+
 
 class FB2Parser:
     """Класс для разбора файла FB2"""
-    def __init__(self, filename: str, check_schema=False):
+    def __init__(self, filename: str, check_schema=False, metadata_only=False, stream=None):
         """
         Конструктор класса.
         :rtype: object
         :param filename: Имя файла FB2
         :param check_schema: Проверять файл FB2 на соответствие схеме
         :type check_schema: bool
+        :param metadata_only: Читать только элемент description. Остаток файла не читается и не разбирается,
+                              тела книги (bodies) и бинарники при этом недоступны.
+        :type metadata_only: bool
+        :param stream: Открытый двоичный поток с содержимым FB2, например член архива ZIP.
+                       Если передан, то файл filename не открывается, а имя используется только для сообщений.
         """
 
-        if not os.path.isfile(filename):
+        if stream is None and not os.path.isfile(filename):
             raise FileNotFoundError(f"Файл {filename} не найден.")
 
         self._filename = filename
+        self._stream = stream
 
         if check_schema:
-            self.check_schema()
-
-        self.root = ElementTree.parse(filename).getroot()
-
-        self.cleanup()
+            with stage('parse.schema'):
+                self.check_schema()
+
+        source = filename if self._stream is None else self._stream
+        with stage('parse.xml'):
+            if metadata_only:
+                self.root = self._parse_description(source)
+            else:
+                self.root = ElementTree.parse(source).getroot()
+        if get_stats() is not None:
+            add_counter('parse.files')
+            if self._stream is None and not metadata_only:
+                add_counter('parse.bytes', os.path.getsize(filename))
+
+        with stage('parse.cleanup'):
+            self.cleanup()
         self.bodies = self.root.findall('./body')
         self._description = self.root.find('./description')
         self._title_info = self._description.find('./title-info')
         self._document_info = self._description.find('./document-info')
         self._publish_info = self._description.find('./publish-info')
 
+    @staticmethod
+    def _parse_description(source, chunk_size: int = 16384) -> Element:
+        """
+        Разбирает файл до закрывающего тэга description и возвращает корневой элемент,
+        в котором есть только description. Файл читается порциями по chunk_size байт,
+        поэтому для большой книги читаются только первые несколько килобайт.
+        :param source: Имя файла или открытый двоичный поток
+        :param chunk_size: Размер порции в байтах
+        :return: Корневой элемент FictionBook
+        """
+        _file = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+        try:
+            _parser = ElementTree.XMLPullParser(events=('start', 'end'))
+            _root = None
+            while _chunk := _file.read(chunk_size):
+                _parser.feed(_chunk)
+                for event, element in _parser.read_events():
+                    if _root is None:
+                        _root = element
+                    if event == 'end' and element.tag.partition('}')[-1] == 'description':
+                        return _root
+            return _root
+        finally:
+            if _file is not source:
+                _file.close()
+
     def cleanup(self):
-        for element in self.root.iter():
+        _count = 0
+        for _count, element in enumerate(self.root.iter(), start=1):
             element.tag = element.tag.partition('}')[-1]
+        add_counter('parse.elements', _count)
 
     def check_schema(self):
         """
         Проверка файла на соответствие схеме XSD
         """
-        xsd = xmlschema.XMLSchema(
-            os.path.join(str(importlib.resources.files(__package__).joinpath("resources")), "FictionBook.xsd"))
-        xsd.validate(source=self.filename)
+        xsd = get_schema()
+        if self._stream is None:
+            xsd.validate(source=self.filename)
+        else:
+            # поток можно прочитать только один раз, поэтому проверяем копию в памяти
+            _data = self._stream.read()
+            xsd.validate(source=io.BytesIO(_data))
+            self._stream = io.BytesIO(_data)
 
     @property
     def filename(self) -> str:
@@ -2,13 +2,18 @@
 import os
 import re
 import string
+import zipfile
 
 from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Stats import stage
+from pyFB2.FB2Zip import UnzipFB2, rename_member
 
 
 class FB2Renamer:
     """
     Класс для переименования ОДНОГО файла FB2 на основе шаблона.
+    Поддерживаются также архивы .fb2.zip: сведения о книге читаются из начала члена архива
+    без распаковки всей книги, а архив переименовывается без перепаковки.
 
     \nВ состав шаблона могут входить:
     \n**${AL}** - Фамилия автора  - верхний регистр
@@ -32,32 +37,58 @@ class FB2Renamer:
     :param template: Шаблон переименования
     :param outdir: дополнительный каталог в форме шаблона
     :param debug: выводить отладочные сообщения
+    :param rename_member: для архива .fb2.zip переименовывать также файл FB2 внутри архива
     """
 
-    def __init__(self, filename: str, template: str, outdir: str = '', debug: bool = False):
+    def __init__(self, filename: str, template: str, outdir: str = '', debug: bool = False,
+                 rename_member: bool = False):
         """
         Конструктор класса для переименования файла FB2 по шаблону
 
-        :param filename: Имя файла FB2
+        :param filename: Имя файла FB2 или архива .fb2.zip
         :param template: Шаблон переименования
         :param outdir
+        :param rename_member: Для архива переименовывать также файл FB2 внутри архива
         """
         self.debug = debug
         self.filename = filename
-        self._get_fb2_properties()  # получить свойства FB2-файла
+        self.rename_member = rename_member
+        self.is_zip = str(filename).lower().endswith('.zip')
+        self.member_name = None  # имя файла FB2 внутри архива
+        with stage('rename.read'):
+            self._get_fb2_properties()  # получить свойства FB2-файла
         self.outdir = self._process_template(outdir)  #
         self.new_path = os.path.join(os.path.split(os.path.abspath(filename))[0], self.outdir)
-        self.new_filename = '{0}.fb2'.format(self._process_template(template))
+        self.new_member_name = '{0}.fb2'.format(self._process_template(template))
+        self.new_filename = f'{self.new_member_name}.zip' if self.is_zip else self.new_member_name
 
     def rename(self) -> str:
         """
-        Выполняет переименование файла
+        Выполняет переименование файла.
+        Для архива сначала перемещается сам архив, затем переименовывается файл FB2 внутри него.
+        Если переименовать файл внутри архива не удалось, архив возвращается на прежнее место.
         """
         os.makedirs(self.new_path, exist_ok=True)
+        _target = os.path.join(self.new_path, self.new_filename)
         try:
-            os.rename(self.filename, os.path.join(self.new_path, self.new_filename))
-        except:
-            raise RuntimeError(f'Ошибка: Не удалось переименовать [{self.filename}] в [{self.new_filename}]')
+            with stage('rename.move'):
+                # архив перезаписывается уже на новом месте, при ошибке перемещения исходный файл остается нетронутым
+                os.rename(self.filename, _target)
+        except Exception as err:
+            raise RuntimeError(f'Ошибка: Не удалось переименовать [{self.filename}] в [{self.new_filename}]') from err
+
+        if self.is_zip and self.rename_member and self.member_name != self.new_member_name:
+            try:
+                with stage('rename.member'):
+                    rename_member(_target, self.member_name, self.new_member_name)
+            except Exception as err:
+                try:
+                    os.rename(_target, self.filename)
+                except OSError:
+                    raise RuntimeError(f'Ошибка: Архив переименован в [{self.new_filename}], но файл '
+                                       f'[{self.member_name}] внутри него не переименован') from err
+                raise RuntimeError(f'Ошибка: Не удалось переименовать [{self.member_name}] в архиве '
+                                   f'[{self.filename}], архив оставлен под прежним именем') from err
 
         return self.new_filename
 
@@ -66,7 +97,17 @@ class FB2Renamer:
         Выполняет извлечение свойств FB2 файла
         :TODO: Что делать, если авторов несколько?
         """
-        parser = FB2Parser(filename=self.filename, check_schema=False)
+        if self.is_zip:
+            # Из архива читаем только начало первого файла FB2 - до конца description
+            with zipfile.ZipFile(self.filename, 'r') as archive:
+                info = next((info for info in archive.infolist() if UnzipFB2.is_fb2_member(info)), None)
+                if info is None:
+                    raise ValueError(f'Ошибка: В архиве {self.filename} нет файлов FB2')
+                self.member_name = info.filename
+                with archive.open(info) as stream:
+                    parser = FB2Parser(filename=self.filename, metadata_only=True, stream=stream)
+        else:
+            parser = FB2Parser(filename=self.filename, check_schema=False, metadata_only=True)
 
         self.S = parser.sequence_name
         self.SN = parser.sequence_number
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import heapq
+import io
+import itertools
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+_NULL_CONTEXT = nullcontext()
+_current = None  # включенный сборщик статистики. None - статистика не собирается
+
+
+def get_stats() -> 'FB2Stats':
+    """ Включенный сборщик статистики. None - если статистика не собирается """
+    return _current
+
+
+def stage(name: str):
+    """
+    Замер времени этапа обработки::
+
+        with stage('parse.xml'):
+            ...
+
+    Если статистика не собирается, то возвращается пустой контекст и замер почти ничего не стоит.
+    :param name: Название этапа
+    """
+    return _NULL_CONTEXT if _current is None else _StageTimer(_current, name)
+
+
+def add_counter(name: str, value: int = 1):
+    """
+    Увеличивает счетчик, например количество прочитанных байтов или элементов
+    :param name: Название счетчика
+    :param value: Величина увеличения
+    """
+    if _current is not None:
+        _current.add(name, value)
+
+
+def track_file(filename, size: int = None):
+    """
+    Замер обработки одного файла. Этапы, выполненные внутри блока with, учитываются и для файла,
+    самые медленные файлы попадают в отчет. Вложенные вызовы для того же потока не создают новый замер.
+    :param filename: Имя файла
+    :param size: Размер файла в байтах. None - определяется по файлу
+    """
+    return _NULL_CONTEXT if _current is None else _current.track_file(filename, size)
+
+
+class _StageTimer:
+    """ Замер времени одного этапа """
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats: 'FB2Stats', name: str):
+        self.stats = stats
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class FB2Stats:
+    """
+    Сборщик статистики обработки: время этапов, счетчики и самые медленные файлы.
+
+    По умолчанию статистика не собирается. Сбор включается на время блока with (или методом enable)
+    и охватывает все модули pyFB2 в текущем процессе: FB2Parser, FB2ConvertBase и его наследников, HystDB,
+    FB2DirScaner и классы переименования. Процессы-исполнители пулов статистику не собирают.
+
+    Пример::
+
+        with FB2Stats(outliers=5, profile=True) as stats:
+            FB2GroupRenamer('C:/Downloads/Книги', '', '${Al} ${Af} - ${Tt}').rename_all()
+        print(stats.report())
+        print(stats.profile_text())
+    """
+
+    def __init__(self, outliers: int = 10, callback=None, profile: bool = False, memory: bool = False):
+        """
+        Конструктор класса
+        :param outliers: Количество самых медленных файлов в отчете
+        :param callback: Функция, которая вызывается после обработки каждого файла со сведениями о нем
+                         (словарь file, bytes, seconds, stages, error)
+        :param profile: Профилировать текущий поток с помощью cProfile
+        :param memory: Отслеживать выделение памяти с помощью tracemalloc
+        """
+        self.outliers = outliers
+        self.callback = callback
+        self.profile = profile
+        self.memory = memory
+        self.stages: dict[str, list] = {}  # этап -> [количество, секунды, максимум секунд]
+        self.counters: dict[str, int] = {}  # счетчик -> значение
+        self.files = 0
+        self.file_errors = 0
+        self.file_seconds = 0.0
+        self._slowest: list[tuple] = []  # куча (секунды, номер, сведения о файле)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # файл, обрабатываемый потоком
+        self._profiler: cProfile.Profile = None
+        self._tracemalloc_started = False
+        self._memory: dict = None
+        self._start = 0.0
+        self._seconds = 0.0
+
+    def __enter__(self) -> 'FB2Stats':
+        return self.enable()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disable()
+        return False
+
+    def enable(self) -> 'FB2Stats':
+        """ Включает сбор статистики. Предыдущий сборщик, если он был, отключается """
+        global _current
+        if _current is not None and _current is not self:
+            _current.disable()
+        self._start = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc_started = True
+        if self.profile:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        _current = self
+        return self
+
+    def disable(self) -> 'FB2Stats':
+        """ Отключает сбор статистики. Собранные данные сохраняются """
+        global _current
+        if _current is self:
+            _current = None
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self.memory and tracemalloc.is_tracing():
+            _current_size, _peak = tracemalloc.get_traced_memory()
+            _top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            self._memory = {"current": _current_size, "peak": _peak, "top": [str(item) for item in _top]}
+            if self._tracemalloc_started:
+                tracemalloc.stop()
+                self._tracemalloc_started = False
+        self._seconds += time.perf_counter() - self._start
+        return self
+
+    def add_time(self, name: str, seconds: float):
+        """ Добавляет время этапа """
+        with self._lock:
+            _stage = self.stages.get(name)
+            if _stage is None:
+                self.stages[name] = [1, seconds, seconds]
+            else:
+                _stage[0] += 1
+                _stage[1] += seconds
+                if seconds > _stage[2]:
+                    _stage[2] = seconds
+        _file = getattr(self._local, 'file', None)
+        if _file is not None:
+            _file["stages"][name] = _file["stages"].get(name, 0.0) + seconds
+
+    def add(self, name: str, value: int = 1):
+        """ Увеличивает счетчик """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def track_file(self, filename, size: int = None):
+        """ Замер обработки одного файла, см. функцию track_file """
+        if getattr(self._local, 'file', None) is not None:
+            yield self._local.file
+            return
+        if size is None:
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+        _file = {"file": str(filename), "bytes": size, "seconds": 0.0, "stages": {}, "error": None}
+        self._local.file = _file
+        _start = time.perf_counter()
+        try:
+            yield _file
+        except Exception as err:
+            _file["error"] = f'{type(err).__name__}: {err}'
+            raise
+        finally:
+            _file["seconds"] = time.perf_counter() - _start
+            self._local.file = None
+            self._add_file(_file)
+
+    def _add_file(self, file: dict):
+        with self._lock:
+            self.files += 1
+            self.file_seconds += file["seconds"]
+            if file["error"] is not None:
+                self.file_errors += 1
+            _item = (file["seconds"], next(self._sequence), file)
+            if len(self._slowest) < self.outliers:
+                heapq.heappush(self._slowest, _item)
+            elif self.outliers > 0 and _item[0] > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, _item)
+        if self.callback is not None:
+            self.callback(file)
+
+    def report(self) -> dict:
+        """
+        Отчет о собранной статистике
+        :return: Словарь: seconds, stages (count, seconds, mean, max для каждого этапа), counters,
+                 files (count, errors, seconds, slowest), memory (если включено отслеживание памяти)
+        """
+        _seconds = self._seconds + (time.perf_counter() - self._start if _current is self else 0.0)
+        with self._lock:
+            _report = {
+                "seconds": _seconds,
+                "stages": {name: {"count": item[0], "seconds": item[1], "mean": item[1] / item[0], "max": item[2]}
+                           for name, item in sorted(self.stages.items(), key=lambda pair: -pair[1][1])},
+                "counters": dict(sorted(self.counters.items())),
+                "files": {"count": self.files, "errors": self.file_errors, "seconds": self.file_seconds,
+                          "slowest": [item[2] for item in sorted(self._slowest, reverse=True)]}}
+        if self._memory is not None:
+            _report["memory"] = self._memory
+        return _report
+
+    def profile_text(self, limit: int = 25, sort: str = 'cumulative') -> str:
+        """
+        Итоги профилирования cProfile
+        :param limit: Количество функций в выводе
+        :param sort: Порядок сортировки, см. pstats.Stats.sort_stats
+        :return: Текст отчета. Пустая строка, если профилирование не включено
+        """
+        if self._profiler is None:
+            return ''
+        _text = io.StringIO()
+        pstats.Stats(self._profiler, stream=_text).sort_stats(sort).print_stats(limit)
+        return _text.getvalue()
@@ -1,3 +1,7 @@
+from typing import NamedTuple
+from xml.etree.ElementTree import Element
+
+
 class Author:
     def __init__(self, firstname: str, middlename: str, lastname: str, nickname: str, homepage: str, email: str):
         self.firstName = firstname
@@ -66,4 +70,28 @@ class DocumentInfo:
                 "publisher": self.publisher}
 
 class PublishInfo:
-    pass
\ No newline at end of file
+    pass
+
+
+class ImageRef(NamedTuple):
+    """Сведения о бинарнике (изображении) книги после его сохранения"""
+    binary_id: str        # идентификатор бинарника в FB2, например cover.jpg
+    stored_id: int        # идентификатор в таблице NOTE_IMAGE. None - если в БД не записано
+    path: str             # путь к файлу на диске. None - если на диск не записано
+    content_type: str     # тип MIME, например image/jpeg
+    width: int            # ширина в пикселях. 0 - если определить не удалось
+    height: int           # высота в пикселях. 0 - если определить не удалось
+    digest: str = ''      # хэш бинарника в хранилище FB2BlobStore. Пустая строка - если хранилище не используется
+
+
+class OutlineItem(NamedTuple):
+    """Элемент оглавления книги: секция с заранее вычисленными уровнем и порядковым номером"""
+    index: int            # номер элемента в оглавлении
+    parent: int           # номер родительского элемента в оглавлении. -1 - корневой узел
+    section_id: str       # атрибут id секции. Пустая строка - если атрибута нет
+    level: int            # уровень вложенности секции
+    seq_no: int           # порядковый номер статьи для упорядочивания в дереве
+    title: str            # заголовок секции
+    flat: bool            # секция не имеет подсекций
+    untitled: bool        # секция не имеет заголовка
+    section: Element      # сама секция
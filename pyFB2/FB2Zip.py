@@ -1,40 +1,333 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+import struct
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Локальный заголовок члена архива ZIP: сигнатура, версия, флаги, метод сжатия, время, дата,
+# CRC, сжатый размер, исходный размер, длина имени, длина дополнительного поля
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# Запись центрального каталога и запись конца центрального каталога
+CENTRAL_HEADER = struct.Struct('<4s4B4H3L5H2L')
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD_SIGNATURE = b'PK\x05\x06'
+# Флаги члена архива: данные сопровождаются дескриптором, имя в кодировке UTF-8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+def member_data_offset(buffer, header_offset: int) -> int:
+    """
+    Возвращает смещение сжатых данных члена архива по смещению его локального заголовка.
+    :param buffer: Содержимое архива (bytes, mmap или memoryview)
+    :param header_offset: Смещение локального заголовка (ZipInfo.header_offset)
+    :return: Смещение первого байта сжатых данных
+    """
+    _header = LOCAL_HEADER.unpack_from(buffer, header_offset)
+    if _header[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f'Неверная сигнатура локального заголовка по смещению {header_offset}')
+    return header_offset + LOCAL_HEADER.size + _header[9] + _header[10]
+
+
+def decompress_member(data, compress_type: int, crc: int) -> bytes:
+    """
+    Распаковывает сжатые данные одного члена архива и проверяет CRC.
+    :param data: Сжатые данные
+    :param compress_type: Метод сжатия (ZIP_STORED или ZIP_DEFLATED)
+    :param crc: Ожидаемый CRC распакованных данных
+    :return: Распакованные данные
+    :raises ValueError: Метод сжатия не поддерживается, такой член архива читается через zipfile
+    """
+    if compress_type == zipfile.ZIP_STORED:
+        _result = bytes(data)
+    elif compress_type == zipfile.ZIP_DEFLATED:
+        _result = zlib.decompress(data, -zlib.MAX_WBITS)
+    else:
+        raise ValueError(f'Метод сжатия {compress_type} не поддерживается')
+    if zlib.crc32(_result) != crc:
+        raise zipfile.BadZipFile('Неверный CRC распакованных данных')
+    return _result
+
+
+def rename_member(filename: str, old_name: str, new_name: str, buffer_size: int = 1024 * 1024) -> bool:
+    """
+    Переименовывает член архива без перепаковки: сжатые данные копируются как есть,
+    заново записываются только заголовки и центральный каталог.
+    :param filename: Имя архива
+    :param old_name: Текущее имя члена архива
+    :param new_name: Новое имя члена архива
+    :param buffer_size: Размер буфера копирования в байтах
+    :return: True, если член архива найден и переименован
+    :raises ValueError: Архив требует расширений ZIP64
+    """
+    _tmp_filename = filename + '.tmp'
+    try:
+        with zipfile.ZipFile(filename, 'r') as archive:
+            if old_name not in archive.NameToInfo:
+                return False
+            with open(filename, 'rb') as src, open(_tmp_filename, 'wb') as dst:
+                _central = []
+                for info in archive.infolist():
+                    if max(info.header_offset, info.compress_size, info.file_size, dst.tell()) >= 0xFFFFFFFF:
+                        raise ValueError(f'Архивы ZIP64 не поддерживаются: {filename}')
+                    _name = new_name if info.filename == old_name else info.filename
+                    _name_bytes = _name.encode('utf-8')
+                    # Дескриптор данных не пишем: CRC и размеры известны заранее и попадают в локальный заголовок
+                    _flags = info.flag_bits & ~FLAG_DATA_DESCRIPTOR & ~FLAG_UTF8
+                    if not _name.isascii():
+                        _flags |= FLAG_UTF8
+                    _dos_time = info.date_time[3] << 11 | info.date_time[4] << 5 | info.date_time[5] // 2
+                    _dos_date = (info.date_time[0] - 1980) << 9 | info.date_time[1] << 5 | info.date_time[2]
+                    src.seek(info.header_offset)
+                    src.seek(info.header_offset + member_data_offset(src.read(LOCAL_HEADER.size), 0))
+                    _header_offset = dst.tell()
+                    dst.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, info.extract_version, _flags,
+                                                info.compress_type, _dos_time, _dos_date, info.CRC, info.compress_size,
+                                                info.file_size, len(_name_bytes), 0))
+                    dst.write(_name_bytes)
+                    _left = info.compress_size
+                    while _left > 0:
+                        _chunk = src.read(min(buffer_size, _left))
+                        if not _chunk:
+                            raise zipfile.BadZipFile(f'Неожиданный конец архива {filename}')
+                        dst.write(_chunk)
+                        _left -= len(_chunk)
+                    _central += [CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, info.create_version, info.create_system,
+                                                     info.extract_version, info.reserved, _flags, info.compress_type,
+                                                     _dos_time, _dos_date, info.CRC, info.compress_size, info.file_size,
+                                                     len(_name_bytes), 0, len(info.comment), 0, info.internal_attr,
+                                                     info.external_attr, _header_offset) + _name_bytes + info.comment]
+                _central_offset = dst.tell()
+                for _entry in _central:
+                    dst.write(_entry)
+                dst.write(END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, len(_central), len(_central),
+                                          dst.tell() - _central_offset, _central_offset, len(archive.comment)))
+                dst.write(archive.comment)
+        os.replace(_tmp_filename, filename)
+    finally:
+        # при ошибке временный файл не должен оставаться рядом с архивом
+        if os.path.exists(_tmp_filename):
+            os.unlink(_tmp_filename)
+    return True
 
 
 class ZipFB2:
-    def __init__(self, startdir: str = '.', removefb2: bool = False, debug: bool = False) -> object:
+    """
+    Упаковка файлов FB2 в архивы ZIP: каждая книга - в отдельный архив .fb2.zip рядом с исходным файлом.
+    Архив сначала пишется во временный файл, поэтому при сбое не остается наполовину записанных архивов.
+    """
+
+    def __init__(self, startdir: str = '.', removefb2: bool = False, debug: bool = False,
+                 jobs: int = None, compresslevel: int = 9) -> object:
+        """
+        Конструктор класса
+
+        :param startdir: Каталог, в котором нужно искать файлы FB2
+        :param removefb2: Удалять файл FB2 после упаковки
+        :param debug: Выводить отладочные сообщения
+        :param jobs: Количество параллельно упаковываемых файлов. По умолчанию - по числу процессоров
+        :param compresslevel: Степень сжатия, от 1 до 9
+        """
         self.startDir = startdir
-        self.removezip = removefb2
+        self.removefb2 = removefb2
         self.debug = debug
+        self.jobs = jobs if jobs else os.cpu_count() or 1
+        self.compresslevel = compresslevel
 
-    def zipFile(self, filename: str):
-        pass
+    def zipFile(self, filename: str) -> str:
+        """
+        Упаковывает файл FB2 в архив filename.zip
+        :param filename: Имя файла FB2
+        :return: Имя архива
+        """
+        _target = f'{filename}.zip'
+        _temp = f'{_target}.tmp'
+        try:
+            with zipfile.ZipFile(_temp, 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=self.compresslevel) as archive:
+                archive.write(filename, os.path.basename(filename))
+            os.replace(_temp, _target)
+        finally:
+            if os.path.exists(_temp):
+                os.unlink(_temp)
+        if self.removefb2:
+            os.unlink(filename)
+        return _target
 
-    def zipAll(self):
-        pass
+    def _zip_safe(self, filename: str) -> int:
+        """ Упаковка с перехватом ошибок, чтобы один файл не останавливал обработку остальных """
+        if self.debug:
+            print('  Zip: {}'.format(filename))
+        try:
+            self.zipFile(filename=filename)
+            return 1
+        except OSError as err:
+            print(f'Ошибка: Не удалось упаковать {filename}: {err}')
+            return 0
+
+    def find_files(self):
+        """ Перебирает файлы FB2 в каталоге startDir, включая подкаталоги """
+        for folderName, subfolders, filenames in os.walk(self.startDir):
+            for filename in filenames:
+                if filename.lower().endswith('.fb2'):
+                    yield os.path.join(folderName, filename)
+
+    def zipAll(self) -> int:
+        """
+        Упаковывает все файлы FB2 из каталога startDir.
+        :return: Количество упакованных файлов
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return sum(executor.map(self._zip_safe, list(self.find_files())))
 
 class UnzipFB2:
-    def __init__(self, startdir: str = '.', removezip: bool = False, debug: bool = False) -> object:
+    """
+    Извлечение файлов FB2 из архивов ZIP.
+
+    Из архива извлекаются только члены с расширением .fb2. Если файл на диске уже существует
+    и совпадает с членом архива по размеру и CRC, то он повторно не извлекается.
+    Архивы обрабатываются параллельно в несколько потоков.
+    """
+
+    def __init__(self, startdir: str = '.', removezip: bool = False, debug: bool = False,
+                 jobs: int = None, buffer_size: int = 1024 * 1024) -> object:
+        """
+        Конструктор класса
+
+        :param startdir: Каталог, в котором нужно искать архивы
+        :param removezip: Удалять архив после извлечения
+        :param debug: Выводить отладочные сообщения
+        :param jobs: Количество параллельно обрабатываемых архивов. По умолчанию - по числу процессоров
+        :param buffer_size: Размер буфера копирования в байтах
+        """
         self.startDir = startdir
         self.removezip = removezip
         self.debug = debug
+        self.jobs = jobs if jobs else min(32, (os.cpu_count() or 1) + 4)
+        self.buffer_size = buffer_size
+        self.kept = {}  # архивы, которые не удалены при removezip: имя архива -> причина
 
-    def unzipFile(self, filename: str):
+    @staticmethod
+    def is_fb2_member(info: zipfile.ZipInfo) -> bool:
+        """
+        Возвращает True, если член архива является файлом FB2
+        :param info: Описание члена архива
+        """
+        return not info.is_dir() and info.filename.lower().endswith('.fb2')
+
+    @staticmethod
+    def safe_target(path: str, member_name: str) -> str:
+        """
+        Формирует путь к извлекаемому файлу и проверяет, что он не выходит за пределы каталога path (zip-slip).
+        :param path: Каталог, в который извлекаются файлы
+        :param member_name: Имя члена архива
+        :return: Полный путь к извлекаемому файлу
+        """
+        _root = os.path.realpath(path)
+        _target = os.path.realpath(os.path.join(_root, member_name))
+        if os.path.commonpath([_root, _target]) != _root:
+            raise ValueError(f'Член архива {member_name} указывает за пределы каталога {path}')
+        return _target
+
+    def is_extracted(self, info: zipfile.ZipInfo, target: str) -> bool:
+        """
+        Проверяет, что файл target уже извлечен: совпадают размер и CRC.
+        Размер проверяется первым, CRC считается только при совпадении размеров.
+        :param info: Описание члена архива
+        :param target: Путь к файлу на диске
+        """
+        try:
+            if os.path.getsize(target) != info.file_size:
+                return False
+        except OSError:
+            return False
+        _crc = 0
+        with open(target, 'rb') as f:
+            while _chunk := f.read(self.buffer_size):
+                _crc = zlib.crc32(_chunk, _crc)
+        return _crc == info.CRC
+
+    def keep_reason(self, archive: zipfile.ZipFile, path: str) -> str:
+        """
+        Проверяет, можно ли удалить архив: все его члены - файлы FB2, и каждый из них
+        лежит на диске и совпадает с членом архива по размеру и CRC.
+        :param archive: Открытый архив
+        :param path: Каталог, в который извлекались файлы
+        :return: Причина, по которой архив удалять нельзя, или None
+        """
+        _other = [info.filename for info in archive.infolist() if not info.is_dir() and not self.is_fb2_member(info)]
+        if _other:
+            return f'в архиве есть файлы, кроме FB2: {", ".join(_other)}'
+        for info in archive.infolist():
+            if self.is_fb2_member(info) and not self.is_extracted(info, self.safe_target(path, info.filename)):
+                return f'файл {info.filename} на диске не совпадает с членом архива'
+        return None
+
+    def unzipFile(self, filename: str) -> int:
+        """
+        Извлекает файлы FB2 из архива в каталог, где лежит архив.
+        При removezip архив удаляется, только если в нем нет ничего, кроме извлеченных файлов FB2,
+        иначе он остается на месте, а причина записывается в kept.
+        :param filename: Имя архива
+        :return: Количество извлеченных файлов
+        """
         path = os.path.split(os.path.abspath(filename))[0]  # получить полный путь к файлу
-        unzip = zipfile.ZipFile(filename, 'r')
-        unzip.extractall(path = path)  # извлечь все файлы из архива, нужно переписать, чтобы только FB2
-        unzip.close()  # если не закрыть, то не сможем удалить
+        _counter = 0
+        _reason = None
+        with zipfile.ZipFile(filename, 'r') as unzip:  # если не закрыть, то не сможем удалить
+            for info in unzip.infolist():
+                if not self.is_fb2_member(info):
+                    continue
+                _target = self.safe_target(path, info.filename)
+                if self.is_extracted(info, _target):
+                    continue
+                os.makedirs(os.path.dirname(_target), exist_ok=True)
+                with unzip.open(info) as src, open(_target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, self.buffer_size)
+                _counter += 1
+            if self.removezip:
+                _reason = self.keep_reason(unzip, path)
         if self.removezip:
-            os.unlink(filename)  # удаление файла ZIP
+            if _reason is None:
+                os.unlink(filename)  # удаление файла ZIP
+            else:
+                self.kept[filename] = _reason
+        return _counter
+
+    def _unzip_safe(self, filename: str) -> int:
+        """ Извлечение с перехватом ошибок, чтобы один испорченный архив не останавливал обработку остальных """
+        if self.debug:
+            print('  Unzip: {}'.format(filename))
+        try:
+            _counter = self.unzipFile(filename=filename)
+            if filename in self.kept:
+                print(f'Архив {filename} не удален: {self.kept[filename]}')
+            return _counter
+        except (zipfile.BadZipFile, OSError, ValueError) as err:
+            print(f'Ошибка: Не удалось распаковать {filename}: {err}')
+            return 0
 
-    def unzipAll(self):
+    def find_archives(self):
+        """
+        Перебирает архивы в каталоге startDir, включая подкаталоги.
+        Открываются только файлы с расширением .zip.
+        """
         for folderName, subfolders, filenames in os.walk(self.startDir):
             for filename in filenames:
+                if not filename.lower().endswith('.zip'):
+                    continue
                 filename = os.path.join(folderName, filename)
                 if zipfile.is_zipfile(filename):
-                    if self.debug:
-                        print('  Unzip: {}'.format(filename))
+                    yield filename
 
-                    self.unzipFile(filename = filename)
+    def unzipAll(self) -> int:
+        """
+        Извлекает файлы FB2 из всех архивов в каталоге startDir.
+        :return: Количество извлеченных файлов
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return sum(executor.map(self._unzip_safe, self.find_archives()))
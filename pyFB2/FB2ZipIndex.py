@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import io
+import mmap
+import os
+import sqlite3
+import zipfile
+
+from pyFB2.FB2Parser import FB2Parser
+from pyFB2.FB2Zip import UnzipFB2, decompress_member, member_data_offset
+
+
+class FB2ZipIndex:
+    """
+    Индекс для произвольного доступа к книгам в больших архивах ZIP.
+
+    Для каждого члена архива с расширением .fb2 в БД SQLite сохраняются смещение локального заголовка,
+    метод сжатия, размеры, CRC и основные сведения из description. Чтение книги по индексу
+    не требует разбора центрального каталога архива: архив отображается в память (mmap),
+    выполняется переход на нужное смещение и распаковывается только один член архива.
+    """
+
+    def __init__(self, database: str):
+        """
+        Конструктор класса
+        :param database: Имя файла БД индекса
+        """
+        self.database = database
+        self.dbconn = sqlite3.connect(database)
+        self.dbconn.row_factory = sqlite3.Row
+        self._mmaps = {}
+        self.create_db()
+
+    def create_db(self):
+        self.dbconn.executescript("""
+            CREATE TABLE IF NOT EXISTS archives (
+                id       INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                filename VARCHAR (4096) UNIQUE NOT NULL,
+                size     INTEGER,
+                mtime    REAL
+            );
+            CREATE TABLE IF NOT EXISTS members (
+                id              INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                archive_id      INTEGER REFERENCES archives (id),
+                name            VARCHAR (4096) NOT NULL,
+                header_offset   INTEGER NOT NULL,
+                compress_type   INTEGER NOT NULL,
+                compress_size   INTEGER NOT NULL,
+                file_size       INTEGER NOT NULL,
+                crc             INTEGER NOT NULL,
+                title           VARCHAR (1024),
+                authors         VARCHAR (1024),
+                genres          VARCHAR (1024),
+                lang            VARCHAR (32),
+                sequence_name   VARCHAR (1024),
+                sequence_number VARCHAR (32)
+            );
+            CREATE INDEX IF NOT EXISTS idx_members_archive ON members (archive_id, name);
+            CREATE INDEX IF NOT EXISTS idx_members_title ON members (title);
+            CREATE INDEX IF NOT EXISTS idx_members_authors ON members (authors);
+            """)
+
+    def close(self):
+        for _mmap in self._mmaps.values():
+            _mmap.close()
+        self._mmaps.clear()
+        self.dbconn.close()
+
+    @staticmethod
+    def _get_metadata(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> list:
+        """
+        Извлекает сведения о книге. Распаковывается только начало члена архива до конца description.
+        :return: Список [title, authors, genres, lang, sequence_name, sequence_number]
+        """
+        with archive.open(info) as stream:
+            parser = FB2Parser(filename=os.path.join(archive.filename, info.filename), metadata_only=True,
+                               stream=stream)
+            authors = []
+            for author in parser.authors:
+                authors += [' '.join(filter(None, [parser.author_last_name(author), parser.author_first_name(author),
+                                                   parser.author_middle_name(author)]))]
+            return [parser.title, '; '.join(authors), ', '.join(filter(None, parser.genres)),
+                    ', '.join(filter(None, parser.lang)), parser.sequence_name, parser.sequence_number]
+
+    def get_archive_id(self, filename: str) -> int:
+        """
+        Возвращает идентификатор архива в индексе. None - если архив не проиндексирован.
+        """
+        row = self.dbconn.execute('select id from archives where filename = ?', [filename]).fetchone()
+        return None if row is None else row["id"]
+
+    def is_indexed(self, filename: str) -> bool:
+        """
+        Возвращает True, если архив уже проиндексирован и с тех пор не изменялся (размер и время изменения).
+        """
+        _stat = os.stat(filename)
+        row = self.dbconn.execute('select size, mtime from archives where filename = ?', [filename]).fetchone()
+        return row is not None and row["size"] == _stat.st_size and row["mtime"] == _stat.st_mtime
+
+    def add_archive(self, filename: str, with_metadata: bool = True) -> int:
+        """
+        Индексирует архив. Если архив уже проиндексирован и не изменялся, то он повторно не читается.
+        :param filename: Имя архива
+        :param with_metadata: Извлекать сведения о книгах из description
+        :return: Количество проиндексированных членов архива
+        """
+        filename = os.path.abspath(filename)
+        if self.is_indexed(filename):
+            return 0
+        self._release_mmap(filename)
+        _stat = os.stat(filename)
+        _counter = 0
+        with self.dbconn as conn, zipfile.ZipFile(filename, 'r') as archive:
+            archive_id = self.get_archive_id(filename)
+            if archive_id is None:
+                archive_id = conn.execute('insert into archives (filename, size, mtime) values (?, ?, ?)',
+                                          [filename, _stat.st_size, _stat.st_mtime]).lastrowid
+            else:
+                conn.execute('delete from members where archive_id = ?', [archive_id])
+                conn.execute('update archives set size = ?, mtime = ? where id = ?',
+                             [_stat.st_size, _stat.st_mtime, archive_id])
+            for info in archive.infolist():
+                if not UnzipFB2.is_fb2_member(info):
+                    continue
+                metadata = [None] * 6
+                if with_metadata:
+                    try:
+                        metadata = self._get_metadata(archive, info)
+                    except Exception as err:
+                        print(f'Ошибка: Не удалось прочитать описание {info.filename} в {filename}: {err}')
+                conn.execute('insert into members (archive_id, name, header_offset, compress_type, compress_size, '
+                             'file_size, crc, title, authors, genres, lang, sequence_name, sequence_number) '
+                             'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             [archive_id, info.filename, info.header_offset, info.compress_type, info.compress_size,
+                              info.file_size, info.CRC] + metadata)
+                _counter += 1
+        return _counter
+
+    def add_dir(self, start_dir: str, with_metadata: bool = True) -> int:
+        """
+        Индексирует все архивы в каталоге, включая подкаталоги.
+        :return: Количество проиндексированных членов архивов
+        """
+        return sum(self.add_archive(filename, with_metadata) for filename in UnzipFB2(start_dir).find_archives())
+
+    def find(self, title: str = None, author: str = None) -> list:
+        """
+        Поиск книг в индексе по началу названия и/или началу имени автора.
+        :return: Список записей таблицы members с именем архива
+        """
+        sql = 'select m.*, a.filename as archive from members m join archives a on a.id = m.archive_id where 1 = 1'
+        params = []
+        if title:
+            sql += " and m.title like ? || '%'"
+            params += [title]
+        if author:
+            sql += " and m.authors like ? || '%'"
+            params += [author]
+        return self.dbconn.execute(sql + ' order by m.id', params).fetchall()
+
+    def get_member(self, member_id: int) -> sqlite3.Row:
+        """
+        Возвращает запись индекса о члене архива.
+        """
+        return self.dbconn.execute('select m.*, a.filename as archive from members m '
+                                   'join archives a on a.id = m.archive_id where m.id = ?', [member_id]).fetchone()
+
+    def _get_mmap(self, filename: str) -> mmap.mmap:
+        """ Отображение архива в память. Отображение открывается один раз на архив. """
+        _mmap = self._mmaps.get(filename)
+        if _mmap is None:
+            with open(filename, 'rb') as f:
+                _mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmaps[filename] = _mmap
+        return _mmap
+
+    def _release_mmap(self, filename: str):
+        _mmap = self._mmaps.pop(filename, None)
+        if _mmap is not None:
+            _mmap.close()
+
+    def read(self, member_id: int) -> bytes:
+        """
+        Читает книгу из архива: один переход по смещению и распаковка одного члена архива.
+        :param member_id: Идентификатор члена архива в индексе
+        :return: Содержимое файла FB2
+        """
+        member = self.get_member(member_id)
+        if member is None:
+            raise KeyError(f'Член архива {member_id} не найден в индексе')
+        if member["compress_type"] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # прочие методы сжатия (bzip2, lzma) распаковывает zipfile
+            with zipfile.ZipFile(member["archive"]) as archive:
+                info = next((info for info in archive.infolist() if info.header_offset == member["header_offset"]),
+                            None)
+                if info is None:
+                    raise zipfile.BadZipFile(f'Член архива {member["name"]} не найден в {member["archive"]}')
+                return archive.read(info)
+        _mmap = self._get_mmap(member["archive"])
+        _offset = member_data_offset(_mmap, member["header_offset"])
+        with memoryview(_mmap) as view, view[_offset:_offset + member["compress_size"]] as data:
+            return decompress_member(data, member["compress_type"], member["crc"])
+
+    def open(self, member_id: int) -> io.BytesIO:
+        """
+        Открывает книгу из архива как двоичный поток.
+        """
+        return io.BytesIO(self.read(member_id))
+
+    def get_parser(self, member_id: int, check_schema: bool = False) -> FB2Parser:
+        """
+        Возвращает парсер для книги из архива.
+        """
+        member = self.get_member(member_id)
+        return FB2Parser(filename=os.path.join(member["archive"], member["name"]), check_schema=check_schema,
+                         stream=self.open(member_id))
@@ -3,6 +3,33 @@ import sqlite3
 import importlib.resources
 import os
 import hashlib
+import re
+import uuid
+import zlib
+from urllib.request import pathname2url
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pyFB2.FB2Stats import add_counter, stage
+
+# Ссылки на изображения, статьи и CSS внутри текста статей
+DB_LINK = re.compile(r'db://thisdb\.(note_image\.image|note\.text|css\.css)\.(\d+)')
+
+# Алгоритмы сжатия текста статей и CSS: имя -> (функция сжатия, функция распаковки).
+# Имя алгоритма записывается в колонку codec каждой сжатой записи
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+
+
+def register_codec(name: str, compress, decompress):
+    """
+    Регистрирует алгоритм сжатия, например lzma или zstd.
+    :param name: Имя алгоритма, записывается в БД
+    :param compress: Функция сжатия bytes -> bytes
+    :param decompress: Функция распаковки bytes -> bytes
+    """
+    CODECS[name] = (compress, decompress)
 
 
 class HystDB:
@@ -10,16 +37,68 @@ class HystDB:
     Класс для работы с БД Hyst
     """
 
-    def __init__(self, filename: str = None):
+    # Индексы, создание которых откладывается до конца пакетной вставки.
+    # Индекс по MD5 изображений не откладывается: по нему ищутся дубликаты при вставке
+    DEFERRABLE_INDEXES = ('idx_note_parentid', 'idx_note_name')
+
+    # Размер пачки параметров для запросов вида in (?, ?, ...)
+    IN_CHUNK_SIZE = 500
+
+    # Настройки для загрузки больших БД прямо на диск: крупные страницы, кэш 256 МБ,
+    # отображение файла в память до 1 ГБ, временные таблицы в памяти
+    BULK_LOAD_PRAGMAS = {'page_size': 16384, 'cache_size': -256 * 1024, 'mmap_size': 1 << 30, 'temp_store': 'MEMORY'}
+
+    def __init__(self, filename: str = None, codec: str = None, cache_size: int = 64, pragmas: dict = None,
+                 check_same_thread: bool = True):
         """
         Создает новую БД в памяти или на диске.
         :param filename: Если не передано имя файла, то создается только in-memory БД
+        :param codec: Алгоритм сжатия текста статей и CSS из CODECS, например 'zlib'. None - не сжимать.
+                      Сжатые записи помечаются в колонке codec, несжатые записи читаются как раньше.
+                      Колонки codec и TextSize (длина несжатого текста) добавляются в таблицы только при сжатии.
+                      Сжатый текст не читается программами, которые не знают о колонке codec
+        :param cache_size: Количество распакованных текстов статей в кэше get_note_text
+        :param pragmas: Прагмы SQLite, которые устанавливаются до создания таблиц, например BULK_LOAD_PRAGMAS.
+                        page_size действует только для новой БД
+        :param check_same_thread: Запретить использование соединения из других потоков. Если False, то
+                                  вызывающий код сам отвечает за то, чтобы потоки не писали одновременно
         """
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f'Неизвестный алгоритм сжатия {codec}')
+        self.codec = codec
+        self.cache_size = cache_size
+        self._text_cache: OrderedDict[int, str] = OrderedDict()  # идентификатор статьи -> текст
         self._filename = filename if filename else ":memory:"
-        self._connection = sqlite3.connect(self.filename)
+        if self.is_memory_db():
+            # именованная in-memory БД: ее можно присоединить к БД на диске (см. write_to_disk)
+            self._uri = f'file:hyst-{uuid.uuid4().hex}?mode=memory&cache=shared'
+        else:
+            self._uri = 'file:' + pathname2url(os.path.abspath(filename))
+        # с uri=True соединение может присоединять (ATTACH) другие БД по URI
+        self._connection = sqlite3.connect(self._uri, uri=True, check_same_thread=check_same_thread)
+        for name, value in (pragmas or {}).items():
+            self._connection.execute(f'pragma {name} = {value}')
         # Используем вот это https://docs.python.org/3.13/library/sqlite3.html#sqlite3-howto-row-factory
         self._connection.row_factory = sqlite3.Row
+        self._bulk = 0  # глубина вложенности пакетного режима
+        self._note_buffers: dict[int, list[str]] = {}  # идентификатор статьи -> фрагменты текста для дописывания
         self._create_tables()
+        _columns = self._table_columns(self._connection, 'note')
+        self._codec_columns = 'codec' in _columns  # в БД есть колонки codec и TextSize
+        if codec is not None or (self._codec_columns and 'textsize' not in _columns):
+            self._add_codec_columns()
+
+    @classmethod
+    def for_bulk_load(cls, filename: str, codec: str = None, **pragmas) -> 'HystDB':
+        """
+        Открывает БД на диске для загрузки большого объема данных: вставка идет прямо в файл,
+        поэтому размер БД не ограничен объемом памяти. Если файл уже есть, то загрузка продолжается в него.
+        Вставку лучше выполнять внутри bulk().
+        :param filename: Имя файла БД
+        :param codec: Алгоритм сжатия текста
+        :param pragmas: Прагмы, заменяющие BULK_LOAD_PRAGMAS, например mmap_size=0
+        """
+        return cls(filename, codec=codec, pragmas={**cls.BULK_LOAD_PRAGMAS, **pragmas})
 
     def integrity_check(self):
         ok = self._connection.execute("pragma integrity_check").fetchone()
@@ -34,6 +113,8 @@ class HystDB:
         return self._connection
 
     def close(self):
+        self.flush_note_text()
+        self._connection.commit()
         self._connection.close()
 
     def _create_tables(self):
@@ -46,25 +127,331 @@ class HystDB:
         with open(_sql_script_file) as f:
             self._connection.executescript(f.read())
 
+    def _add_codec_columns(self):
+        """
+        Добавляет колонку codec в таблицы NOTE и CSS и колонку TextSize в таблицу NOTE, если их нет.
+        Вызывается только тогда, когда в БД пишется сжатый текст
+        """
+        for table, column, column_type in (('note', 'codec', 'varchar(16)'), ('note', 'TextSize', 'integer'),
+                                           ('css', 'codec', 'varchar(16)')):
+            if column.lower() not in self._table_columns(self._connection, table):
+                self._connection.execute(f'alter table {table} add column {column} {column_type}')
+        self._connection.commit()
+        self._codec_columns = True
+
+    @property
+    def _text_columns(self) -> tuple:
+        """ Колонки, в которые записывается текст статьи (см. _text_values) """
+        return ('Text', 'codec', 'TextSize') if self._codec_columns else ('Text',)
+
+    def _text_values(self, text) -> list:
+        """
+        Значения колонок _text_columns для текста статьи. Для сжатого текста TextSize хранит
+        длину несжатого текста: length(Text) вернул бы размер сжатых данных.
+        """
+        _value, _codec = self.encode_text(text)
+        if not self._codec_columns:
+            return [_value]
+        return [_value, _codec, len(text) if _codec is not None else None]
+
+    @property
+    def _size_sql(self) -> str:
+        """ Выражение SQL для длины текста статьи """
+        return self._text_size_sql(self._codec_columns)
+
+    @staticmethod
+    def _text_size_sql(codec_columns: bool, alias: str = '') -> str:
+        """
+        Выражение SQL для длины текста статьи: у сжатых статей - длина несжатого текста
+        :param codec_columns: В таблице NOTE есть колонки codec и TextSize
+        :param alias: Псевдоним таблицы NOTE в запросе, например 'n.'
+        """
+        return f'coalesce({alias}TextSize, length({alias}Text))' if codec_columns else f'length({alias}Text)'
+
+    def encode_text(self, text) -> tuple:
+        """
+        Сжимает текст для записи в БД, если задан алгоритм сжатия.
+        Если сжатие не уменьшает размер, то текст записывается как есть.
+        :param text: Текст (str или bytes)
+        :return: Пара (значение для записи, имя алгоритма или None)
+        """
+        if self.codec is None or not text:
+            return text, None
+        _data = text.encode('utf-8') if isinstance(text, str) else text
+        _compressed = CODECS[self.codec][0](_data)
+        if len(_compressed) >= len(_data):
+            return text, None
+        return sqlite3.Binary(_compressed), self.codec
+
+    @staticmethod
+    def decode_data(value, codec: str) -> bytes:
+        """ Распаковывает значение, прочитанное из БД. Несжатые значения возвращаются как есть """
+        if codec is None or value is None:
+            return value
+        if codec not in CODECS:
+            raise ValueError(f'Неизвестный алгоритм сжатия {codec}')
+        return CODECS[codec][1](value)
+
+    @classmethod
+    def decode_text(cls, value, codec: str) -> str:
+        """ Текст статьи из значения, прочитанного из БД """
+        _value = cls.decode_data(value, codec)
+        if isinstance(_value, bytes):
+            return _value.decode('utf-8')
+        return _value or ''
+
     def set_database_name(self, name: str):
         """
         Записывает в БД Hyst ее название
         :param name: Название БД
         :return:
         """
-        with self._connection as conn:
-            conn.execute(f"insert into nb_profile (name) values ('{name}')")
+        with self._transaction() as conn:
+            conn.execute('insert into nb_profile (name) values (?)', [name])
 
     def is_memory_db(self) -> bool:
         return self.filename == ':memory:'
 
-    def write_to_disk(self, filename: str):
-        if self.is_memory_db():
-            _new_connection = sqlite3.connect(filename)
-            self._connection.backup(_new_connection)
-            self._connection.close()
-            self._connection = _new_connection
-            self._filename = filename
+    def write_to_disk(self, filename: str, pages: int = 1024, progress=None, resume: bool = False):
+        """
+        Записывает in-memory БД в файл и переключается на него.
+        Копирование идет порциями по pages страниц, между порциями вызывается progress.
+        :param filename: Имя файла БД
+        :param pages: Количество страниц в одной порции. -1 - все сразу
+        :param progress: Функция progress(status, remaining, total), где remaining и total - количество страниц
+        :param resume: Если файл уже есть, то дописать записи в него, а не заменить его. Записные книжки
+                       и корневые статьи (авторы) с теми же названиями не дублируются (см. merge_database)
+        """
+        if not self.is_memory_db():
+            return
+        self.flush_note_text()
+        self._connection.commit()
+        if resume and os.path.isfile(filename):
+            _target = HystDB(filename, codec=self.codec)
+            _target.merge_database(self._uri, merge_existing=True)
+            _new_connection = _target.connection
+            self._codec_columns = _target._codec_columns
+            if progress is not None:
+                progress(sqlite3.SQLITE_DONE, 0, 1)
+        else:
+            _new_connection = sqlite3.connect('file:' + pathname2url(os.path.abspath(filename)), uri=True)
+            self._connection.backup(_new_connection, pages=pages, progress=progress)
+            _new_connection.row_factory = sqlite3.Row
+        self._connection.close()
+        self._connection = _new_connection
+        self._filename = filename
+        self._uri = 'file:' + pathname2url(os.path.abspath(filename))
+        self._text_cache.clear()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Транзакция для одной операции записи. В пакетном режиме фиксация откладывается
+        до выхода из bulk, поэтому отдельные вставки не выполняют commit.
+        """
+        if self._bulk:
+            yield self._connection
+        else:
+            with self._connection as conn:
+                yield conn
+                with stage('db.commit'):
+                    conn.commit()
+
+    @contextmanager
+    def bulk(self, defer_indexes: bool = True, unsafe: bool = False):
+        """
+        Пакетный режим: все вставки внутри блока with выполняются в одной транзакции.
+        При ошибке транзакция откатывается. Вложенные вызовы bulk входят во внешнюю транзакцию.
+
+        Пример::
+
+            with hyst_db.bulk():
+                for ...:
+                    hyst_db.insert_note(...)
+
+        :param defer_indexes: Удалить индексы DEFERRABLE_INDEXES на время вставки и создать их заново в конце.
+                              Запросы по этим индексам внутри блока выполняются полным просмотром таблицы
+        :param unsafe: Отключить синхронизацию с диском и держать журнал в памяти (journal_mode=MEMORY,
+                       synchronous=OFF). Быстро, но при сбое БД может быть испорчена. Только для временных БД
+        """
+        if self._bulk:
+            self._bulk += 1
+            try:
+                yield self
+            finally:
+                self._bulk -= 1
+            return
+
+        _pragmas = {}
+        if unsafe:
+            # прагмы нельзя менять внутри транзакции
+            self._connection.commit()
+            for name, value in (('journal_mode', 'MEMORY'), ('synchronous', 'OFF')):
+                _pragmas[name] = self._connection.execute(f'pragma {name}').fetchone()[0]
+                self._connection.execute(f'pragma {name} = {value}')
+        _indexes = []
+        self._bulk = 1
+        try:
+            with self._connection as conn:
+                # явное начало транзакции, чтобы удаление индексов тоже откатывалось при ошибке
+                if not conn.in_transaction:
+                    conn.execute('begin')
+                if defer_indexes:
+                    _placeholders = ', '.join('?' * len(self.DEFERRABLE_INDEXES))
+                    _indexes = [row[0] for row in conn.execute(
+                        f"select sql from sqlite_master where type = 'index' and sql is not null "
+                        f"and name in ({_placeholders})", self.DEFERRABLE_INDEXES)]
+                    for name in self.DEFERRABLE_INDEXES:
+                        conn.execute(f'drop index if exists {name}')
+                yield self
+                self.flush_note_text()
+                with stage('db.index'):
+                    for sql in _indexes:
+                        conn.execute(sql)
+                with stage('db.commit'):
+                    conn.commit()
+        finally:
+            self._bulk = 0
+            for name, value in _pragmas.items():
+                self._connection.execute(f'pragma {name} = {value}')
+
+    def merge_database(self, src_db: str, parent_id: int = 0, notebook_id: int = None,
+                       merge_existing: bool = False) -> int:
+        """
+        Переносит в эту БД все записи из БД src_db запросами INSERT ... SELECT через ATTACH.
+        Идентификаторы записных книжек и статей сдвигаются на максимальный идентификатор этой БД,
+        корневые статьи источника становятся дочерними для parent_id. Изображения, которые уже есть
+        в этой БД (по MD5), не копируются. Ссылки на изображения, статьи и CSS в тексте статей
+        пересчитываются функцией SQL.
+        :param src_db: Имя файла или URI БД-источника
+        :param parent_id: Идентификатор статьи, под которой будут размещены корневые статьи источника. 0 - в корень
+        :param notebook_id: Записная книжка для всех перенесенных статей. None - записные книжки тоже переносятся
+        :param merge_existing: Не дублировать записные книжки с тем же названием и корневые статьи (например,
+                               авторов) с тем же названием в той же записной книжке: их потомки из источника
+                               добавляются к уже имеющимся записям
+        :return: Количество перенесенных статей
+        """
+        self.flush_note_text()
+        self._connection.commit()
+        # ATTACH нельзя выполнить внутри транзакции
+        self._connection.execute('attach database ? as src', [src_db])
+        try:
+            # сжатые записи источника переносятся как есть, поэтому им нужны колонки сжатия
+            if not self._codec_columns and any(
+                    self._has_column('src', table, 'codec') and self._connection.execute(
+                        f'select 1 from src.{table} where codec is not null limit 1').fetchone()
+                    for table in ('note', 'css')):
+                self._add_codec_columns()
+            with self.bulk(defer_indexes=False) as db:
+                return db._merge_attached(parent_id, notebook_id, merge_existing)
+        finally:
+            self._connection.execute('detach database src')
+
+    def _merge_attached(self, parent_id: int, notebook_id: int, merge_existing: bool = False) -> int:
+        """ Перенос записей из присоединенной БД src в одной транзакции """
+        conn = self._connection
+        _note_offset = self._max_id('note')
+        _notebook_offset = self._max_id('notebook')
+        _image_offset = self._max_id('note_image')
+        # записи источника, совпавшие с уже имеющимися: идентификатор в источнике -> идентификатор в этой БД.
+        # Остальные записи получают идентификатор, сдвинутый на offset, поэтому совпавшие записи - это
+        # записи с новым идентификатором не больше offset
+        _notebooks = {}
+        _roots = {}
+        conn.create_function('hyst_notebook_id', 1, lambda _id: _notebooks.get(_id, _id + _notebook_offset)
+                             if _id is not None else None)
+        conn.create_function('hyst_note_id', 1, lambda _id: _roots.get(_id, _id + _note_offset)
+                             if _id is not None else None)
+
+        if notebook_id is None:
+            if merge_existing:
+                _notebooks.update(conn.execute(
+                    'select s.id, min(m.id) from src.notebook s join main.notebook m on m.name = s.name '
+                    'group by s.id').fetchall())
+            conn.execute('insert into notebook (id, name, SeqNo, Rating, TabColor, ShortDescr, state, Tags) '
+                         'select id + ?, name, SeqNo, Rating, TabColor, ShortDescr, state, Tags from src.notebook '
+                         ' where hyst_notebook_id(id) > ?',
+                         [_notebook_offset, _notebook_offset])
+        if merge_existing:
+            _roots.update(conn.execute(
+                'select s.id, min(m.id) from src.note s '
+                '  join main.note m on coalesce(m.ParentID, 0) = ? and m.Name = s.Name '
+                '   and m.NotebookID = coalesce(?, hyst_notebook_id(s.NotebookID)) '
+                ' where coalesce(s.ParentID, 0) = 0 group by s.id', [parent_id, notebook_id]).fetchall())
+
+        # изображения: из повторяющихся в источнике берется первое, уже имеющиеся в этой БД не копируются
+        conn.execute('insert into note_image (id, image, book_id, ShortDescr, LongDescr, MD5, thumbnail) '
+                     'select s.id + ?, s.image, s.book_id, s.ShortDescr, s.LongDescr, s.MD5, s.thumbnail '
+                     '  from src.note_image s '
+                     ' where s.MD5 is null '
+                     '    or (s.id in (select min(id) from src.note_image where MD5 is not null group by MD5) '
+                     '        and not exists (select 1 from main.note_image m where m.MD5 = s.MD5 and m.id <= ?))',
+                     [_image_offset, _image_offset])
+        _images = dict(conn.execute(
+            'select s.id, coalesce((select min(m.id) from main.note_image m where m.MD5 = s.MD5), s.id + ?) '
+            '  from src.note_image s', [_image_offset]).fetchall())
+
+        # CSS с тем же кодом уже есть в этой БД - ссылки переводятся на него
+        _note_codec = 'codec' if self._has_column('src', 'note', 'codec') else 'null'
+        _css_codec = 'codec' if self._has_column('src', 'css', 'codec') else 'null'
+        if self._codec_columns:
+            conn.execute(f'insert or ignore into css (name, code, filename, css, codec) '
+                         f'select name, code, filename, css, {_css_codec} from src.css')
+        else:
+            conn.execute('insert or ignore into css (name, code, filename, css) '
+                         'select name, code, filename, css from src.css')
+        _css = dict(conn.execute('select s.id, m.id from src.css s join main.css m on m.code = s.code').fetchall())
+
+        _maps = {'note_image.image': _images, 'css.css': _css}
+
+        def _remap(match: re.Match) -> str:
+            _kind, _id = match.group(1), int(match.group(2))
+            if _kind == 'note.text':
+                return f'db://thisdb.note.text.{_roots.get(_id, _id + _note_offset)}'
+            return f'db://thisdb.{_kind}.{_maps[_kind].get(_id, _id)}'
+
+        def _remap_links(text, codec):
+            if codec is not None:
+                # сжатый текст распаковывается и сжимается тем же алгоритмом
+                _text = DB_LINK.sub(_remap, self.decode_text(text, codec))
+                return CODECS[codec][0](_text.encode('utf-8'))
+            if not isinstance(text, str):
+                return text
+            return DB_LINK.sub(_remap, text)
+
+        conn.create_function('hyst_remap_links', 2, _remap_links, deterministic=True)
+        _codec = ', codec' if self._codec_columns else ''
+        _codec_value = f', {_note_codec}' if self._codec_columns else ''
+        _cursor = conn.execute(
+            f'insert into note (id, ParentID, NotebookID, SeqNo, Name, Link, ShortDescr, Text, State, TextType, '
+            f'                  NodeType, Tags{_codec}) '
+            f'select hyst_note_id(id), case when coalesce(ParentID, 0) = 0 then ? else hyst_note_id(ParentID) end, '
+            f'       coalesce(?, hyst_notebook_id(NotebookID)), SeqNo, Name, Link, ShortDescr, '
+            f'       hyst_remap_links(Text, {_note_codec}), State, TextType, NodeType, Tags{_codec_value} '
+            f'  from src.note where hyst_note_id(id) > ? order by id',
+            [parent_id, notebook_id, _note_offset])
+        if self._codec_columns:
+            # ссылки в тексте пересчитаны, поэтому длина сжатого текста вычисляется заново
+            conn.create_function('hyst_text_size', 2, lambda text, codec: len(self.decode_text(text, codec)),
+                                 deterministic=True)
+            conn.execute('update note set TextSize = hyst_text_size(Text, codec) where id > ? and codec is not null',
+                         [_note_offset])
+        return _cursor.rowcount
+
+    def _has_column(self, schema: str, table: str, column: str) -> bool:
+        return column in self._table_columns(self._connection, table, schema)
+
+    @staticmethod
+    def _table_columns(connection: sqlite3.Connection, table: str, schema: str = 'main') -> set[str]:
+        """ Имена колонок таблицы в нижнем регистре """
+        return {row[1].lower() for row in connection.execute(f'pragma {schema}.table_info({table})')}
+
+    def _max_id(self, table: str) -> int:
+        """ Наибольший идентификатор таблицы с учетом уже выданных AUTOINCREMENT """
+        _row = self._connection.execute(
+            f"select max(coalesce((select seq from sqlite_sequence where name = ?), 0), "
+            f"coalesce((select max(id) from main.{table}), 0))", [table]).fetchone()
+        return _row[0]
 
     def insert_notebook(self, name: str, short_descr: str = '') -> int:
         """
@@ -73,7 +460,7 @@ class HystDB:
         :param short_descr: Короткое описание
         :return: Идентификатор записной книжки
         """
-        with self._connection as conn:
+        with self._transaction() as conn:
             return conn.execute('insert into notebook (name, ShortDescr) values (?, ?)',
                                 [name, short_descr]).lastrowid
 
@@ -87,13 +474,58 @@ class HystDB:
         :param notebook_id: Идентификатор записной книжки, к которой принадлежит статья
         :returns: Идентификатор статьи
         """
-        _cursor = self._connection.cursor()
-        _sql = 'insert into note (ParentID, NotebookID, SeqNo, name, text) values (?, ?, ?, ?, ?)'
-        _cursor.execute(_sql, [parent_id, notebook_id, seq_no, title, text])
-        self._connection.commit()
-        _last_rowid = _cursor.lastrowid
-        _cursor.close()
-        return _last_rowid
+        _columns = self._text_columns
+        _sql = f'insert into note (ParentID, NotebookID, SeqNo, name, {", ".join(_columns)}) ' \
+               f'values (?, ?, ?, ?, {", ".join("?" * len(_columns))})'
+        add_counter('db.notes')
+        with self._transaction() as conn:
+            return conn.execute(_sql, [parent_id, notebook_id, seq_no, title, *self._text_values(text)]).lastrowid
+
+    def insert_notes(self, notes) -> int:
+        """
+        Вставляет в таблицу NOTE много записей одним запросом executemany.
+        :param notes: Итератор по кортежам (id, ParentID, NotebookID, SeqNo, Name, Text).
+                      Если id равен None, то идентификатор назначает БД
+        :returns: Количество вставленных записей
+        """
+        _columns = self._text_columns
+        _sql = f'insert into note (id, ParentID, NotebookID, SeqNo, name, {", ".join(_columns)}) ' \
+               f'values (?, ?, ?, ?, ?, {", ".join("?" * len(_columns))})'
+        with self._transaction() as conn:
+            _count = conn.executemany(_sql, ((*note[:5], *self._text_values(note[5])) for note in notes)).rowcount
+        add_counter('db.notes', _count)
+        return _count
+
+    def insert_css(self, name: str, code: str, filename: str, css: bytes) -> int:
+        """
+        Вставляет в таблицу CSS файл стилей
+        :param name: Название
+        :param code: Код (уникальный)
+        :param filename: Имя файла (уникальное)
+        :param css: Содержимое файла
+        :return: Идентификатор записи
+        """
+        _value, _codec = self.encode_text(css)
+        _value = sqlite3.Binary(_value) if isinstance(_value, bytes) else _value
+        with self._transaction() as conn:
+            if not self._codec_columns:
+                return conn.execute('insert into css (name, code, filename, css) values (?, ?, ?, ?)',
+                                    [name, code, filename, _value]).lastrowid
+            return conn.execute('insert into css (name, code, filename, css, codec) values (?, ?, ?, ?, ?)',
+                                [name, code, filename, _value, _codec]).lastrowid
+
+    def get_css(self, css_id: int) -> bytes:
+        """
+        Возвращает содержимое файла стилей
+        :param css_id: Идентификатор записи в таблице CSS
+        :return: Содержимое файла. None - если записи нет
+        """
+        _row = self._connection.execute(f'select css, {"codec" if self._codec_columns else "null"} as codec '
+                                        f'from css where id = ?', [css_id]).fetchone()
+        if _row is None:
+            return None
+        _value = self.decode_data(_row["css"], _row["codec"])
+        return _value.encode('utf-8') if isinstance(_value, str) else _value
 
     def insert_image(self, short_descr: str, image: bytes) -> int:
         """
@@ -104,14 +536,42 @@ class HystDB:
         """
         _md5 = hashlib.md5(image).hexdigest()
         # Проверяем, есть ли такое изображение в БД
-        _id = self._connection.execute(f'select id from note_image where md5 = {_md5}').fetchone()["id"]
+        _row = self._connection.execute('select id from note_image where md5 = ?', [_md5]).fetchone()
         # Если есть, то возвращаем его ID
-        if _id: return _id
+        if _row is not None:
+            return _row["id"]
         # Если нет такого изображения, то вставляем его
-        with self._connection as conn:
+        add_counter('db.images')
+        with self._transaction() as conn:
             return conn.execute('insert into note_image (ShortDescr, image, md5) values (?, ?, ?)',
                                 [short_descr, sqlite3.Binary(image), _md5]).lastrowid
 
+    def insert_images(self, images) -> list[int]:
+        """
+        Вставляет в таблицу NOTE_IMAGE много изображений одним запросом executemany.
+        Изображения, которые уже есть в БД (или повторяются в списке), не вставляются.
+        :param images: Итератор по парам (короткое описание, изображение)
+        :return: Идентификаторы изображений в порядке следования в images
+        """
+        _rows = [(short_descr, sqlite3.Binary(image), hashlib.md5(image).hexdigest()) for short_descr, image in images]
+        _md5_list = list(dict.fromkeys(row[2] for row in _rows))
+        with self._transaction() as conn:
+            _ids = self._find_images(conn, _md5_list)
+            _new_rows = {row[2]: row for row in _rows if row[2] not in _ids}
+            conn.executemany('insert into note_image (ShortDescr, image, md5) values (?, ?, ?)', _new_rows.values())
+            add_counter('db.images', len(_new_rows))
+            _ids.update(self._find_images(conn, list(_new_rows)))
+        return [_ids[row[2]] for row in _rows]
+
+    def _find_images(self, conn: sqlite3.Connection, md5_list: list) -> dict:
+        """ Идентификаторы изображений по их MD5: MD5 -> id """
+        _result = {}
+        for i in range(0, len(md5_list), self.IN_CHUNK_SIZE):
+            _chunk = md5_list[i:i + self.IN_CHUNK_SIZE]
+            _sql = f"select md5, min(id) as id from note_image where md5 in ({', '.join('?' * len(_chunk))}) group by md5"
+            _result.update((row["md5"], row["id"]) for row in conn.execute(_sql, _chunk))
+        return _result
+
     def update_image(self, image_id: int, short_desc: str, image: bytes):
         """
         Обновляет изображение в таблице **NOTE_IMAGE**
@@ -122,27 +582,114 @@ class HystDB:
         """
         # Здесь мы применяем self._connection как менеджер контекста.
         # https://docs.python.org/3.13/library/sqlite3.html#how-to-use-the-connection-context-manager
-        with self._connection as conn:
+        with self._transaction() as conn:
             conn.execute('update note_image set ShortDescr=?, image=?, md5=? where id=?',
                          [short_desc, sqlite3.Binary(image), hashlib.md5(image).hexdigest(), image_id])
 
-    def get_notes(self, parent_id: int = None) -> []:
+    @staticmethod
+    def _note_dict(row: sqlite3.Row) -> dict:
+        return {"id": row["id"], "parent_id": row["ParentID"], "seq_no": row["SeqNo"], "name": row["Name"],
+                "length": row["size"]}
+
+    def get_notes(self, parent_id: int = None) -> list:
         """
         Возвращает записи из таблицы **NOTE**. Если указан непустой **parent_id**, то возвращаются
-        только записи, являющиеся дочерними по отношению к **parent_id**.
-        **Не возвращает поле TEXT**
+        только записи, являющиеся дочерними по отношению к **parent_id**, в порядке SeqNo.
+        **Не возвращает поле TEXT**. Для больших БД лучше использовать iter_children или iter_subtree.
         :param parent_id: Идентификатор родительского узла
-        :return: Идентификатор записи в таблице NOTE
+        :return: Список словарей {id, parent_id, seq_no, name, length}
         """
-        _result = []
-        _sql = "select id, name, length(text) as size from note"
         if parent_id:
-            _sql = _sql + f" where parentID = {parent_id} order by id asc"
+            return list(self.iter_children(parent_id))
+        _sql = f'select id, ParentID, SeqNo, Name, {self._size_sql} as size from note order by id'
+        return [self._note_dict(row) for row in self._connection.execute(_sql)]
 
-        for row in self._connection.execute(_sql):
-            _result.append({"id": row["id"], "name": row["name"], "length": row["size"]})
-        print("parent id: ", parent_id)
-        return _result
+    def iter_children(self, parent_id: int, notebook_id: int = None, state: str = None):
+        """
+        Перебирает прямых потомков узла в порядке SeqNo, не загружая их все в память.
+        Если указана записная книжка, то запрос использует индекс (NotebookID, ParentID, state).
+        :param parent_id: Идентификатор родительского узла. 0 - корневые узлы
+        :param notebook_id: Идентификатор записной книжки
+        :param state: Состояние записей, например 'A'. None - любое
+        :return: Итератор по словарям {id, parent_id, seq_no, name, length}
+        """
+        _sql, _params = self._children_query(parent_id, notebook_id, state, self._size_sql)
+        for row in self._connection.execute(_sql + ' order by SeqNo, id', _params):
+            yield self._note_dict(row)
+
+    def get_children_page(self, parent_id: int, after: tuple = None, limit: int = 100, notebook_id: int = None,
+                          state: str = None) -> list:
+        """
+        Страница прямых потомков узла (keyset pagination): записи, следующие за ключом after
+        в порядке (SeqNo, id). Стоимость запроса не зависит от номера страницы.
+
+        Пример::
+
+            page = db.get_children_page(parent_id)
+            while page:
+                ...
+                page = db.get_children_page(parent_id, after=(page[-1]["seq_no"], page[-1]["id"]))
+
+        :param parent_id: Идентификатор родительского узла. 0 - корневые узлы
+        :param after: Ключ (SeqNo, id) последней записи предыдущей страницы. None - первая страница
+        :param limit: Количество записей на странице
+        :param notebook_id: Идентификатор записной книжки
+        :param state: Состояние записей. None - любое
+        :return: Список словарей {id, parent_id, seq_no, name, length}
+        """
+        _sql, _params = self._children_query(parent_id, notebook_id, state, self._size_sql)
+        if after is not None:
+            _sql += ' and (SeqNo, id) > (?, ?)'
+            _params += list(after)
+        _sql += ' order by SeqNo, id limit ?'
+        return [self._note_dict(row) for row in self._connection.execute(_sql, _params + [limit])]
+
+    @staticmethod
+    def _children_query(parent_id: int, notebook_id: int, state: str, size: str = 'length(Text)') -> tuple[str, list]:
+        """ Запрос прямых потомков узла и его параметры. size - выражение SQL для длины текста """
+        _sql = f'select id, ParentID, SeqNo, Name, {size} as size from note where '
+        _params = []
+        if notebook_id is not None:
+            _sql += 'NotebookID = ? and '
+            _params.append(notebook_id)
+        # корневые узлы могут иметь ParentID = 0 или NULL
+        _sql += 'ParentID = ?' if parent_id else 'coalesce(ParentID, 0) = ?'
+        _params.append(parent_id or 0)
+        if state is not None:
+            _sql += ' and state = ?'
+            _params.append(state)
+        return _sql, _params
+
+    def iter_subtree(self, parent_id: int = 0, max_depth: int = None):
+        """
+        Перебирает всех потомков узла одним рекурсивным запросом в порядке обхода дерева
+        (дочерние узлы упорядочены по SeqNo).
+        :param parent_id: Идентификатор узла. Сам узел не возвращается. 0 - все записи
+        :param max_depth: Наибольшая глубина. None - без ограничения
+        :return: Итератор по словарям {id, parent_id, seq_no, name, length, depth, path}.
+                 depth - глубина (1 - прямые потомки), path - идентификаторы предков через '/'
+        """
+        _sql = f"""
+            with recursive tree(id, ParentID, SeqNo, Name, size, depth, path, sort_key) as (
+                select id, coalesce(ParentID, 0), SeqNo, Name, {self._size_sql}, 1, cast(id as text),
+                       printf('%010d.%010d', SeqNo, id)
+                  from note
+                 where coalesce(ParentID, 0) = ?
+                union all
+                select n.id, n.ParentID, n.SeqNo, n.Name, {self._text_size_sql(self._codec_columns, 'n.')},
+                       t.depth + 1, t.path || '/' || n.id,
+                       t.sort_key || '/' || printf('%010d.%010d', n.SeqNo, n.id)
+                  from note n
+                  join tree t on n.ParentID = t.id
+                 where ? is null or t.depth < ?
+            )
+            select id, ParentID, SeqNo, Name, coalesce(size, 0) as size, depth, path from tree order by sort_key
+            """
+        for row in self._connection.execute(_sql, [parent_id, max_depth, max_depth]):
+            _note = self._note_dict(row)
+            _note["depth"] = row["depth"]
+            _note["path"] = row["path"]
+            yield _note
 
     def get_children_count(self, parent_id: int) -> int:
         """
@@ -150,25 +697,84 @@ class HystDB:
         :param parent_id: Идентификатор родительского узла
         :returns: Количество прямых потомков у узла
         """
-        return \
-        self._connection.execute(f'select count(1) as counter from note where ParentID = {parent_id}').fetchone()[
-            "counter"]
+        return self._connection.execute('select count(1) as counter from note where ParentID = ?',
+                                        [parent_id]).fetchone()["counter"]
 
     def get_note_text(self, note_id: int) -> str:
         """
-        Возвращает текст статьи по её идентификатору.
+        Возвращает текст статьи по её идентификатору. Фрагменты, ожидающие дописывания, сначала записываются.
+        Недавно прочитанные тексты хранятся в кэше уже распакованными.
         :param note_id: Идентификатор статьи
-        :return: Текст статьи
+        :return: Текст статьи. Пустая строка - если текста нет
         """
-        with self._connection.blobopen("NOTE", "TEXT", note_id) as blob:
-            return blob.read().decode()
+        self.flush_note_text(note_id)
+        _text = self._text_cache.get(note_id)
+        if _text is not None:
+            self._text_cache.move_to_end(note_id)
+            return _text
+        _text = self._read_note_text(note_id)
+        if self.cache_size > 0:
+            self._text_cache[note_id] = _text
+            if len(self._text_cache) > self.cache_size:
+                self._text_cache.popitem(last=False)
+        return _text
 
-    def update_note_text(self, note_id:int, text: str):
+    def _read_note_text(self, note_id: int) -> str:
+        _row = self._connection.execute(f'select text, {"codec" if self._codec_columns else "null"} as codec '
+                                        f'from note where id = ?', [note_id]).fetchone()
+        return self.decode_text(_row["text"], _row["codec"]) if _row is not None else ''
+
+    def update_note_text(self, note_id: int, text: str):
         """
-        Обновляет текст статьи.
+        Обновляет текст статьи. Фрагменты, ожидающие дописывания, отбрасываются.
         :param note_id: Идентификатор статьи
         :param text: Новый текст
         :return:
         """
-        self._connection.execute(f"update note set text = '{text}' where id={note_id}")
-        self._connection.commit()
+        self._note_buffers.pop(note_id, None)
+        self._text_cache.pop(note_id, None)
+        with self._transaction() as conn:
+            conn.execute(f'update note set {", ".join(f"{column} = ?" for column in self._text_columns)} where id = ?',
+                         [*self._text_values(text), note_id])
+
+    def append_note_text(self, note_id: int, text: str):
+        """
+        Дописывает фрагмент в конец текста статьи. Фрагменты копятся в памяти, и каждая статья
+        записывается один раз: при flush_note_text, при чтении текста, в конце bulk или при закрытии БД.
+        :param note_id: Идентификатор статьи
+        :param text: Фрагмент текста
+        """
+        self._note_buffers.setdefault(note_id, []).append(text)
+
+    def flush_note_text(self, note_id: int = None):
+        """
+        Записывает накопленные фрагменты. Текст дописывается средствами SQLite, без чтения
+        старого текста в Python.
+        :param note_id: Идентификатор статьи. None - все статьи
+        """
+        if note_id is None:
+            _buffers, self._note_buffers = self._note_buffers, {}
+        elif note_id in self._note_buffers:
+            _buffers = {note_id: self._note_buffers.pop(note_id)}
+        else:
+            return
+        if not _buffers:
+            return
+        for _id in _buffers:
+            self._text_cache.pop(_id, None)
+        if not self._codec_columns:
+            _compressed = set()
+        elif self.codec is None:
+            # сжатые раньше записи дописываются через распаковку
+            _compressed = {_id for _id in _buffers if self._connection.execute(
+                'select 1 from note where id = ? and codec is not null', [_id]).fetchone()}
+        else:
+            _compressed = set(_buffers)
+        # текст, вставленный как bytes, приводится к строке, иначе конкатенация даст BLOB
+        _sql = "update note set text = coalesce(cast(text as text), '') || ? where id = ?"
+        with self._transaction() as conn:
+            conn.executemany(_sql, ((''.join(parts), _id) for _id, parts in _buffers.items()
+                                    if _id not in _compressed))
+            for _id in _compressed:
+                conn.execute('update note set text = ?, codec = ?, TextSize = ? where id = ?',
+                             [*self._text_values(self._read_note_text(_id) + ''.join(_buffers[_id])), _id])
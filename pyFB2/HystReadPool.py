@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from pyFB2.HystDB import HystDB
+
+
+class HystReadPool:
+    """
+    Пул соединений для чтения БД Hyst из многих потоков, например в веб-просмотрщике.
+
+    Каждый поток получает свое соединение только для чтения (URI mode=ro) с кэшем подготовленных
+    запросов, поэтому чтение текстов статей и изображений не требует блокировок и масштабируется
+    по потокам. Запись выполняется через единственный объект HystDB (writer), доступ к которому
+    упорядочен блокировкой.
+    """
+
+    def __init__(self, filename: str, cached_statements: int = 256, wal: bool = False):
+        """
+        Конструктор класса
+        :param filename: Имя файла БД Hyst
+        :param cached_statements: Количество подготовленных запросов в кэше каждого соединения
+        :param wal: Перевести БД в режим журнала WAL, в котором чтение не блокируется записью.
+                    Режим сохраняется в файле БД
+        """
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(f'Ошибка: БД {filename} не найдена')
+        self.filename = filename
+        self.cached_statements = cached_statements
+        self._uri = 'file:' + pathname2url(os.path.abspath(filename)) + '?mode=ro'
+        self._local = threading.local()
+        self._lock = threading.Lock()  # защищает список соединений и создание писателя
+        self._write_lock = threading.Lock()  # упорядочивает запись
+        self._connections: list[sqlite3.Connection] = []
+        self._writer: HystDB = None
+        # увеличивается, когда писатель меняет схему БД: потоки чтения заново определяют колонки
+        self._schema = 0
+        if wal:
+            with self.write() as writer:
+                writer.connection.execute('pragma journal_mode = WAL')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connection(self) -> sqlite3.Connection:
+        """ Соединение только для чтения для текущего потока. Создается при первом обращении """
+        _connection = getattr(self._local, 'connection', None)
+        if _connection is None:
+            # check_same_thread=False только для того, чтобы close() мог закрыть соединения всех потоков
+            _connection = sqlite3.connect(self._uri, uri=True, check_same_thread=False,
+                                          cached_statements=self.cached_statements)
+            _connection.row_factory = sqlite3.Row
+            self._local.connection = _connection
+            self._local.schema = None
+            with self._lock:
+                self._connections.append(_connection)
+        if self._local.schema != self._schema:
+            self._local.schema = self._schema
+            # в БД, созданных без сжатия, колонок codec и TextSize может не быть,
+            # писатель добавляет их, например, при слиянии со сжатой БД
+            self._local.codec = {table: 'codec' if 'codec' in HystDB._table_columns(_connection, table) else 'null'
+                                 for table in ('note', 'css')}
+            self._local.size = HystDB._text_size_sql(self._local.codec["note"] == 'codec')
+        return _connection
+
+    @contextmanager
+    def write(self):
+        """
+        Единственный объект для записи в БД. Пока блок with выполняется, другие потоки не пишут.
+
+        Пример::
+
+            with pool.write() as writer:
+                writer.update_note_text(note_id, text)
+        """
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = HystDB(self.filename, check_same_thread=False)
+            _schema_version = self._schema_version()
+            yield self._writer
+            self._writer.flush_note_text()
+            self._writer.connection.commit()
+            if self._schema_version() != _schema_version:
+                self._schema += 1
+
+    def _schema_version(self) -> int:
+        """ Счетчик изменений схемы БД, который SQLite увеличивает при каждом изменении схемы """
+        return self._writer.connection.execute('pragma schema_version').fetchone()[0]
+
+    def get_note_text(self, note_id: int) -> str:
+        """
+        Текст статьи, в том числе сжатый.
+        :param note_id: Идентификатор статьи
+        :return: Текст статьи. Пустая строка - если статьи нет или у нее нет текста
+        """
+        _connection = self.connection()
+        _row = _connection.execute(f'select text, {self._local.codec["note"]} as codec from note where id = ?',
+                                   [note_id]).fetchone()
+        return HystDB.decode_text(_row["text"], _row["codec"]) if _row is not None else ''
+
+    def get_image(self, image_id: int) -> bytes:
+        """
+        Изображение из таблицы NOTE_IMAGE.
+        :param image_id: Идентификатор изображения
+        :return: Изображение. None - если его нет
+        """
+        _row = self.connection().execute('select image from note_image where id = ?', [image_id]).fetchone()
+        return _row["image"] if _row is not None else None
+
+    def get_css(self, css_id: int) -> bytes:
+        """
+        Содержимое файла стилей из таблицы CSS.
+        :param css_id: Идентификатор записи
+        :return: Содержимое файла. None - если записи нет
+        """
+        _connection = self.connection()
+        _row = _connection.execute(f'select css, {self._local.codec["css"]} as codec from css where id = ?',
+                                   [css_id]).fetchone()
+        if _row is None:
+            return None
+        _value = HystDB.decode_data(_row["css"], _row["codec"])
+        return _value.encode('utf-8') if isinstance(_value, str) else _value
+
+    def get_children(self, parent_id: int, notebook_id: int = None) -> list:
+        """
+        Прямые потомки узла в порядке SeqNo.
+        :param parent_id: Идентификатор родительского узла. 0 - корневые узлы
+        :param notebook_id: Идентификатор записной книжки
+        :return: Список словарей {id, parent_id, seq_no, name, length}
+        """
+        _connection = self.connection()
+        _sql, _params = HystDB._children_query(parent_id, notebook_id, None, self._local.size)
+        return [HystDB._note_dict(row) for row in _connection.execute(_sql + ' order by SeqNo, id', _params)]
+
+    def close(self):
+        """ Закрывает соединения всех потоков и объект для записи """
+        with self._lock:
+            for _connection in self._connections:
+                _connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
@@ -1 +1,305 @@
-﻿raise NotImplementedError("This is a library only")
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+Командная строка pyFB2::
+
+    python -m pyFB2 <команда> [аргументы] пути...
+
+Команды: scan, rename, html, hyst, zip, unzip, validate. Подробности - python -m pyFB2 <команда> --help.
+Модули pyFB2 импортируются только для выбранной команды, поэтому запуск не тратит время на лишние импорты.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+
+# Расширения файлов, которые обрабатывает команда
+SUFFIXES = {"scan": ('.fb2', '.fb2.zip'), "rename": ('.fb2', '.fb2.zip'), "html": ('.fb2',), "hyst": ('.fb2',),
+            "zip": ('.fb2',), "unzip": ('.zip',), "validate": ('.fb2',)}
+# Команды, упирающиеся в ввод-вывод и сжатие (zlib отпускает GIL), выполняются в потоках, остальные - в процессах
+THREAD_COMMANDS = ('zip', 'unzip')
+
+
+class Progress:
+    """
+    Строка хода выполнения в stderr: обработано файлов, файлов в секунду и МБ в секунду.
+    Строка обновляется не чаще, чем раз в interval секунд.
+    """
+
+    def __init__(self, total: int, enabled: bool = True, interval: float = 0.2):
+        self.total = total
+        self.enabled = enabled
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self._start = time.perf_counter()
+        self._shown = 0.0
+
+    def update(self, size: int):
+        """ Учитывает обработанный файл размером size байт """
+        self.files += 1
+        self.bytes += size
+        _now = time.perf_counter()
+        if self.enabled and (_now - self._shown >= self.interval or self.files == self.total):
+            self._shown = _now
+            _elapsed = max(_now - self._start, 1e-9)
+            sys.stderr.write(f'\r{self.files}/{self.total} файлов, {self.files / _elapsed:.1f} файл/с, '
+                             f'{self.bytes / 1024 / 1024 / _elapsed:.2f} МБ/с ')
+            sys.stderr.flush()
+
+    def close(self):
+        if self.enabled and self.files:
+            sys.stderr.write('\n')
+
+
+def find_files(paths: list, suffixes: tuple, recursive: bool = False) -> list[str]:
+    """
+    Список файлов для обработки. Файлы, указанные явно, берутся как есть,
+    в каталогах выбираются файлы с расширениями suffixes.
+    :param paths: Файлы и каталоги
+    :param suffixes: Расширения файлов в нижнем регистре
+    :param recursive: Искать файлы в подкаталогах
+    """
+    _files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            _files.append(path)
+            continue
+        for folder, subfolders, filenames in os.walk(path):
+            _files += [os.path.join(folder, name) for name in sorted(filenames) if name.lower().endswith(suffixes)]
+            if not recursive:
+                break
+    return list(dict.fromkeys(_files))
+
+
+def _scan(task: dict) -> dict:
+    """ Сведения о книге из description. Архивы .fb2.zip не распаковываются целиком """
+    import zipfile
+    from pyFB2.FB2Parser import FB2Parser
+    from pyFB2.FB2Zip import UnzipFB2
+    if task["source"].lower().endswith('.zip'):
+        with zipfile.ZipFile(task["source"]) as archive:
+            _info = next((info for info in archive.infolist() if UnzipFB2.is_fb2_member(info)), None)
+            if _info is None:
+                raise ValueError('В архиве нет файлов FB2')
+            with archive.open(_info) as stream:
+                _parser = FB2Parser(task["source"], metadata_only=True, stream=stream)
+    else:
+        _parser = FB2Parser(task["source"], metadata_only=True)
+    _author = ' '.join(filter(None, [_parser.author_last_name(), _parser.author_first_name(),
+                                     _parser.author_middle_name()]))
+    return {"author": _author, "title": _parser.title, "sequence": _parser.sequence_name,
+            "sequence_number": _parser.sequence_number, "genres": _parser.genres, "lang": _parser.lang}
+
+
+def _rename(task: dict) -> dict:
+    from pyFB2.FB2Renamer import FB2Renamer
+    _renamer = FB2Renamer(task["source"], task["template"], task["out_dir"], rename_member=task["rename_member"])
+    _target = os.path.join(_renamer.new_path, _renamer.new_filename)
+    if task["dry_run"]:
+        return {"status": "planned", "target": _target}
+    _renamer.rename()
+    return {"target": _target}
+
+
+def _html(task: dict) -> dict:
+    from pyFB2.FB2HTML import FB2HTML
+    _html = FB2HTML(task["source"], task["out_dir"], css=task["css"], check_schema=task["check_schema"])
+    _code = _html.create_html(task["out_dir"])
+    if _code != 0:
+        raise RuntimeError(f'create_html вернул код ошибки {_code}')
+    return {"target": _html.out_dir}
+
+
+def _zip(task: dict) -> dict:
+    from pyFB2.FB2Zip import ZipFB2
+    return {"target": ZipFB2(removefb2=task["remove"], compresslevel=task["level"]).zipFile(task["source"])}
+
+
+def _unzip(task: dict) -> dict:
+    from pyFB2.FB2Zip import UnzipFB2
+    _unzip = UnzipFB2(removezip=task["remove"])
+    _result = {"extracted": _unzip.unzipFile(task["source"])}
+    if task["source"] in _unzip.kept:
+        _result["kept"] = _unzip.kept[task["source"]]
+    return _result
+
+
+def _validate(task: dict) -> dict:
+    from pyFB2.FB2Parser import get_schema
+    get_schema().validate(task["source"])
+    return {}
+
+
+WORKERS = {"scan": _scan, "rename": _rename, "html": _html, "zip": _zip, "unzip": _unzip, "validate": _validate}
+# Команды, которые в режиме --dry-run выполняются сами и сообщают, что было бы сделано
+DRY_RUN_WORKERS = ('rename',)
+
+
+def _execute(task: dict, redirect: bool = True) -> dict:
+    """
+    Обработка одного файла в процессе (потоке) пула.
+    Ошибки перехватываются, чтобы один файл не останавливал обработку остальных.
+    :param redirect: Перенаправлять сообщения модулей в stderr, чтобы они не смешивались с итогами в stdout.
+                     redirect_stdout подменяет sys.stdout всего процесса, поэтому в потоках его использовать нельзя
+    :return: Результат: source, status ('ok', 'planned' или 'failed'), error и сведения от команды
+    """
+    _result = {"source": task["source"], "status": "ok", "error": None}
+    try:
+        if task["dry_run"] and task["command"] not in DRY_RUN_WORKERS:
+            _result["status"] = "planned"
+        else:
+            with contextlib.redirect_stdout(sys.stderr) if redirect else contextlib.nullcontext():
+                _result.update(WORKERS[task["command"]](task))
+    except Exception as err:
+        _result["status"] = "failed"
+        _reason = getattr(err, 'reason', None) or str(err)
+        _result["error"] = f'{type(err).__name__}: {_reason}'
+    return _result
+
+
+def _run_tasks(command: str, tasks: list, jobs: int):
+    """ Итератор по результатам обработки файлов в порядке заданий """
+    if jobs == 1:
+        yield from map(_execute, tasks)
+        return
+    if command in THREAD_COMMANDS:
+        # ZipFB2 и UnzipFB2 без debug ничего не выводят, о результате сообщают возвращаемыми значениями
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as _pool:
+            yield from _pool.map(functools.partial(_execute, redirect=False), tasks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as _pool:
+            yield from _pool.map(_execute, tasks, chunksize=4)
+
+
+def _run_hyst(args, files: list, progress: Progress, sizes: dict):
+    """ Импорт в БД Hyst: книги отрисовываются в пуле процессов, записывает их один процесс """
+    if args.dry_run:
+        yield from map(_execute, ({"source": file, "command": "hyst", "dry_run": True} for file in files))
+        return
+    from pyFB2.FB2HystLibrary import FB2HystLibrary
+    _library = FB2HystLibrary(args.database, notebook=args.notebook, css=args.css, jobs=args.jobs,
+                              check_schema=args.check_schema, commit_every=args.commit_every, unsafe=args.unsafe,
+                              codec=args.codec)
+    _statuses = {}
+
+    def _on_book(source: str, status: str):
+        _statuses[source] = status
+        progress.update(sizes.get(source, 0))
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            _summary = _library.import_files(files, progress=_on_book)
+    finally:
+        _library.close()
+    _errors = {item["source"]: item["error"] for item in _summary["errors"]}
+    for file in files:
+        yield {"source": file, "status": _statuses.get(file, "failed"), "error": _errors.get(file)}
+
+
+def run(args) -> dict:
+    """
+    Выполняет команду над всеми файлами
+    :param args: Разобранные аргументы командной строки
+    :return: Итоги: command, dry_run, files, ok, planned, skipped, failed, bytes, seconds, files_per_second,
+             mb_per_second, errors
+    """
+    _start = time.perf_counter()
+    _files = find_files(args.paths, SUFFIXES[args.command], args.recursive)
+    _sizes = {file: os.path.getsize(file) if os.path.isfile(file) else 0 for file in _files}
+    _progress = Progress(len(_files), enabled=args.progress)
+    _summary = {"command": args.command, "dry_run": args.dry_run, "files": len(_files), "ok": 0, "planned": 0,
+                "skipped": 0, "failed": 0, "bytes": 0, "errors": []}
+    _output = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        if args.command == 'hyst':
+            _results = _run_hyst(args, _files, _progress, _sizes)
+        else:
+            _options = {key: value for key, value in vars(args).items() if key not in ('paths', 'func')}
+            _results = _run_tasks(args.command, [dict(_options, source=file) for file in _files], args.jobs)
+        for result in _results:
+            _summary[result["status"]] += 1
+            if result["status"] == "failed":
+                _summary["errors"].append({"source": result["source"], "error": result["error"]})
+            else:
+                _summary["bytes"] += _sizes[result["source"]]
+            if args.command != 'hyst':
+                _progress.update(_sizes[result["source"]])
+            if _output is not None:
+                _output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    finally:
+        _progress.close()
+        if _output is not None:
+            _output.close()
+    _summary["seconds"] = time.perf_counter() - _start
+    _elapsed = max(_summary["seconds"], 1e-9)
+    _summary["files_per_second"] = len(_files) / _elapsed
+    _summary["mb_per_second"] = sum(_sizes.values()) / 1024 / 1024 / _elapsed
+    return _summary
+
+
+def create_parser() -> argparse.ArgumentParser:
+    _common = argparse.ArgumentParser(add_help=False)
+    _common.add_argument('paths', nargs='+', help='Файлы и каталоги')
+    _common.add_argument('-r', '--recursive', action='store_true', help='Искать файлы в подкаталогах')
+    _common.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                         help='Количество параллельных заданий. По умолчанию - по числу процессоров')
+    _common.add_argument('-n', '--dry-run', action='store_true', help='Только показать, что будет сделано')
+    _common.add_argument('--output', help='Файл для результатов по каждому файлу (JSON Lines)')
+    _common.add_argument('--no-progress', dest='progress', action='store_false', default=sys.stderr.isatty(),
+                         help='Не выводить строку хода выполнения')
+
+    _parser = argparse.ArgumentParser(prog='python -m pyFB2', description='Обработка файлов FB2. '
+                                      'Итоги выводятся в stdout в формате JSON, ход выполнения - в stderr.')
+    _commands = _parser.add_subparsers(dest='command', required=True, metavar='команда')
+
+    _commands.add_parser('scan', parents=[_common], help='Сведения о книгах (автор, название, серия, жанры)')
+
+    _rename = _commands.add_parser('rename', parents=[_common], help='Переименование по шаблону')
+    _rename.add_argument('-t', '--template', required=True, help="Шаблон имени, например '${Al} ${Af} - ${Tt}'")
+    _rename.add_argument('--out-dir', default='', help='Дополнительный каталог в форме шаблона, например ${Al}')
+    _rename.add_argument('--rename-member', action='store_true',
+                         help='Для архивов .fb2.zip переименовывать также файл FB2 внутри архива')
+
+    _html = _commands.add_parser('html', parents=[_common], help='Преобразование в HTML')
+    _html.add_argument('-o', '--out-dir', required=True, help='Каталог для книг HTML')
+    _html.add_argument('--css', help='Файл CSS')
+    _html.add_argument('--check-schema', action='store_true', help='Проверять файлы на соответствие схеме')
+
+    _hyst = _commands.add_parser('hyst', parents=[_common], help='Импорт в БД Hyst')
+    _hyst.add_argument('-d', '--database', required=True, help='Файл БД Hyst')
+    _hyst.add_argument('--notebook', default='Библиотека', help='Записная книжка')
+    _hyst.add_argument('--css', help='Файл CSS')
+    _hyst.add_argument('--codec', help='Сжатие текста глав, например zlib')
+    _hyst.add_argument('--commit-every', type=int, default=100, help='Количество книг в одной транзакции')
+    _hyst.add_argument('--unsafe', action='store_true', help='Быстрые, но небезопасные настройки БД на время импорта')
+    _hyst.add_argument('--check-schema', action='store_true', help='Проверять файлы на соответствие схеме')
+
+    _zip = _commands.add_parser('zip', parents=[_common], help='Упаковка каждой книги в архив .fb2.zip')
+    _zip.add_argument('--remove', action='store_true', help='Удалять файл FB2 после упаковки')
+    _zip.add_argument('--level', type=int, default=9, choices=range(1, 10), help='Степень сжатия')
+
+    _unzip = _commands.add_parser('unzip', parents=[_common], help='Извлечение файлов FB2 из архивов ZIP')
+    _unzip.add_argument('--remove', action='store_true', help='Удалять архив после извлечения')
+
+    _commands.add_parser('validate', parents=[_common], help='Проверка на соответствие схеме FictionBook')
+    return _parser
+
+
+def main(argv: list = None) -> int:
+    """
+    :return: Код завершения: 0 - все файлы обработаны, 1 - были ошибки
+    """
+    _args = create_parser().parse_args(argv)
+    _args.jobs = max(1, _args.jobs)
+    _summary = run(_args)
+    print(json.dumps(_summary, ensure_ascii=False, indent=1))
+    return 1 if _summary["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
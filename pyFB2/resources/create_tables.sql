@@ -39,6 +39,8 @@ CREATE TABLE IF NOT EXISTS note (
 
 CREATE INDEX IF NOT EXISTS idx_note_parentid ON note (NotebookID, ParentID, state);
 
+CREATE INDEX IF NOT EXISTS idx_note_name ON note (NotebookID, ParentID, Name);
+
 CREATE TABLE IF NOT EXISTS note_image (
     id         INTEGER       CONSTRAINT pk_note_image PRIMARY KEY AUTOINCREMENT
                              CONSTRAINT uniq_note_image UNIQUE
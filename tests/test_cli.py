@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Проверки командной строки python -m pyFB2 на синтетических книгах (FB2Generator)
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import zipfile
+import unittest
+
+from pyFB2.FB2Generator import FB2Generator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_cli(*args) -> subprocess.CompletedProcess:
+    """ Запускает python -m pyFB2 в отдельном процессе """
+    return subprocess.run([sys.executable, '-m', 'pyFB2', *args, '--no-progress'], cwd=ROOT, capture_output=True,
+                          text=True, encoding='utf-8')
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+        self.books = FB2Generator(sections=1, paragraphs=2, notes=0, images=0).generate(self.dir, 40)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_zip_jobs_summary_in_stdout(self):
+        # потоки пула не должны подменять sys.stdout: итоги всегда в stdout, а не в stderr
+        for _ in range(6):
+            _process = run_cli('zip', self.dir, '-j4')
+            self.assertEqual(_process.returncode, 0, _process.stderr)
+            _summary = json.loads(_process.stdout)
+            self.assertEqual((_summary["files"], _summary["ok"], _summary["failed"]), (40, 40, 0))
+        self.assertTrue(all(os.path.isfile(f'{book}.zip') for book in self.books))
+
+    def test_unzip_keeps_archive_with_other_files(self):
+        _archive = self.books[0] + '.zip'
+        run_cli('zip', self.books[0], '--remove')
+        with zipfile.ZipFile(_archive, 'a') as archive:
+            archive.writestr('cover.jpg', b'jpg')
+        _process = run_cli('unzip', self.dir, '-j4', '--remove')
+        self.assertEqual(json.loads(_process.stdout)["ok"], 1, _process.stderr)
+        self.assertTrue(os.path.isfile(_archive))
+        self.assertTrue(os.path.isfile(self.books[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
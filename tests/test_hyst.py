@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Проверки импорта библиотеки и слияния БД Hyst на синтетических книгах (FB2Generator).
+
+После каждой операции все ссылки db://thisdb.* в тексте статей должны указывать на существующие записи той же
+книги, а сами ссылки, записанные без идентификаторов (путь статьи, MD5 изображения, код CSS), - совпадать
+со ссылками исходных книг. Повторный импорт и слияние не должны дублировать записные книжки, авторов и изображения.
+"""
+import base64
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from pyFB2.FB2Generator import FB2Generator
+from pyFB2.FB2HystLibrary import FB2HystLibrary, PLACEHOLDER
+from pyFB2.HystDB import DB_LINK, HystDB
+
+BOOKS = 4  # книг в каждой из двух частей библиотеки
+
+
+def import_books(filename: str, files: list, codec: str = None, css: str = None) -> dict:
+    """ Импортирует книги в БД filename, возвращает итоги импорта """
+    _library = FB2HystLibrary(filename, css=css, jobs=2, codec=codec)
+    try:
+        return _library.import_files(files)
+    finally:
+        _library.close()
+
+
+def merge(filename: str, src_db: str, merge_existing: bool = False) -> int:
+    _db = HystDB(filename)
+    try:
+        return _db.merge_database(src_db, merge_existing=merge_existing)
+    finally:
+        _db.close()
+
+
+def counts(filename: str) -> dict:
+    """ Количество записных книжек, корневых статей (авторов), всех статей и изображений """
+    with sqlite3.connect(filename) as conn:
+        return {"notebooks": conn.execute('select count(1) from notebook').fetchone()[0],
+                "roots": conn.execute('select count(1) from note where coalesce(ParentID, 0) = 0').fetchone()[0],
+                "notes": conn.execute('select count(1) from note').fetchone()[0],
+                "images": conn.execute('select count(1) from note_image').fetchone()[0]}
+
+
+class HystTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._tmp = tempfile.TemporaryDirectory()
+        cls.dir = cls._tmp.name
+        # авторов меньше, чем книг: у авторов обеих частей библиотеки есть общие книги
+        _generator = FB2Generator(sections=2, depth=2, paragraphs=2, words=10, notes=2, images=2, image_size=512,
+                                  authors=2)
+        cls.part_a = [_generator.write(os.path.join(cls.dir, f'a_{index}.fb2'), index) for index in range(BOOKS)]
+        cls.part_b = [_generator.write(os.path.join(cls.dir, f'b_{index}.fb2'), index)
+                      for index in range(BOOKS, 2 * BOOKS)]
+        # MD5 изображений, на которые ссылается каждая книга: название книги -> множество MD5
+        cls.images = {}
+        for index, filename in enumerate(cls.part_a + cls.part_b):
+            with open(filename, 'rb') as f:
+                _data = f.read()
+            _binaries = dict(re.findall(rb'<binary id="([^"]+)"[^>]*>([^<]*)</binary>', _data))
+            cls.images[_generator.title(index)] = {hashlib.md5(base64.b64decode(_binaries[name])).hexdigest()
+                                                   for name in re.findall(rb'<image l:href="#([^"]+)"', _data)}
+        cls.css = os.path.join(cls.dir, 'book.css')
+        with open(cls.css, 'w', encoding='utf-8') as f:
+            f.write('p { text-indent: 1em; }')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp.cleanup()
+
+    def db(self, name: str) -> str:
+        """ Имя файла новой БД во временном каталоге """
+        _filename = os.path.join(self.dir, name)
+        if os.path.exists(_filename):
+            os.unlink(_filename)
+        return _filename
+
+    def assertLinksResolve(self, filename: str) -> dict:
+        """
+        Проверяет, что ссылки в тексте статей указывают на существующие записи и не выходят за пределы книги,
+        а меток $note:N$ и $image:N$ не осталось.
+        :return: Ссылки без идентификаторов: название книги -> отсортированный список книг с этим названием,
+                 для каждой книги - отсортированный список (путь статьи со ссылкой, вид ссылки, путь статьи,
+                 MD5 изображения или код CSS, на которые ссылка указывает)
+        """
+        with sqlite3.connect(filename) as conn:
+            _codec = 'codec' if 'codec' in HystDB._table_columns(conn, 'note') else 'null'
+            _notes = {row[0]: row[1:] for row in conn.execute(
+                f'select id, coalesce(ParentID, 0), NotebookID, Name, Text, {_codec} from note')}
+            _notebooks = {row[0] for row in conn.execute('select id from notebook')}
+            _targets = {"note_image.image": dict(conn.execute('select id, MD5 from note_image').fetchall()),
+                        "css.css": dict(conn.execute('select id, code from css').fetchall())}
+
+        def _book(note_id: int) -> int:
+            # книга - статья, родитель которой корневая статья (автор)
+            while _notes[note_id][0] and _notes[_notes[note_id][0]][0]:
+                note_id = _notes[note_id][0]
+            return note_id
+
+        def _path(note_id: int) -> tuple:
+            _names = [_notes[note_id][2]]
+            while note_id != _book(note_id):
+                note_id = _notes[note_id][0]
+                _names.insert(0, _notes[note_id][2])
+            return tuple(_names)
+
+        _books = {}
+        for note_id, (parent_id, notebook_id, name, text, codec) in _notes.items():
+            self.assertTrue(not parent_id or parent_id in _notes, f'статья {note_id}: нет родителя {parent_id}')
+            self.assertIn(notebook_id, _notebooks, f'статья {note_id}: нет записной книжки {notebook_id}')
+            _text = HystDB.decode_text(text, codec) if text is not None else ''
+            self.assertIsNone(PLACEHOLDER.search(_text), f'статья {note_id}: осталась метка')
+            for kind, target in DB_LINK.findall(_text):
+                _target = int(target)
+                if kind == 'note.text':
+                    self.assertIn(_target, _notes, f'статья {note_id}: нет статьи {target}')
+                    self.assertEqual(_book(_target), _book(note_id), f'статья {note_id}: ссылка в другую книгу')
+                    _value = _path(_target)
+                else:
+                    self.assertIn(_target, _targets[kind], f'статья {note_id}: нет записи {kind}.{target}')
+                    _value = _targets[kind][_target]
+                _books.setdefault(_book(note_id), []).append((_path(note_id), kind, _value))
+        self.assertTrue(_books, 'в статьях нет ссылок')
+        _result = {}
+        for book_id, links in _books.items():
+            _result.setdefault(_notes[book_id][2], []).append(sorted(links))
+        return {title: sorted(books) for title, books in _result.items()}
+
+
+class LibraryImportTest(HystTestCase):
+
+    def test_import(self):
+        _db = self.db('import.db')
+        _summary = import_books(_db, self.part_a, css=self.css)
+        self.assertEqual((_summary["imported"], _summary["failed"]), (BOOKS, 0), _summary["errors"])
+        _links = self.assertLinksResolve(_db)
+        self.assertEqual(counts(_db)["images"], 2 * BOOKS)
+        # метки $image:N$ заменены ссылками на изображения своей книги
+        self.assertEqual({title: {value for path, kind, value in books[0] if kind == 'note_image.image'}
+                          for title, books in _links.items()},
+                         {title: self.images[title] for title in _links})
+        self.assertEqual(len(_links), BOOKS)
+        # при другом порядке книги получают другие идентификаторы, но ссылки те же
+        _reversed = self.db('import_reversed.db')
+        import_books(_reversed, self.part_a[::-1], css=self.css)
+        self.assertEqual(self.assertLinksResolve(_reversed), self.assertLinksResolve(_db))
+
+    def test_repeated_import(self):
+        _db = self.db('repeat.db')
+        import_books(_db, self.part_a, css=self.css)
+        _counts, _links = counts(_db), self.assertLinksResolve(_db)
+        _summary = import_books(_db, self.part_a, css=self.css)
+        self.assertEqual((_summary["imported"], _summary["skipped"]), (0, BOOKS))
+        self.assertEqual(counts(_db), _counts)
+        self.assertEqual(self.assertLinksResolve(_db), _links)
+
+    def test_import_after_deleted_notes(self):
+        # sqlite_sequence опережает max(id): главы новых книг не должны занять выданные ранее идентификаторы
+        _db = self.db('deleted.db')
+        import_books(_db, self.part_a[:2], css=self.css)
+        with sqlite3.connect(_db) as conn:
+            _deleted = conn.execute("insert into note (ParentID, NotebookID, Name) values (0, 1, 'x')").lastrowid
+            conn.execute('delete from note where id = ?', [_deleted])
+        import_books(_db, self.part_a[2:], css=self.css)
+        with sqlite3.connect(_db) as conn:
+            self.assertIsNone(conn.execute('select 1 from note where id = ?', [_deleted]).fetchone())
+        _expected = self.db('deleted_expected.db')
+        import_books(_expected, self.part_a, css=self.css)
+        self.assertEqual(self.assertLinksResolve(_db), self.assertLinksResolve(_expected))
+
+    def test_import_compressed(self):
+        _db = self.db('compressed.db')
+        import_books(_db, self.part_a, codec='zlib', css=self.css)
+        _expected = self.db('uncompressed.db')
+        import_books(_expected, self.part_a, css=self.css)
+        self.assertEqual(self.assertLinksResolve(_db), self.assertLinksResolve(_expected))
+
+
+class MergeTest(HystTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.db_a = os.path.join(cls.dir, 'part_a.db')
+        cls.db_b = os.path.join(cls.dir, 'part_b.db')
+        import_books(cls.db_a, cls.part_a, css=cls.css)
+        # вторая часть сжата: при слиянии в несжатую БД добавляются колонки сжатия
+        import_books(cls.db_b, cls.part_b, codec='zlib', css=cls.css)
+
+    def target(self, name: str) -> str:
+        """ Копия первой части библиотеки, в которую переносится вторая """
+        _db = self.db(name)
+        shutil.copyfile(self.db_a, _db)
+        return _db
+
+    def expected_links(self, copies: int) -> dict:
+        """ Ссылки первой части и copies копий каждой книги второй части """
+        _links = self.assertLinksResolve(self.db_a)
+        for title, books in self.assertLinksResolve(self.db_b).items():
+            _links[title] = sorted(_links.get(title, []) + books * copies)
+        return _links
+
+    def test_merge(self):
+        _db = self.target('merge.db')
+        _a, _b = counts(_db), counts(self.db_b)
+        self.assertEqual(merge(_db, self.db_b), _b["notes"])
+        self.assertEqual(counts(_db)["notes"], _a["notes"] + _b["notes"])
+        self.assertEqual(self.assertLinksResolve(_db), self.expected_links(1))
+
+    def test_repeated_merge_existing(self):
+        # записные книжки, авторы и изображения не дублируются, добавляются только книги
+        _db = self.target('merge_existing.db')
+        _a, _b = counts(_db), counts(self.db_b)
+        for step in (1, 2):
+            merge(_db, self.db_b, merge_existing=True)
+            self.assertEqual(counts(_db), {"notebooks": _a["notebooks"], "roots": _a["roots"],
+                                           "notes": _a["notes"] + step * (_b["notes"] - _b["roots"]),
+                                           "images": _a["images"] + _b["images"]})
+            self.assertEqual(self.assertLinksResolve(_db), self.expected_links(step))
+
+    def test_resume_write_to_disk(self):
+        _db = self.target('resume.db')
+        _a, _b = counts(_db), counts(self.db_b)
+        for step in (1, 2):
+            _memory = HystDB()
+            _memory.merge_database(self.db_b)
+            _memory.write_to_disk(_db, resume=True)
+            _memory.close()
+            self.assertEqual(counts(_db), {"notebooks": _a["notebooks"], "roots": _a["roots"],
+                                           "notes": _a["notes"] + step * (_b["notes"] - _b["roots"]),
+                                           "images": _a["images"] + _b["images"]})
+            self.assertEqual(self.assertLinksResolve(_db), self.expected_links(step))
+
+
+if __name__ == '__main__':
+    unittest.main()